@@ -0,0 +1,90 @@
+"""
+Compare how many PDUs per second can be read from a socket by smpplib's
+read_pdu(), which makes two recv() calls per PDU, and by PduReader, which
+reads everything available into one buffer and splits it into PDUs.
+
+Usage: PYTHONPATH=src python benchmarks/pdu_reader.py [--pdus N]
+"""
+import argparse
+import socket
+import threading
+import time
+
+import smpplib.client
+import smpplib.smpp
+
+from smpp_gateway.pdu_reader import PduReader
+
+
+def make_client(sock=None) -> smpplib.client.Client:
+    client = smpplib.client.Client("localhost", 2775)
+    if client._socket is not None:
+        client._socket.close()
+    client._socket = sock
+    return client
+
+
+def make_stream(count: int) -> bytes:
+    client = make_client()
+    raw_pdus = []
+    for sequence in range(1, count + 1):
+        pdu = smpplib.smpp.make_pdu(
+            "submit_sm_resp", client=client, message_id=f"{sequence:016x}"
+        )
+        pdu.sequence = sequence
+        raw_pdus.append(pdu.generate())
+    return b"".join(raw_pdus)
+
+
+def send_stream(sock: socket.socket, stream: bytes):
+    sock.sendall(stream)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def read_with_smpplib(sock: socket.socket, count: int):
+    client = make_client(sock)
+    for _ in range(count):
+        client.read_pdu()
+    client._socket = None
+
+
+def read_with_pdu_reader(sock: socket.socket, count: int):
+    client = make_client()
+    reader = PduReader()
+    for _ in range(count):
+        raw_pdu = reader.next_pdu()
+        while raw_pdu is None:
+            reader.read_from(sock)
+            raw_pdu = reader.next_pdu()
+        smpplib.smpp.parse_pdu(raw_pdu, client=client)
+
+
+def run(read, stream: bytes, count: int) -> float:
+    reader_socket, writer_socket = socket.socketpair()
+    sender = threading.Thread(target=send_stream, args=(writer_socket, stream))
+    start = time.perf_counter()
+    sender.start()
+    read(reader_socket, count)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    reader_socket.close()
+    writer_socket.close()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pdus", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    stream = make_stream(args.pdus)
+    for name, read in [
+        ("smpplib read_pdu", read_with_smpplib),
+        ("PduReader", read_with_pdu_reader),
+    ]:
+        rate = max(run(read, stream, args.pdus) for _ in range(args.repeat))
+        print(f"{name:>16}: {rate:,.0f} PDUs/s")
+
+
+if __name__ == "__main__":
+    main()
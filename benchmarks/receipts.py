@@ -0,0 +1,75 @@
+"""
+Compare how many delivery receipts per second can be parsed by
+parse_delivery_receipt(), which searches for each field with a precompiled
+pattern, and by splitting the text into key:value pairs.
+
+Usage: PYTHONPATH=src python benchmarks/receipts.py [--receipts N]
+"""
+import argparse
+import pathlib
+import time
+
+from smpp_gateway.receipts import (
+    FINAL_STATES,
+    INTERMEDIATE_STATES,
+    DeliveryReceipt,
+    parse_delivery_receipt,
+    parse_done_date,
+)
+
+CORPUS = pathlib.Path(__file__).with_name("receipts.txt")
+KEYS = (b"id", b"sub", b"dlvrd", b"submit date", b"done date", b"stat", b"err", b"text")
+
+
+def parse_by_splitting(text: bytes):
+    """Split the text before each known key, stopping at the "text" field."""
+    fields = {}
+    lower = text.lower()
+    starts = sorted(
+        (index, key)
+        for key in KEYS
+        for index in [lower.find(key + b":")]
+        if index >= 0 and (index == 0 or lower[index - 1 : index] == b" ")
+    )
+    for (index, key), (next_index, _) in zip(starts, starts[1:] + [(len(text), None)]):
+        fields[key] = text[index + len(key) + 1 : next_index].strip()
+        if key == b"text":
+            break
+    state = fields.get(b"stat", b"").decode().upper()
+    if state not in FINAL_STATES and state not in INTERMEDIATE_STATES:
+        return None
+    err = fields.get(b"err")
+    done_date = fields.get(b"done date")
+    return DeliveryReceipt(
+        state,
+        int(err) if err and err.isdigit() else None,
+        parse_done_date(done_date) if done_date else None,
+    )
+
+
+def run(parse, receipts: list[bytes]) -> float:
+    start = time.perf_counter()
+    for receipt in receipts:
+        parse(receipt)
+    return len(receipts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    corpus = CORPUS.read_bytes().splitlines()
+    receipts = (corpus * (args.receipts // len(corpus) + 1))[: args.receipts]
+    for text in corpus:
+        assert parse_delivery_receipt(text) == parse_by_splitting(text), text
+    for name, parse in [
+        ("splitting", parse_by_splitting),
+        ("parse_delivery_receipt", parse_delivery_receipt),
+    ]:
+        rate = max(run(parse, receipts) for _ in range(args.repeat))
+        print(f"{name:>22}: {rate:,.0f} receipts/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -61,6 +61,7 @@ class MTMessageAdmin(admin.ModelAdmin):
         "backend",
         "priority_flag",
         "status",
+        "attempt_count",
         "create_time",
     )
     list_filter = (
@@ -73,6 +74,12 @@ class MTMessageAdmin(admin.ModelAdmin):
     ordering = ("-create_time",)
     inlines = (MTMessageStatusInline,)
 
+    def save_model(self, request, obj, form, change):
+        # Keep the encoded parts in step with an edited message
+        if "short_message" in form.changed_data and obj.encoded_parts is not None:
+            obj.encode()
+        super().save_model(request, obj, form, change)
+
 
 class MTMessageStatusCommandStatusListFilter(MTMessageCommandStatusListFilter):
     path_to_parameter = "command_status"
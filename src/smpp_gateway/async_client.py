@@ -0,0 +1,332 @@
+import asyncio
+import logging
+import struct
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import smpplib.consts
+import smpplib.exceptions
+import smpplib.smpp
+
+from django.db import connections
+from smpplib.command import Command, DeliverSM
+
+from smpp_gateway.client import PgSmppClient, PgSmppSequenceGenerator
+from smpp_gateway.pdu_reader import HEADER_LENGTH, MAX_PDU_LENGTH
+from smpp_gateway.utils import decoded_params
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPgSmppClient(PgSmppClient):
+    """
+    PgSmppClient driven by an asyncio event loop instead of select(). Once
+    bound, reading PDUs, writing PDUs, saving to the DB, sending MT messages
+    and sending enquire_link PDUs run as separate tasks. DB queries run one
+    at a time in a separate thread, so they never hold up the socket.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._write_queue = None
+        # DeliverSM PDUs for MO messages not yet saved or acknowledged
+        self._mo_pdus: list[DeliverSM] = []
+
+    # ############### Handlers ################
+
+    def _message_received(self, pdu: DeliverSM):
+        """Called by handle_pdu(). MO messages are saved by the persist() task,
+        which also acknowledges them.
+        """
+        if decoded_params(pdu).get("receipted_message_id"):
+            super()._message_received(pdu)
+        else:
+            self.counters["deliver_sm_mo"] += 1
+            self._mo_pdus.append(pdu)
+            self._persist_event.set()
+
+    def handle_pdu(self, pdu: Command):
+        super().handle_pdu(pdu)
+        if pdu.command in ("submit_sm_resp", "generic_nack"):
+            self._window_event.set()
+        elif pdu.command == "unbind_resp":
+            self._unbound_event.set()
+
+    def flush_due_buffers(self):
+        """Wake up the persist() task rather than saving from the event loop,
+        if a buffer is due sooner than it was going to wake up, e.g. because
+        the buffer was empty until now.
+        """
+        timeout = self.time_until_flush()
+        if timeout is not None and time.monotonic() + timeout < self._persist_wake_time:
+            self._persist_event.set()
+
+    # ############### Transport ################
+
+    def send_pdu(self, p: Command):
+        """Queue a PDU for the write_pdus() task once the event loop is
+        running, or send it straight away (e.g. while binding) otherwise.
+        """
+        if self._write_queue is None:
+            return super().send_pdu(p)
+        if self.state not in smpplib.consts.COMMAND_STATES[p.command]:
+            raise smpplib.exceptions.PDUError(
+                "Command %s failed: %s"
+                % (
+                    p.command,
+                    smpplib.consts.DESCRIPTIONS[smpplib.consts.SMPP_ESME_RINVBNDSTS],
+                )
+            )
+        self.logger.debug("Queueing %s PDU", p.command)
+        self._write_queue.put_nowait(p.generate())
+        return True
+
+    async def read_pdus(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                raw_len = await reader.readexactly(4)
+                length = struct.unpack(">L", raw_len)[0]
+                if length < HEADER_LENGTH or length > MAX_PDU_LENGTH:
+                    raise smpplib.exceptions.PDUError("Broken PDU")
+                raw_pdu = raw_len + await reader.readexactly(length - 4)
+            except asyncio.IncompleteReadError:
+                raise smpplib.exceptions.ConnectionError()
+            pdu = smpplib.smpp.parse_pdu(
+                raw_pdu,
+                client=self,
+                allow_unknown_opt_params=self.allow_unknown_opt_params,
+            )
+            self.logger.debug("Read %s PDU", pdu.command)
+            if not pdu.is_error() and pdu.command in smpplib.consts.STATE_SETTERS:
+                self.state = smpplib.consts.STATE_SETTERS[pdu.command]
+            self.handle_pdu(pdu)
+            if self.hc_worker:
+                self.hc_worker.success_ping()
+
+    async def write_pdus(self, writer: asyncio.StreamWriter):
+        while True:
+            writer.write(await self._write_queue.get())
+            if self._write_queue.empty():
+                await writer.drain()
+
+    # ############### DB persistence ################
+
+    def run_db(self, func, *args):
+        """Run `func` in the DB thread."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._db_executor, func, *args)
+
+    async def persist(self):
+        while True:
+            timeout = self.time_until_flush()
+            self._persist_wake_time = (
+                float("inf") if timeout is None else time.monotonic() + timeout
+            )
+            try:
+                await asyncio.wait_for(self._persist_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._persist_event.clear()
+            await self.flush_buffers_async()
+
+    async def flush_buffers_async(self, force: bool = False):
+        """Save MO messages and any due (or, if `force` is set, all)
+        submit_sm_resps and delivery receipts in the DB thread, then
+        acknowledge the PDUs that require it.
+        """
+        receipts = []
+        if force or self.receipt_buffer.is_due():
+            receipts = self.receipt_buffer.drain()
+        resps = []
+        if force or receipts or self.resp_buffer.is_due():
+            resps = self.drain_submit_sm_resps()
+        mo_pdus, self._mo_pdus = self._mo_pdus, []
+        if not (resps or receipts or mo_pdus or self.pending_receipts.is_due()):
+            return
+        await self.run_db(self._save_buffers, resps, receipts, mo_pdus)
+        self.ack_delivery_receipts(receipts)
+        for pdu in mo_pdus:
+            self.send_deliver_sm_resp(pdu)
+
+    def _save_buffers(self, resps, receipts, mo_pdus):
+        # In this order, so that receipts find their message_id
+        self._save_submit_sm_resps(resps)
+        if receipts:
+            self._save_delivery_receipts(receipts)
+        for pdu in mo_pdus:
+            self.message_received_handler(pdu)
+        if self.pending_receipts.is_due():
+            self.retry_pending_receipts()
+
+    async def reserve_sequences(self, count: int = 1):
+        """Make sure `count` sequence numbers are reserved before making PDUs
+        in the event loop, since Django connections can't be used there.
+        """
+        generator = self.sequence_generator
+        if not isinstance(generator, PgSmppSequenceGenerator):
+            return
+        while generator.available < count:
+            await self.run_db(generator.reserve_block)
+
+    # ############### Send MT Messages ################
+
+    async def send_mt_messages_async(self) -> int:
+        if not self.send_mt:
+            return 0
+        await self.run_db(self.reclaim_expired_claims)
+        limit = self.mt_messages_per_second * self.event_loop_timeout
+        smses = await self.run_db(self.fetch_mt_messages, limit)
+        batch = []
+        for sms in smses:
+            parts, data_coding, esm_class = self.get_parts(sms)
+            await self.reserve_sequences(len(parts))
+            pdus = self.make_submit_sm_kwargs(sms, parts, data_coding, esm_class)
+            batch.append((sms["id"], pdus))
+        self.start_batch(batch)
+        await self.run_db(self.write_statuses, batch)
+        for mt_message_id, pdus in batch:
+            for kwargs in pdus:
+                await self.wait_for_window_async()
+                await self.wait_for_token_async()
+                self.send_submit_sm(**kwargs)
+                self.batch_unsent_sequences.discard(kwargs["sequence"])
+            self.batch_unsent.discard(mt_message_id)
+        self.start_batch([])
+        return len(smses)
+
+    async def wait_for_window_async(self):
+        while len(self.in_flight) >= self.window_size:
+            self.expire_in_flight()
+            if len(self.in_flight) < self.window_size:
+                break
+            self._window_event.clear()
+            oldest = next(iter(self.in_flight.values()))
+            timeout = max(oldest + self.timeout - time.monotonic(), 0)
+            try:
+                await asyncio.wait_for(self._window_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_for_token_async(self):
+        while not self.rate_limiter.consume():
+            await asyncio.sleep(self.rate_limiter.time_until_available())
+
+    async def send_mt_loop(self):
+        """Send batches of MT messages until the exit event is set, which is
+        only checked between batches so a batch is never left half sent.
+        """
+        while not self._exit_event.is_set():
+            self.fetched_ids.clear()
+            # Keep going while there are messages to send
+            while await self.send_mt_messages_async():
+                if self._exit_event.is_set():
+                    return
+            try:
+                await asyncio.wait_for(self._mt_event.wait(), self.queue_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._mt_event.clear()
+
+    def receive_pg_notify(self):
+        if self.drain_pg_notifies():
+            self._mt_event.set()
+
+    # ############### Main loop ################
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(self.enquire_link_interval)
+            await self.reserve_sequences()
+            self.send_pdu(smpplib.smpp.make_pdu("enquire_link", client=self))
+            if self.hc_worker:
+                self.hc_worker.success_ping()
+
+    async def wait_for_exit_signal(self):
+        while not self.exit_signal_received():
+            await asyncio.sleep(0.5)
+            self.log_counters()
+            self.log_timings()
+        self.logger.info("Got exit signal, leaving listen loop")
+
+    def listen(self, ignore_error_codes=None, auto_send_enquire_link=True):
+        if isinstance(self.sequence_generator, PgSmppSequenceGenerator):
+            # Later blocks are reserved in the DB thread by reserve_sequences()
+            self.sequence_generator.reserve_block()
+        asyncio.run(self.listen_async())
+
+    async def listen_async(self):
+        self.logger.info("Entering asyncio main loop")
+        loop = asyncio.get_running_loop()
+        self._db_executor = ThreadPoolExecutor(1, thread_name_prefix="smpp_gateway_db")
+        self._write_queue = asyncio.Queue()
+        self._persist_event = asyncio.Event()
+        # When persist() will next wake up by itself
+        self._persist_wake_time = float("inf")
+        self._window_event = asyncio.Event()
+        self._mt_event = asyncio.Event()
+        self._unbound_event = asyncio.Event()
+        self._exit_event = asyncio.Event()
+        # The stream reader below only sees data read from the socket after
+        # it is created
+        self.read_buffered()
+        reader, writer = await asyncio.open_connection(sock=self._socket)
+        loop.add_reader(self._pg_conn, self.receive_pg_notify)
+        io_tasks = [
+            asyncio.create_task(self.read_pdus(reader)),
+            asyncio.create_task(self.write_pdus(writer)),
+            asyncio.create_task(self.persist()),
+        ]
+        send_task = asyncio.create_task(self.send_mt_loop())
+        tasks = [
+            send_task,
+            asyncio.create_task(self.keepalive()),
+            asyncio.create_task(self.wait_for_exit_signal()),
+        ]
+        try:
+            done, _ = await asyncio.wait(
+                io_tasks + tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                # Raise any exception, e.g. if the connection was lost
+                task.result()
+            # Let the batch being sent finish, so no messages are left SENDING,
+            # while the I/O tasks keep reading responses
+            self._exit_event.set()
+            self._mt_event.set()
+            done, _ = await asyncio.wait(
+                [send_task] + io_tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+            for task in tasks:
+                task.cancel()
+            await self.flush_buffers_async(force=True)
+            await self.unbind_async()
+        finally:
+            loop.remove_reader(self._pg_conn)
+            for task in io_tasks + tasks:
+                task.cancel()
+            writer.close()
+            self._socket = None
+            self.state = smpplib.consts.SMPP_CLIENT_STATE_CLOSED
+            self._write_queue = None
+            await self.run_db(connections.close_all)
+            self.log_counters(force=True)
+            self.log_timings(force=True)
+            self._db_executor.shutdown()
+
+    def reconcile_in_flight(self):
+        # MO messages not saved yet weren't acknowledged either, so the MC
+        # will deliver them again
+        self._mo_pdus = []
+        super().reconcile_in_flight()
+
+    async def unbind_async(self):
+        self.logger.info("Unbinding...")
+        await self.reserve_sequences()
+        self.send_pdu(smpplib.smpp.make_pdu("unbind", client=self))
+        try:
+            await asyncio.wait_for(self._unbound_event.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning("No unbind_resp received")
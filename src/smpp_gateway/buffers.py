@@ -0,0 +1,115 @@
+import time
+
+from typing import Any, Optional
+
+
+class BatchBuffer:
+    """
+    Accumulates items to be written to the DB in a single statement. The
+    buffer is due to be flushed once it holds `max_size` items, or once the
+    oldest item has waited `max_delay` seconds.
+    """
+
+    def __init__(self, max_size: int, max_delay: float, clock=time.monotonic):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.clock = clock
+        self.items: list[Any] = []
+        self.first_item_time = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, item):
+        if not self.items:
+            self.first_item_time = self.clock()
+        self.items.append(item)
+
+    def time_until_due(self) -> Optional[float]:
+        """Seconds until the buffer is due to be flushed, or None if empty."""
+        if not self.items:
+            return None
+        if len(self.items) >= self.max_size:
+            return 0
+        return max(self.first_item_time + self.max_delay - self.clock(), 0)
+
+    def is_due(self) -> bool:
+        return self.time_until_due() == 0
+
+    def drain(self) -> list[Any]:
+        """Empty the buffer, returning its contents."""
+        items, self.items = self.items, []
+        self.first_item_time = None
+        return items
+
+
+class PendingReceiptBuffer:
+    """
+    Holds delivery receipts that arrived before the MTMessageStatus they refer
+    to had its message_id saved, so they can be matched again once it has.
+    Receipts are kept for at most `ttl` seconds, and at most `max_size` of
+    them are kept, dropping the oldest. A `max_size` of 0 keeps none. Held
+    receipts are due to be matched again every `retry_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        retry_interval: float = 1,
+        clock=time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.clock = clock
+        # Receipts mapped to the time they expire, oldest first
+        self.items: dict[Any, float] = {}
+        self.retry_time = None
+        self.expired = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, receipts: list, expires: Optional[list[float]] = None):
+        """Hold `receipts` until they expire `ttl` seconds from now or at the
+        given `expires` times, e.g. those returned by drain().
+        """
+        if expires is None:
+            expires = [self.clock() + self.ttl] * len(receipts)
+        if self.retry_time is None:
+            self.retry_time = self.clock() + self.retry_interval
+        for receipt, expire_time in zip(receipts, expires):
+            self.items[receipt] = expire_time
+        while len(self.items) > self.max_size:
+            del self.items[next(iter(self.items))]
+            self.dropped += 1
+
+    def time_until_due(self) -> Optional[float]:
+        """Seconds until the held receipts are due to be matched again, or
+        None if there are none.
+        """
+        if not self.items:
+            return None
+        return max(self.retry_time - self.clock(), 0)
+
+    def is_due(self) -> bool:
+        return self.time_until_due() == 0
+
+    def expire(self) -> list[Any]:
+        """Remove and return the receipts held for longer than `ttl`."""
+        now = self.clock()
+        expired = [receipt for receipt, due in self.items.items() if due <= now]
+        for receipt in expired:
+            del self.items[receipt]
+        self.expired += len(expired)
+        if not self.items:
+            self.retry_time = None
+        return expired
+
+    def drain(self) -> tuple[list[Any], list[float]]:
+        """Empty the buffer, returning the receipts and their expiry times."""
+        items, self.items = self.items, {}
+        self.retry_time = None
+        return list(items), list(items.values())
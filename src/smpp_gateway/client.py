@@ -1,35 +1,74 @@
+import collections
 import logging
 import select
 import socket
+import time
+
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
 
 import smpplib
 import smpplib.client
 import smpplib.consts
 import smpplib.exceptions
-import smpplib.gsm
 
+from django.db import connection
 from django.utils import timezone
 from rapidsms.models import Backend
 from smpplib.command import Command, DeliverSM, SubmitSMResp
 
+from smpp_gateway.buffers import BatchBuffer, PendingReceiptBuffer
+from smpp_gateway.encoding import SegmentCache
+from smpp_gateway.metrics import PhaseTimers, format_histograms
 from smpp_gateway.models import MOMessage, MTMessage, MTMessageStatus
 from smpp_gateway.monitoring import HealthchecksIoWorker
-from smpp_gateway.queries import get_mt_messages_to_send, pg_listen, pg_notify
+from smpp_gateway.pdu_reader import PduReader
+from smpp_gateway.queries import (
+    get_mt_messages_to_send,
+    match_delivery_receipts,
+    parse_mt_notify_payload,
+    pg_listen,
+    pg_notify,
+    reclaim_expired_mt_messages,
+    requeue_mt_messages,
+    save_submit_sm_resps,
+    schedule_mt_message_retries,
+    write_mt_message_statuses,
+)
+from smpp_gateway.retries import RetryPolicy
+from smpp_gateway.throttling import AimdRateController, TokenBucket
+from smpp_gateway.timers import Timers
 from smpp_gateway.utils import decoded_params, set_exit_signals
 
 logger = logging.getLogger(__name__)
 
+# submit_sm_resp statuses asking us to slow down
+THROTTLING_STATUSES = {
+    smpplib.consts.SMPP_ESME_RTHROTTLED,
+    smpplib.consts.SMPP_ESME_RMSGQFUL,
+}
+
 
 class PgSmppSequenceGenerator(smpplib.client.SimpleSequenceGenerator):
     """
     smpplib sequence generator that uses a Postgres sequence to persist
     sequence numbers across restarts and client instances. See:
     https://www.postgresql.org/docs/10/sql-createsequence.html
+
+    Each query reserves a block of `block_size` sequence numbers by calling
+    nextval() `block_size` times, and the numbers are then handed out from
+    memory. Because every number comes from nextval(), no two generators
+    can ever hand out the same one, whatever block sizes they use. Unused
+    numbers in a block are skipped when the client restarts.
     """
 
-    def __init__(self, conn, backend_name):
+    def __init__(self, conn, backend_name, block_size=1):
         self.conn = conn
         self.sequence_name = f"smpp_gateway_sequence_{backend_name}"
+        self.block_size = block_size
+        # Reserved sequence numbers not yet handed out
+        self._reserved = collections.deque()
+        self._last = None
         with conn.cursor() as curs:
             curs.execute(
                 f"""
@@ -40,19 +79,42 @@ class PgSmppSequenceGenerator(smpplib.client.SimpleSequenceGenerator):
                 """
             )
 
-    def _fetchone(self, query):
+    @property
+    def sequence(self):
+        "Current (last) value of the sequence."
+        if self._last is None and self._reserved:
+            # smpplib numbers some PDUs, such as enquire_link and unbind, with
+            # the current value, so answer without a query once a block is
+            # reserved, e.g. from the asyncio engine's event loop
+            self._last = self._reserved.popleft()
+        if self._last is not None:
+            return self._last
         with self.conn.cursor() as curs:
-            curs.execute(query)
+            curs.execute(f"SELECT last_value from {self.sequence_name}")
             return curs.fetchone()[0]
 
     @property
-    def sequence(self):
-        "Current (last) value of the sequence."
-        return self._fetchone(f"SELECT last_value from {self.sequence_name}")
+    def available(self) -> int:
+        "Number of reserved sequence numbers not yet handed out."
+        return len(self._reserved)
 
     def next_sequence(self):
-        "Increments and returns the next value of the sequence."
-        return self._fetchone(f"SELECT nextval('{self.sequence_name}')")
+        "Returns the next value of the sequence, reserving a new block if needed."
+        if not self._reserved:
+            self.reserve_block()
+        self._last = self._reserved.popleft()
+        return self._last
+
+    def reserve_block(self):
+        "Reserves another `block_size` sequence numbers in a single query."
+        with self.conn.cursor() as curs:
+            curs.execute(
+                f"""
+                SELECT nextval('{self.sequence_name}')
+                FROM generate_series(1, {self.block_size})
+                """
+            )
+            self._reserved.extend(row[0] for row in curs.fetchall())
 
 
 class PgSmppClient(smpplib.client.Client):
@@ -63,6 +125,11 @@ class PgSmppClient(smpplib.client.Client):
     https://gist.github.com/pkese/2790749
     """
 
+    # Seconds between logging the running totals in `counters`
+    COUNTERS_LOG_INTERVAL = 60
+    # Maximum seconds between looking for expired claims on MT messages
+    RECLAIM_INTERVAL = 60
+
     def __init__(
         self,
         notify_mo_channel: str,
@@ -73,9 +140,28 @@ class PgSmppClient(smpplib.client.Client):
         mt_messages_per_second: int,
         event_loop_timeout: int,
         *args,
+        window_size: int = 10,
+        mt_burst_size: int = 1,
+        dlr_batch_size: int = 100,
+        dlr_batch_delay: float = 0.1,
+        pending_receipt_max: int = 10000,
+        pending_receipt_ttl: float = 60,
+        resp_batch_size: int = 100,
+        resp_batch_delay: float = 0.1,
+        exit_signal_received: Optional[Callable[[], bool]] = None,
+        send_mt: bool = True,
+        adaptive_rate: bool = True,
+        retry_policy: Optional[RetryPolicy] = None,
+        lease_seconds: float = 300,
+        segment_cache_size: int = 1000,
+        enquire_link_interval: Optional[float] = None,
+        queue_poll_interval: Optional[float] = None,
+        stats_interval: float = 60,
         **kwargs,
     ):
-        self.exit_signal_received = set_exit_signals()
+        # Signal handlers can only be set from the main thread, so clients
+        # running in other threads are passed the main thread's instead
+        self.exit_signal_received = exit_signal_received or set_exit_signals()
         self.notify_mo_channel = notify_mo_channel
         self.backend = backend
         self.hc_worker = hc_worker
@@ -83,8 +169,113 @@ class PgSmppClient(smpplib.client.Client):
         self.set_priority_flag = set_priority_flag
         self.mt_messages_per_second = mt_messages_per_second
         self.event_loop_timeout = event_loop_timeout
+        # Seconds without reading a PDU after which an enquire_link is sent
+        self.enquire_link_interval = enquire_link_interval or event_loop_timeout
+        # Seconds between checks of the queue for MT messages that arrived
+        # without a notification, e.g. retries that have become due
+        self.queue_poll_interval = queue_poll_interval or event_loop_timeout
+        # Paces submit_sm PDUs at mt_messages_per_second
+        self.rate_limiter = TokenBucket(mt_messages_per_second, mt_burst_size)
+        # Slows the rate limiter down when the MC reports throttling errors
+        self.rate_controller = (
+            AimdRateController(self.rate_limiter, mt_messages_per_second)
+            if adaptive_rate
+            else None
+        )
+        # Seconds after which messages left SENDING are sent again, or 0
+        self.lease_seconds = lease_seconds
+        self.reclaimed_time = None
+        # Decides which failed messages to retry, and when
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Encoded and split texts of recently sent messages
+        self.segment_cache = SegmentCache(segment_cache_size)
+        # Maximum number of submit_sm PDUs awaiting a submit_sm_resp
+        self.window_size = window_size
+        # Sequence numbers of unacknowledged submit_sm PDUs, mapped to the
+        # (monotonic) time they were sent, oldest first
+        self.in_flight: dict[int, float] = {}
+        # IDs of the messages fetched in the current or last fetch cycle
+        self.fetched_ids: set[int] = set()
+        # Whether the last batch came back full, so there may be more to send
+        self.mt_backlog = False
+        # IDs of the messages in the batch being sent
+        self.batch_ids: list[int] = []
+        self.batch_unsent: set[int] = set()
+        self.batch_unsent_sequences: set[int] = set()
+        # (DeliverSM, params) tuples for delivery receipts not yet saved or
+        # acknowledged
+        self.receipt_buffer = BatchBuffer(dlr_batch_size, dlr_batch_delay)
+        # (sequence_number, command_status, message_id) tuples from
+        # submit_sm_resps not yet saved
+        self.resp_buffer = BatchBuffer(resp_batch_size, resp_batch_delay)
+        # (message_id, short_message, received_at) tuples for delivery
+        # receipts that arrived before their submit_sm_resp was saved
+        self.pending_receipts = PendingReceiptBuffer(
+            pending_receipt_max, pending_receipt_ttl
+        )
+        # Running totals of notable events, logged every COUNTERS_LOG_INTERVAL
+        self.counters = collections.Counter()
+        self.counters_logged_time = time.monotonic()
+        # How long each phase of the client's work takes, logged every
+        # stats_interval seconds (if not 0)
+        self.timings = PhaseTimers()
+        self.stats_interval = stats_interval
+        self.timings_logged_time = time.monotonic()
+        # Buffers data read from the socket until it makes up whole PDUs
+        self.pdu_reader = PduReader()
+        self.last_read_time = time.monotonic()
+        # False for clients bound as receivers, which can't send MT messages
+        self.send_mt = send_mt
         super().__init__(*args, **kwargs)
-        self._pg_conn = pg_listen(self.backend.name)
+        if send_mt:
+            self._pg_conn = pg_listen(self.backend.name)
+        else:
+            # Still waited on by the main loop, but never notified
+            connection.ensure_connection()
+            self._pg_conn = connection.connection
+
+    # ############### Reading PDUs ################
+
+    def connect(self):
+        self.pdu_reader.reset()
+        super().connect()
+
+    def read_pdu(self) -> Command:
+        """Return the next PDU from the MC, like smpplib's read_pdu(), but
+        parsed from a buffer that is only refilled from the socket once it
+        holds no complete PDU.
+        """
+        raw_pdu = self.pdu_reader.next_pdu()
+        while raw_pdu is None:
+            self.pdu_reader.read_from(self._socket)
+            raw_pdu = self.pdu_reader.next_pdu()
+        pdu = smpplib.smpp.parse_pdu(
+            raw_pdu,
+            client=self,
+            allow_unknown_opt_params=self.allow_unknown_opt_params,
+        )
+        self.logger.debug("Read %s PDU", pdu.command)
+        self.last_read_time = time.monotonic()
+        if not pdu.is_error() and pdu.command in smpplib.consts.STATE_SETTERS:
+            self.state = smpplib.consts.STATE_SETTERS[pdu.command]
+        return pdu
+
+    def read_available(self, ignore_error_codes=None, auto_send_enquire_link=True):
+        """Read from the socket once and handle every complete PDU read,
+        before going back to select().
+        """
+        with self.timings.time("read"):
+            self.read_once(ignore_error_codes, auto_send_enquire_link)
+            while self.pdu_reader.has_pdu():
+                self.read_once(ignore_error_codes, auto_send_enquire_link)
+
+    def read_buffered(self, ignore_error_codes=None, auto_send_enquire_link=True):
+        """Handle any PDUs read along with the bind_resp, such as receipts
+        the MC had queued, reading the rest of one read only in part. These
+        would otherwise wait for more data to arrive on the socket.
+        """
+        while len(self.pdu_reader):
+            self.read_once(ignore_error_codes, auto_send_enquire_link)
 
     # ############### Handlers ################
 
@@ -100,26 +291,95 @@ class PgSmppClient(smpplib.client.Client):
         """We received an update that an outbound message was delivered.
         Mark it as delivered.
         """
-        count = MTMessageStatus.objects.filter(
-            backend=self.backend,
-            message_id=params["receipted_message_id"],
-        ).update(
-            modify_time=timezone.now(),
-            delivery_report=pdu.short_message,
-        )
-        if count == 0:
+        self._save_delivery_receipts([(pdu, params, timezone.now())])
+
+    def _save_delivery_receipts(self, receipts: list[tuple[DeliverSM, dict, datetime]]):
+        pairs = [
+            (params["receipted_message_id"], pdu.short_message, received_at)
+            for pdu, params, received_at in receipts
+        ]
+        with self.timings.time("save_receipts"):
+            matched = match_delivery_receipts(self.backend, pairs)
+        unmatched = [pair for pair in pairs if pair[0] not in matched]
+        if unmatched:
+            # The submit_sm_resp may not have been saved yet
+            self.hold_pending_receipts(unmatched)
+            self.expire_pending_receipts()
+
+    def hold_pending_receipts(self, receipts: list[tuple], expires=None):
+        """Keep unmatched receipts until retry_pending_receipts() can match
+        them, counting any dropped to make room.
+        """
+        dropped = self.pending_receipts.dropped
+        self.pending_receipts.add(receipts, expires)
+        self.counters["receipt_dropped"] += self.pending_receipts.dropped - dropped
+
+    def expire_pending_receipts(self):
+        expired = self.pending_receipts.expire()
+        if expired:
+            self.counters["receipt_expired"] += len(expired)
             logger.warning(
-                f"Found no MTMessageStatus for backend={self.backend}, "
-                f"message_id={params['receipted_message_id']}. "
-                f"delivery_report={pdu.short_message}"
+                f"Found no MTMessageStatus for {len(expired)} delivery receipts "
+                f"for backend={self.backend} within "
+                f"{self.pending_receipts.ttl:g} seconds"
             )
-        count = MTMessage.objects.filter(
-            backend=self.backend,
-            mtmessagestatus__message_id=params["receipted_message_id"],
-        ).update(
-            modify_time=timezone.now(),
-            status=MTMessage.Status.DELIVERED,
+
+    def retry_pending_receipts(self):
+        """Try again to match delivery receipts that arrived before their
+        submit_sm_resp was saved.
+        """
+        self.expire_pending_receipts()
+        receipts, expires = self.pending_receipts.drain()
+        if not receipts:
+            return
+        with self.timings.time("save_receipts"):
+            matched = match_delivery_receipts(self.backend, receipts)
+        self.counters["receipt_matched_late"] += len(matched)
+        unmatched = [
+            i for i, receipt in enumerate(receipts) if receipt[0] not in matched
+        ]
+        if unmatched:
+            self.hold_pending_receipts(
+                [receipts[i] for i in unmatched], [expires[i] for i in unmatched]
+            )
+
+    def _message_received(self, pdu: DeliverSM):
+        """Called by smpplib base Client. Delivery receipts are buffered and
+        only acknowledged once flush_delivery_receipts() has saved them, so
+        the MC will redeliver any receipts lost before they were saved.
+        """
+        params = decoded_params(pdu)
+        if params.get("receipted_message_id"):
+            self.counters["deliver_sm_receipt"] += 1
+            self.receipt_buffer.append((pdu, params, timezone.now()))
+            self.flush_due_buffers()
+        else:
+            self.counters["deliver_sm_mo"] += 1
+            super()._message_received(pdu)
+
+    def flush_delivery_receipts(self):
+        """Save all buffered delivery receipts in one batch, then send a
+        deliver_sm_resp for each of them.
+        """
+        receipts = self.receipt_buffer.drain()
+        if not receipts:
+            return
+        # Receipts may refer to message_ids from buffered submit_sm_resps
+        self.flush_submit_sm_resps()
+        self._save_delivery_receipts(receipts)
+        self.ack_delivery_receipts(receipts)
+
+    def ack_delivery_receipts(self, receipts: list[tuple[DeliverSM, dict, datetime]]):
+        """Send a deliver_sm_resp for each saved delivery receipt."""
+        for pdu, *_ in receipts:
+            self.send_deliver_sm_resp(pdu)
+
+    def send_deliver_sm_resp(self, pdu: DeliverSM):
+        resp = smpplib.smpp.make_pdu(
+            "deliver_sm_resp", client=self, status=smpplib.consts.SMPP_ESME_ROK
         )
+        resp.sequence = pdu.sequence
+        self.send_pdu(resp)
 
     def _create_mo_message(self, pdu: DeliverSM, params):
         """We received a message. Insert into DB and notify the
@@ -138,20 +398,104 @@ class PgSmppClient(smpplib.client.Client):
 
     def message_sent_handler(self, pdu: SubmitSMResp):
         """Called by smpplib base Client."""
+        # Error responses are handled twice, but only in flight once
+        sent_time = self.in_flight.pop(pdu.sequence, None)
+        if sent_time is not None:
+            self.counters["submit_sm_resp"] += 1
+            self.adjust_rate(pdu.status)
         params = decoded_params(pdu)
-        count = MTMessageStatus.objects.filter(
-            backend=self.backend,
-            sequence_number=pdu.sequence,
-        ).update(
-            modify_time=timezone.now(),
-            command_status=pdu.status,
-            message_id=params["message_id"] or "",
+        self.buffer_submit_sm_resp(
+            pdu.sequence, pdu.status, params["message_id"] or "", sent_time
         )
-        if count == 0:
-            logger.warning(
-                f"Found no MTMessageStatus for {self.backend}, {pdu.sequence}. "
-                f"status={pdu.status}, message_id={params['message_id']}"
+
+    def buffer_submit_sm_resp(
+        self,
+        sequence: int,
+        command_status: int,
+        message_id: str,
+        sent_time: Optional[float],
+    ):
+        """Buffer the response to the submit_sm PDU sent at the monotonic
+        `sent_time` (None if no longer in flight), to be saved along with the
+        wall clock times it was sent and answered.
+        """
+        now = timezone.now()
+        submitted_at = None
+        if sent_time is not None:
+            submitted_at = now - timedelta(seconds=time.monotonic() - sent_time)
+        self.resp_buffer.append(
+            (sequence, command_status, message_id, now, submitted_at)
+        )
+        self.flush_due_buffers()
+
+    def adjust_rate(self, command_status: int):
+        if command_status in THROTTLING_STATUSES:
+            self.counters["submit_sm_throttled"] += 1
+        if self.rate_controller is None:
+            return
+        if command_status in THROTTLING_STATUSES:
+            if self.rate_controller.throttled():
+                logger.warning(
+                    f"Throttled by MC, reducing rate to "
+                    f"{self.rate_controller.rate:g}/s for backend={self.backend}"
+                )
+        elif command_status == smpplib.consts.SMPP_ESME_ROK:
+            if self.rate_controller.succeeded():
+                logger.info(
+                    f"Increasing rate to {self.rate_controller.rate:g}/s "
+                    f"for backend={self.backend}"
+                )
+
+    def flush_submit_sm_resps(self):
+        """Save all buffered submit_sm_resps to their MTMessageStatus objects
+        in one batch.
+        """
+        self._save_submit_sm_resps(self.drain_submit_sm_resps())
+
+    def drain_submit_sm_resps(
+        self,
+    ) -> list[tuple[int, int, str, datetime, Optional[datetime]]]:
+        # smpplib calls message_sent_handler() for error responses after our
+        # error_pdu_handler() has already done so, so keep the first one only,
+        # which knows when the PDU was sent
+        resps = {}
+        for resp in self.resp_buffer.drain():
+            resps.setdefault(resp[0], resp)
+        return list(resps.values())
+
+    def _save_submit_sm_resps(
+        self, resps: list[tuple[int, int, str, datetime, Optional[datetime]]]
+    ):
+        if not resps:
+            return
+        with self.timings.time("save_resps"):
+            count = save_submit_sm_resps(self.backend, resps)
+        if count < len(resps):
+            self.counters["submit_sm_resp_unmatched"] += len(resps) - count
+            logger.debug(
+                f"Found no MTMessageStatus for {len(resps) - count} of "
+                f"{len(resps)} submit_sm_resps for backend={self.backend}"
+            )
+        if count and self.pending_receipts:
+            self.retry_pending_receipts()
+        throttled = [resp[0] for resp in resps if resp[1] in THROTTLING_STATUSES]
+        if throttled:
+            count = requeue_mt_messages(self.backend, throttled)
+            logger.info(
+                f"Requeued {count} throttled messages for backend={self.backend}"
             )
+        failures = [
+            (sequence_number, command_status)
+            for sequence_number, command_status, *_ in resps
+            if command_status != smpplib.consts.SMPP_ESME_ROK
+            and command_status not in THROTTLING_STATUSES
+        ]
+        if failures:
+            retried, failed = schedule_mt_message_retries(
+                self.backend, failures, self.retry_policy
+            )
+            self.counters["mt_message_retried"] += retried
+            self.counters["mt_message_failed"] += failed
 
     def error_pdu_handler(self, pdu: Command):
         """Called by smpplib base Client when incoming PDU has status set to
@@ -160,6 +504,13 @@ class PgSmppClient(smpplib.client.Client):
         if pdu.command == "submit_sm_resp":
             # update MTMessageStatus record with the error
             self.message_sent_handler(pdu)
+        elif pdu.command == "generic_nack":
+            # The MC could not parse our PDU, so no submit_sm_resp will follow.
+            # Save the nack as a failed response, so the message is retried or
+            # failed rather than reclaimed and sent again indefinitely.
+            self.buffer_submit_sm_resp(
+                pdu.sequence, pdu.status, "", self.in_flight.pop(pdu.sequence, None)
+            )
         logger.warning(
             "({}) {}: {}".format(
                 pdu.status,
@@ -168,51 +519,286 @@ class PgSmppClient(smpplib.client.Client):
             ),
         )
 
+    def handle_pdu(self, pdu: Command):
+        """Act on a PDU read from the MC, like smpplib's read_once() does
+        after reading it.
+        """
+        if pdu.is_error():
+            self.error_pdu_handler(pdu)
+        if pdu.command == "unbind":
+            self.logger.info("Unbind command received")
+        elif pdu.command == "submit_sm_resp":
+            self.message_sent_handler(pdu=pdu)
+        elif pdu.command == "deliver_sm":
+            self._message_received(pdu)
+        elif pdu.command == "query_sm_resp":
+            self.query_resp_handler(pdu)
+        elif pdu.command == "enquire_link":
+            self._enquire_link_received(pdu)
+        elif pdu.command == "alert_notification":
+            self._alert_notification(pdu)
+        elif pdu.command not in ("enquire_link_resp", "unbind_resp"):
+            self.logger.warning(f'Unhandled SMPP command "{pdu.command}"')
+
     # ############### Listen for and send MT Messages ################
 
-    def receive_pg_notify(self):
+    def drain_pg_notifies(self) -> bool:
+        """Read every pending Postgres notification, returning whether any
+        of them calls for a fetch cycle. All of them are answered by a single
+        fetch cycle, so the ones beyond the first are counted as coalesced.
+        """
         self._pg_conn.poll()
-        if self._pg_conn.notifies:
-            notify = self._pg_conn.notifies.pop()
-            logger.info(f"Got NOTIFY:{notify}")
+        notifies = list(self._pg_conn.notifies)
+        if not notifies:
+            return False
+        logger.info(f"Got NOTIFY:{notifies[-1]} ({len(notifies)} pending)")
+        self._pg_conn.notifies.clear()
+        self.counters["pg_notify_coalesced"] += len(notifies) - 1
+        if self.needs_fetch(notifies):
+            return True
+        self.counters["pg_notify_skipped"] += len(notifies)
+        return False
+
+    def needs_fetch(self, notifies: list) -> bool:
+        """Whether `notifies` may announce messages that haven't been fetched.
+        Only notifications whose payload lists their message IDs can rule
+        that out; any other notification requires a fetch.
+        """
+        for notify in notifies:
+            payload = parse_mt_notify_payload(notify.payload)
+            if payload is None or "ids" not in payload:
+                return True
+            if not self.fetched_ids.issuperset(payload["ids"]):
+                return True
+        return False
+
+    def receive_pg_notify(self):
+        if self.drain_pg_notifies():
             self.send_mt_messages()
 
     def send_mt_messages(self):
+        """Send a batch of MT messages. If it comes back full, `mt_backlog` is
+        set and the main loop sends the next batch as soon as it has handled
+        incoming PDUs, timers and health checks, so a backlog is sent at the
+        full rate rather than one batch per `queue_poll_interval`.
+        """
+        if not self.send_mt:
+            return
+        if not self.mt_backlog:
+            self.fetched_ids.clear()
+        self.reclaim_expired_claims()
         limit = self.mt_messages_per_second * self.event_loop_timeout
-        smses = get_mt_messages_to_send(limit=limit, backend=self.backend)
-        if len(smses) == 0:
+        self.mt_backlog = self.send_mt_batch(limit) == limit
+
+    def send_mt_batch(self, limit: int) -> int:
+        """Fetch and send up to `limit` MT messages, returning the number
+        fetched.
+        """
+        smses = self.fetch_mt_messages(limit)
+        batch = [(sms["id"], self.prepare_mt_message(sms)) for sms in smses]
+        self.start_batch(batch)
+        self.write_statuses(batch)
+        for mt_message_id, pdus in batch:
+            for kwargs in pdus:
+                self.send_message(**kwargs)
+                self.batch_unsent_sequences.discard(kwargs["sequence"])
+            self.batch_unsent.discard(mt_message_id)
+        self.start_batch([])
+        return len(smses)
+
+    def start_batch(self, batch: list[tuple[int, list[dict[str, Any]]]]):
+        """Keep track of the batch being sent, as `(mt_message_id, pdus)`
+        pairs, in case the connection drops before it has been sent in full.
+        """
+        self.batch_ids = [mt_message_id for mt_message_id, _ in batch]
+        # Messages with parts not sent yet, and the sequence numbers of
+        # those parts
+        self.batch_unsent = set(self.batch_ids)
+        self.batch_unsent_sequences = {
+            kwargs["sequence"] for _, pdus in batch for kwargs in pdus
+        }
+
+    def reclaim_expired_claims(self):
+        """Return messages left SENDING for longer than `lease_seconds` to the
+        queue, at most once every RECLAIM_INTERVAL seconds (or half the lease,
+        if shorter).
+        """
+        if not self.lease_seconds:
             return
-        logger.info(
-            f"Found {len(smses)} messages to send in {self.event_loop_timeout} seconds"
-        )
-        submit_sm_resps = []
-        for sms in smses:
-            params = {**self.submit_sm_params, **sms["params"]}
-            if self.set_priority_flag and sms["priority_flag"] is not None:
-                params["priority_flag"] = sms["priority_flag"]
-            pdus = self.split_and_send_message(sms["short_message"], **params)
-            # Create placeholder MTMessageStatus objects in the DB, which
-            # the message_sent handler will later update with the actual command_status
-            # and message_id (and eventually maybe a delivery report).
-            now = timezone.now()
-            submit_sm_resps.extend(
-                [
-                    MTMessageStatus(
-                        create_time=now,
-                        modify_time=now,
-                        mt_message_id=sms["id"],
-                        backend=self.backend,
-                        sequence_number=pdu.sequence,
-                    )
-                    for pdu in pdus
-                ]
+        now = time.monotonic()
+        interval = min(self.RECLAIM_INTERVAL, self.lease_seconds / 2)
+        if self.reclaimed_time is not None and now < self.reclaimed_time + interval:
+            return
+        self.reclaimed_time = now
+        count = reclaim_expired_mt_messages(self.backend, self.lease_seconds)
+        if count:
+            self.counters["mt_message_reclaimed"] += count
+            logger.warning(
+                f"Returned {count} messages left sending for over "
+                f"{self.lease_seconds:g} seconds to the queue for backend={self.backend}"
             )
-        pks = [sms["id"] for sms in smses]
-        MTMessage.objects.filter(pk__in=pks).update(
-            status=MTMessage.Status.SENT,
-            modify_time=timezone.now(),
-        )
-        MTMessageStatus.objects.bulk_create(submit_sm_resps)
+
+    def fetch_mt_messages(self, limit: int) -> list[dict[str, Any]]:
+        """Fetch up to `limit` messages to send, marking them as SENDING."""
+        with self.timings.time("fetch"):
+            smses = get_mt_messages_to_send(limit=limit, backend=self.backend)
+        self.fetched_ids.update(sms["id"] for sms in smses)
+        if smses:
+            logger.info(
+                f"Found {len(smses)} messages to send in {self.event_loop_timeout} seconds"
+            )
+        return smses
+
+    def get_submit_sm_params(self, sms: dict[str, Any]) -> dict[str, Any]:
+        params = {**self.submit_sm_params, **sms["params"]}
+        if self.set_priority_flag and sms["priority_flag"] is not None:
+            params["priority_flag"] = sms["priority_flag"]
+        return params
+
+    def get_parts(self, sms: dict[str, Any]) -> tuple[list[bytes], int, int]:
+        """Return the parts, data_coding and esm_class to send `sms` with,
+        encoding it unless it was encoded when it was queued.
+        """
+        if sms.get("encoded_parts") is None:
+            with self.timings.time("encode"):
+                return self.make_parts(sms["short_message"])
+        parts = [bytes(part) for part in sms["encoded_parts"]]
+        if sms["esm_class"] & smpplib.consts.SMPP_GSMFEAT_UDHI:
+            # Each attempt gets its own concatenation reference, like cached parts
+            parts = self.segment_cache.new_reference(parts)
+        return parts, sms["data_coding"], sms["esm_class"]
+
+    def make_parts(self, message: str) -> tuple[list[bytes], int, int]:
+        """Encode and split `message`, returning the parts, data_coding and
+        esm_class.
+        """
+        return self.segment_cache.make_parts(message)
+
+    def prepare_mt_message(self, sms: dict[str, Any]) -> list[dict[str, Any]]:
+        """Return the keyword arguments for the submit_sm PDU of each part of
+        `sms`, including the sequence number it will be sent with.
+        """
+        return self.make_submit_sm_kwargs(sms, *self.get_parts(sms))
+
+    def make_submit_sm_kwargs(
+        self, sms: dict[str, Any], parts: list[bytes], data_coding: int, esm_class: int
+    ) -> list[dict[str, Any]]:
+        params = self.get_submit_sm_params(sms)
+        return [
+            {
+                "short_message": short_message,
+                "data_coding": data_coding,
+                "esm_class": esm_class,
+                "sequence": self.next_sequence(),
+                **params,
+            }
+            for short_message in parts
+        ]
+
+    def write_statuses(self, batch: list[tuple[int, list[dict[str, Any]]]]):
+        """Create a placeholder MTMessageStatus object for each PDU of the
+        batch, which the message_sent handler will later update with the
+        actual command_status and message_id (and eventually maybe a delivery
+        report), and mark the batch as SENT, before sending any of it. That
+        way, no submit_sm_resp can arrive before its MTMessageStatus exists.
+        """
+        sequence_numbers = [
+            (mt_message_id, kwargs["sequence"])
+            for mt_message_id, pdus in batch
+            for kwargs in pdus
+        ]
+        if sequence_numbers:
+            with self.timings.time("save_statuses"):
+                write_mt_message_statuses(self.backend, sequence_numbers)
+
+    def send_message(self, **kwargs):
+        """Send a submit_sm PDU once there is room for it in the window and
+        the rate limit allows it.
+        """
+        self.wait_for_window()
+        self.wait_for_token()
+        return self.send_submit_sm(**kwargs)
+
+    def send_submit_sm(self, **kwargs):
+        """Send a submit_sm PDU right away and track it as in flight."""
+        with self.timings.time("submit_sm"):
+            pdu = super().send_message(**kwargs)
+        self.counters["submit_sm_sent"] += 1
+        self.in_flight[pdu.sequence] = time.monotonic()
+        return pdu
+
+    def wait_for_window(self):
+        """Block until fewer than `window_size` submit_sm PDUs are awaiting a
+        response, reading incoming PDUs and Postgres notifications in the
+        meantime.
+        """
+        while len(self.in_flight) >= self.window_size:
+            self.expire_in_flight()
+            if len(self.in_flight) < self.window_size:
+                break
+            oldest = next(iter(self.in_flight.values()))
+            self.service_io(max(oldest + self.timeout - time.monotonic(), 0))
+
+    def wait_for_token(self):
+        """Block until the rate limiter allows another submit_sm PDU, reading
+        incoming PDUs and Postgres notifications in the meantime.
+        """
+        while not self.rate_limiter.consume():
+            self.service_io(self.rate_limiter.time_until_available())
+
+    def service_io(self, timeout: float):
+        """Wait up to `timeout` seconds for incoming PDUs or Postgres
+        notifications, and handle them without sending more MT messages.
+        Notifications are left in `self._pg_conn.notifies` for the main loop.
+        """
+        with self.timings.time("select"):
+            rlist, _, _ = select.select([self._socket, self._pg_conn], [], [], timeout)
+        if self._socket in rlist:
+            self.read_available()
+        if self._pg_conn in rlist:
+            self._pg_conn.poll()
+        self.flush_due_buffers()
+
+    def flush_due_buffers(self):
+        if self.resp_buffer.is_due():
+            self.flush_submit_sm_resps()
+        if self.receipt_buffer.is_due():
+            self.flush_delivery_receipts()
+        if self.pending_receipts.is_due():
+            # Their submit_sm_resps may have been saved by another session,
+            # e.g. the transmitter when binding as a separate receiver
+            self.retry_pending_receipts()
+
+    def flush_all_buffers(self):
+        # Also flushes submit_sm_resps
+        self.flush_delivery_receipts()
+        self.flush_submit_sm_resps()
+
+    def time_until_flush(self) -> Optional[float]:
+        """Seconds until the next buffer is due to be flushed, or None if
+        all are empty.
+        """
+        timeouts = [
+            timeout
+            for timeout in (
+                self.resp_buffer.time_until_due(),
+                self.receipt_buffer.time_until_due(),
+                self.pending_receipts.time_until_due(),
+            )
+            if timeout is not None
+        ]
+        return min(timeouts, default=None)
+
+    def expire_in_flight(self):
+        """Forget about submit_sm PDUs that have been awaiting a response for
+        longer than the socket timeout, so they no longer occupy the window.
+        """
+        expire_before = time.monotonic() - self.timeout
+        for sequence, sent_time in list(self.in_flight.items()):
+            if sent_time > expire_before:
+                break
+            logger.warning(f"No submit_sm_resp for sequence {sequence}, giving up")
+            del self.in_flight[sequence]
 
     def split_and_send_message(self, message, **kwargs):
         """
@@ -221,7 +807,7 @@ class PgSmppClient(smpplib.client.Client):
         by python-smpplib.
         """
         # Two parts, UCS2, SMS with UDH
-        parts, data_coding, esm_class = smpplib.gsm.make_parts(message)
+        parts, data_coding, esm_class = self.make_parts(message)
         return [
             self.send_message(
                 short_message=short_message,
@@ -236,34 +822,153 @@ class PgSmppClient(smpplib.client.Client):
 
     def listen(self, ignore_error_codes=None, auto_send_enquire_link=True):
         self.logger.info("Entering main listen loop")
+        try:
+            self._listen(ignore_error_codes, auto_send_enquire_link)
+        finally:
+            # Save buffered DB writes however the loop ended. The writes happen
+            # before any deliver_sm_resp is sent, so they are kept even if the
+            # connection is already gone.
+            try:
+                self.flush_all_buffers()
+            except Exception:
+                self.logger.exception("Failed to flush buffers on exit")
+            self.log_counters(force=True)
+            self.log_timings(force=True)
+        self.safe_disconnect()
+
+    def _listen(self, ignore_error_codes, auto_send_enquire_link):
+        timers = Timers()
+        self.last_read_time = time.monotonic()
+        timers.add(
+            self.enquire_link_interval,
+            lambda: self.keep_alive(auto_send_enquire_link),
+        )
+        if self.send_mt:
+            timers.add(self.queue_poll_interval, self.send_mt_messages)
+        self.read_buffered(ignore_error_codes, auto_send_enquire_link)
         # Look for and send messages on start up
         self.send_mt_messages()
         while True:
+            if self._pg_conn.notifies:
+                # Notifications received while a batch was being sent
+                self.receive_pg_notify()
+            timeout = timers.time_until_next()
+            if self.mt_backlog:
+                timeout = 0
+            flush_timeout = self.time_until_flush()
+            if flush_timeout is not None and flush_timeout < timeout:
+                timeout = flush_timeout
             # When either main socket has data or _pg_conn has data, select.select will return
-            rlist, _, _ = select.select(
-                [self._socket, self._pg_conn], [], [], self.event_loop_timeout
-            )
-            if not rlist and auto_send_enquire_link:
-                self.logger.debug("Socket timeout, listening again")
-                pdu = smpplib.smpp.make_pdu("enquire_link", client=self)
-                self.send_pdu(pdu)
-                self.send_mt_messages()
-                continue
-            elif not rlist:
-                # backwards-compatible with existing behavior
-                raise socket.timeout()
+            with self.timings.time("select"):
+                rlist, _, _ = select.select(
+                    [self._socket, self._pg_conn], [], [], timeout
+                )
+            self.flush_due_buffers()
             for ready_socket in rlist:
                 if ready_socket is self._socket:
-                    self.read_once(ignore_error_codes, auto_send_enquire_link)
+                    self.read_available(ignore_error_codes, auto_send_enquire_link)
                 else:
                     self.receive_pg_notify()
-            if self.hc_worker:
+            timers.run_due()
+            if self.mt_backlog:
+                self.send_mt_messages()
+            if rlist and self.hc_worker:
                 self.hc_worker.success_ping()
+            self.log_counters()
+            self.log_timings()
             if self.exit_signal_received():
                 self.logger.info("Got exit signal, leaving listen loop")
-                self.safe_disconnect()
                 return
 
+    def keep_alive(self, auto_send_enquire_link: bool = True):
+        """Send an enquire_link if no PDU has been read for
+        `enquire_link_interval` seconds.
+        """
+        if time.monotonic() - self.last_read_time < self.enquire_link_interval:
+            return
+        if not auto_send_enquire_link:
+            # backwards-compatible with existing behavior
+            raise socket.timeout()
+        self.logger.debug("Socket timeout, listening again")
+        self.send_pdu(smpplib.smpp.make_pdu("enquire_link", client=self))
+        # Don't send another until this one has had time to be answered
+        self.last_read_time = time.monotonic()
+
+    def log_counters(self, force=False):
+        """Log the running totals in `counters`, at most once every
+        COUNTERS_LOG_INTERVAL seconds unless `force` is set.
+        """
+        now = time.monotonic()
+        if not force and now < self.counters_logged_time + self.COUNTERS_LOG_INTERVAL:
+            return
+        self.counters_logged_time = now
+        counters = dict(self.counters)
+        if self.segment_cache.hits or self.segment_cache.misses:
+            counters["segment_cache_hits"] = self.segment_cache.hits
+            counters["segment_cache_misses"] = self.segment_cache.misses
+        if counters:
+            counters = ", ".join(f"{k}={v}" for k, v in sorted(counters.items()))
+            self.logger.info(
+                f"Counters for backend={self.backend}: {counters}, "
+                f"mt_rate={self.rate_limiter.rate:g}"
+            )
+
+    def log_timings(self, force=False):
+        """Log how long each phase took since the last time, at most once
+        every `stats_interval` seconds unless `force` is set.
+        """
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        if not force and now < self.timings_logged_time + self.stats_interval:
+            return
+        self.timings_logged_time = now
+        histograms = self.timings.since_last()
+        if histograms:
+            self.logger.info(
+                f"Timings for backend={self.backend}: " + format_histograms(histograms)
+            )
+
+    def close_connection(self):
+        """Close the socket after the connection has failed, so connect()
+        can open a new one.
+        """
+        try:
+            self.disconnect()
+        except Exception:
+            self.logger.exception("Ignoring exception during disconnect")
+
+    def reconcile_in_flight(self):
+        """After the connection has dropped, save what was buffered and
+        return messages without a submit_sm_resp for every part, or with parts
+        not sent yet, to the queue. The placeholder MTMessageStatus objects of
+        parts not sent are deleted.
+        """
+        self._save_submit_sm_resps(self.drain_submit_sm_resps())
+        receipts = self.receipt_buffer.drain()
+        if receipts:
+            # Not acknowledged, so the MC will deliver them again too
+            self._save_delivery_receipts(receipts)
+        if self.in_flight:
+            count = requeue_mt_messages(self.backend, list(self.in_flight))
+            self.counters["mt_message_requeued"] += count
+            logger.warning(
+                f"Requeued {count} messages without a submit_sm_resp "
+                f"for backend={self.backend}"
+            )
+            self.in_flight.clear()
+        if self.batch_unsent_sequences:
+            MTMessageStatus.objects.filter(
+                backend=self.backend,
+                sequence_number__in=self.batch_unsent_sequences,
+            ).delete()
+        if self.batch_unsent:
+            MTMessage.objects.filter(
+                pk__in=self.batch_unsent,
+                status__in=[MTMessage.Status.SENDING, MTMessage.Status.SENT],
+            ).update(status=MTMessage.Status.NEW, modify_time=timezone.now())
+        self.start_batch([])
+
     def safe_disconnect(self):
         if self._socket is not None:
             try:
@@ -0,0 +1,88 @@
+import random
+
+from collections import OrderedDict
+from typing import Any
+
+import smpplib.consts
+import smpplib.gsm
+
+# Concatenated SMS information element (8-bit reference number), as added by
+# smpplib.gsm.make_parts_encoded()
+CONCAT_UDH_PREFIX = b"\x05\x00\x03"
+CONCAT_UDH_REFERENCE_INDEX = len(CONCAT_UDH_PREFIX)
+
+
+def new_reference(parts: list[bytes], randint=random.randint) -> list[bytes]:
+    """Replace the concatenation reference number in the UDH of `parts` with
+    a random one, so copies of a message can be told apart by the handset.
+    """
+    reference = bytes([randint(0, 255)])
+    index = CONCAT_UDH_REFERENCE_INDEX
+    return [part[:index] + reference + part[index + 1 :] for part in parts]
+
+
+def encode_message(text: str) -> dict[str, Any]:
+    """Encode and split `text` like the SMPP client would, returning the
+    MTMessage fields that store the result.
+    """
+    parts, data_coding, esm_class = smpplib.gsm.make_parts(text)
+    return {
+        "encoded_parts": parts,
+        "data_coding": data_coding,
+        "esm_class": esm_class,
+    }
+
+
+class SegmentCache:
+    """
+    Bounded LRU cache of smpplib.gsm.make_parts() results, so the same text
+    sent to many recipients is only encoded and split once.
+
+    Parts of a concatenated message share a random reference number in their
+    UDH. A cached result is given a new reference number each time it is
+    returned, so separate messages with the same text can still be told apart
+    by the handset. A `max_size` of 0 disables caching.
+    """
+
+    def __init__(self, max_size: int = 1000, random=random.randint):
+        self.max_size = max_size
+        self.random = random
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def make_parts(
+        self,
+        text: str,
+        encoding: int = smpplib.consts.SMPP_ENCODING_DEFAULT,
+        use_udhi: bool = True,
+    ) -> tuple[list[bytes], int, int]:
+        """Return the parts, data_coding and esm_class for `text`, like
+        smpplib.gsm.make_parts().
+        """
+        if not self.max_size:
+            return smpplib.gsm.make_parts(text, encoding, use_udhi)
+        key = (text, encoding, use_udhi)
+        try:
+            parts, data_coding, esm_class = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            parts, data_coding, esm_class = smpplib.gsm.make_parts(
+                text, encoding, use_udhi
+            )
+            self.entries[key] = (parts, data_coding, esm_class)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return parts, data_coding, esm_class
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if esm_class & smpplib.consts.SMPP_GSMFEAT_UDHI:
+            parts = self.new_reference(parts)
+        return parts, data_coding, esm_class
+
+    def new_reference(self, parts: list[bytes]) -> list[bytes]:
+        """Replace the concatenation reference number in the UDH of `parts`."""
+        return new_reference(parts, self.random)
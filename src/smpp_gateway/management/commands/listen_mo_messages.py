@@ -1,5 +1,10 @@
 from django.core.management.base import BaseCommand
 
+from smpp_gateway.prometheus import (
+    mo_listener_collector,
+    mo_queue_collector,
+    start_metrics_server,
+)
 from smpp_gateway.subscribers import listen_mo_messages
 
 
@@ -8,6 +13,23 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--channel", default="new_mo_msg")
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=0,
+            help="Port on which to serve Prometheus metrics at /metrics. "
+            "0 disables the metrics endpoint.",
+        )
+        parser.add_argument(
+            "--metrics-address",
+            default="127.0.0.1",
+            help="Address on which to serve Prometheus metrics.",
+        )
 
     def handle(self, *args, **options):
+        start_metrics_server(
+            options["metrics_address"],
+            options["metrics_port"],
+            [mo_queue_collector(), mo_listener_collector()],
+        )
         listen_mo_messages(channel=options["channel"])
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rapidsms.models import Backend
+
+from smpp_gateway.queries import get_mt_latency_percentiles
+
+
+def format_seconds(seconds):
+    return "-" if seconds is None else f"{seconds:.3f}s"
+
+
+class Command(BaseCommand):
+    help = "Report percentiles of the latency of MT messages sent recently."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=float,
+            default=1,
+            help="Report on message segments submitted in this many past hours.",
+        )
+        parser.add_argument(
+            "--backend",
+            help="RapidSMS backend name. Defaults to all backends.",
+        )
+
+    def handle(self, *args, **options):
+        backend = None
+        if options["backend"]:
+            try:
+                backend = Backend.objects.get(name=options["backend"])
+            except Backend.DoesNotExist:
+                raise CommandError(f"Backend {options['backend']!r} does not exist")
+        end = timezone.now()
+        start = end - timedelta(hours=options["hours"])
+        results = get_mt_latency_percentiles(start, end, backend)
+        if not results:
+            self.stdout.write("No MT messages were submitted in this period.")
+            return
+        for backend_name, stages in results.items():
+            self.stdout.write(f"{backend_name}:")
+            for stage, result in stages.items():
+                self.stdout.write(
+                    f"  {stage:<5} count={result['count']} "
+                    f"p50={format_seconds(result['p50'])} "
+                    f"p95={format_seconds(result['p95'])} "
+                    f"p99={format_seconds(result['p99'])}"
+                )
@@ -56,6 +56,117 @@ class Command(BaseCommand):
             "--mt-messages-per-second",
             type=int,
             default=os.environ.get("SMPPLIB_MT_MESSAGES_PER_SECOND", 20),
+            help="Maximum rate at which submit_sm PDUs are sent. Each part of "
+            "a multipart message counts as one PDU.",
+        )
+        parser.add_argument(
+            "--mt-burst-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_MT_BURST_SIZE", 1),
+            help="Number of submit_sm PDUs that may be sent back-to-back when "
+            "the client has been idle. The default of 1 spreads PDUs evenly "
+            "at --mt-messages-per-second.",
+        )
+        parser.add_argument(
+            "--adaptive-rate",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Whether to halve the rate at which submit_sm PDUs are sent "
+            "when the SMPP server reports throttling errors (ESME_RTHROTTLED "
+            "or ESME_RMSGQFUL), and recover gradually to "
+            "--mt-messages-per-second afterwards. Throttled messages are "
+            "requeued either way.",
+        )
+        parser.add_argument(
+            "--reconnect",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Whether to reconnect and bind again, after a backoff, when "
+            "the SMPP connection drops. Messages awaiting a submit_sm_resp "
+            "are returned to the queue first.",
+        )
+        parser.add_argument(
+            "--retry-policy",
+            default=os.environ.get("SMPPLIB_RETRY_POLICY", r"{}"),
+            help="JSON object configuring which failed messages are retried, "
+            'e.g. {"max_attempts": 5, "base_delay": 30, "multiplier": 2, '
+            '"max_delay": 3600, "statuses": {"0x08": {}, "0x45": '
+            '{"base_delay": 60}}}. Messages that are not retried are marked '
+            "as errors.",
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=os.environ.get("SMPPLIB_LEASE_SECONDS", 300),
+            help="Messages still sending this many seconds after they were "
+            "fetched, e.g. because a client crashed mid-batch, are returned "
+            "to the queue to be sent again. Must be longer than a batch takes "
+            "to send. 0 disables this.",
+        )
+        parser.add_argument(
+            "--segment-cache-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_SEGMENT_CACHE_SIZE", 1000),
+            help="Number of distinct message texts whose encoded parts are "
+            "cached, so bulk messages sent to many recipients are only "
+            "encoded once. 0 disables the cache.",
+        )
+        parser.add_argument(
+            "--window-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_WINDOW_SIZE", 10),
+            help="Maximum number of submit_sm PDUs awaiting a submit_sm_resp "
+            "from the SMPP server at any time.",
+        )
+        parser.add_argument(
+            "--dlr-batch-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_DLR_BATCH_SIZE", 100),
+            help="Maximum number of delivery receipts to save to the DB in "
+            "one statement. Receipts are acknowledged once they are saved.",
+        )
+        parser.add_argument(
+            "--dlr-batch-delay-ms",
+            type=int,
+            default=os.environ.get("SMPPLIB_DLR_BATCH_DELAY_MS", 100),
+            help="Maximum time in milliseconds a delivery receipt may wait "
+            "to be saved to the DB with others.",
+        )
+        parser.add_argument(
+            "--pending-receipt-max",
+            type=int,
+            default=os.environ.get("SMPPLIB_PENDING_RECEIPT_MAX", 10000),
+            help="Maximum number of delivery receipts to hold in memory while "
+            "waiting for their submit_sm_resp to be saved. The oldest are "
+            "dropped first. 0 disables holding receipts.",
+        )
+        parser.add_argument(
+            "--pending-receipt-ttl",
+            type=float,
+            default=os.environ.get("SMPPLIB_PENDING_RECEIPT_TTL", 60),
+            help="Maximum time in seconds to hold a delivery receipt while "
+            "waiting for its submit_sm_resp to be saved.",
+        )
+        parser.add_argument(
+            "--resp-batch-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_RESP_BATCH_SIZE", 100),
+            help="Maximum number of submit_sm_resps to save to the DB in one "
+            "statement.",
+        )
+        parser.add_argument(
+            "--resp-batch-delay-ms",
+            type=int,
+            default=os.environ.get("SMPPLIB_RESP_BATCH_DELAY_MS", 100),
+            help="Maximum time in milliseconds a submit_sm_resp may wait to "
+            "be saved to the DB with others.",
+        )
+        parser.add_argument(
+            "--sequence-block-size",
+            type=int,
+            default=os.environ.get("SMPPLIB_SEQUENCE_BLOCK_SIZE", 100),
+            help="Number of PDU sequence numbers to reserve from Postgres at "
+            "a time.",
         )
         parser.add_argument(
             "--socket-timeout",
@@ -70,6 +181,65 @@ class Command(BaseCommand):
             "incoming messages. This is also the time between enquire_link "
             "PDUs sent to the SMPP server when there is no other traffic.",
         )
+        parser.add_argument(
+            "--enquire-link-interval",
+            type=float,
+            default=os.environ.get("SMPPLIB_ENQUIRE_LINK_INTERVAL"),
+            help="Seconds without any PDU from the SMPP server after which an "
+            "enquire_link PDU is sent. Defaults to --event-loop-timeout.",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=os.environ.get("SMPPLIB_METRICS_PORT", 0),
+            help="Port on which to serve Prometheus metrics at /metrics. "
+            "0 disables the metrics endpoint.",
+        )
+        parser.add_argument(
+            "--metrics-address",
+            default=os.environ.get("SMPPLIB_METRICS_ADDRESS", "127.0.0.1"),
+            help="Address on which to serve Prometheus metrics.",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=os.environ.get("SMPPLIB_STATS_INTERVAL", 60),
+            help="Seconds between log lines summarizing how long each phase "
+            "of the client's work took, such as waiting in select(), "
+            "fetching messages and saving responses. 0 disables them.",
+        )
+        parser.add_argument(
+            "--queue-poll-interval",
+            type=float,
+            default=os.environ.get("SMPPLIB_QUEUE_POLL_INTERVAL"),
+            help="Seconds between checks of the database for MT messages to "
+            "send, in addition to the checks prompted by Postgres "
+            "notifications. Defaults to --event-loop-timeout.",
+        )
+        parser.add_argument(
+            "--engine",
+            choices=["select", "asyncio"],
+            default=os.environ.get("SMPPLIB_ENGINE", "select"),
+            help="Event loop used once bound. With asyncio, reading and writing "
+            "PDUs, DB queries and enquire_link PDUs run as separate tasks, so "
+            "DB writes don't hold up the socket.",
+        )
+        parser.add_argument(
+            "--binds",
+            type=int,
+            default=os.environ.get("SMPPLIB_BINDS", 1),
+            help="Number of concurrent sessions to bind for the backend, each "
+            "in its own thread. --mt-messages-per-second and --window-size "
+            "apply to each session.",
+        )
+        parser.add_argument(
+            "--bind-mode",
+            choices=["transceiver", "split"],
+            default=os.environ.get("SMPPLIB_BIND_MODE", "transceiver"),
+            help="With split, each session binds a transmitter for MT messages "
+            "and a separate receiver for MO messages and delivery receipts, "
+            "each in its own thread.",
+        )
         parser.add_argument(
             "--database-url",
             default=os.environ.get("DATABASE_URL"),
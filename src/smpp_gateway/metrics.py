@@ -0,0 +1,124 @@
+import bisect
+import threading
+import time
+
+from typing import Optional
+
+# Upper bounds, in seconds, of the histogram buckets: 10 microseconds to
+# about 10 seconds, doubling each time, plus a bucket for anything slower
+BUCKET_BOUNDS = tuple(0.00001 * 2**i for i in range(21))
+
+
+class Histogram:
+    """Counts of durations in exponentially sized buckets."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.buckets = list(self.buckets)
+        histogram.count = self.count
+        histogram.total = self.total
+        return histogram
+
+    def __sub__(self, other: "Histogram") -> "Histogram":
+        """The durations recorded since `other` was copied from this one."""
+        histogram = Histogram()
+        histogram.buckets = [a - b for a, b in zip(self.buckets, other.buckets)]
+        histogram.count = self.count - other.count
+        histogram.total = self.total - other.total
+        return histogram
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Upper bound of the bucket holding the given fraction of durations,
+        or None if there are none. Durations in the last bucket are reported
+        as infinite.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class PhaseTimer:
+    """Context manager recording how long its block took in a histogram."""
+
+    __slots__ = ("timers", "phase", "start")
+
+    def __init__(self, timers: "PhaseTimers", phase: str):
+        self.timers = timers
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timers.record(self.phase, time.perf_counter() - self.start)
+
+
+class PhaseTimers:
+    """
+    Histograms of how long each phase of the client's work takes, such as
+    waiting in select() or fetching MT messages. Phases may be timed from
+    several threads, e.g. the asyncio engine's DB thread.
+    """
+
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+        # Copies of the histograms as of the last call to since_last()
+        self.previous: dict[str, Histogram] = {}
+
+    def time(self, phase: str) -> PhaseTimer:
+        return PhaseTimer(self, phase)
+
+    def record(self, phase: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.record(seconds)
+
+    def snapshot(self) -> dict[str, Histogram]:
+        """Copies of the histograms of every phase timed so far."""
+        with self.lock:
+            return {phase: h.copy() for phase, h in self.histograms.items()}
+
+    def since_last(self) -> dict[str, Histogram]:
+        """Histograms of the durations recorded since the last call, for
+        phases with any.
+        """
+        current = self.snapshot()
+        empty = Histogram()
+        intervals = {
+            phase: histogram - self.previous.get(phase, empty)
+            for phase, histogram in current.items()
+        }
+        self.previous = current
+        return {phase: h for phase, h in intervals.items() if h.count}
+
+
+def format_histograms(histograms: dict[str, Histogram]) -> str:
+    """Summarize `histograms` on one line, in milliseconds."""
+
+    def ms(seconds):
+        return f"{seconds * 1000:.3g}ms"
+
+    return "; ".join(
+        f"{phase} count={h.count} total={ms(h.total)} "
+        f"p50<={ms(h.percentile(0.5))} p99<={ms(h.percentile(0.99))}"
+        for phase, h in sorted(histograms.items())
+    )
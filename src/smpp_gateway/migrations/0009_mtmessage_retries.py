@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:32
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Rebuild the index without locking out writes to a large table
+    atomic = False
+
+    dependencies = [
+        ("smpp_gateway", "0008_remove_mtmessage_mt_message_status_idx_and_more"),
+    ]
+
+    operations = [
+        RemoveIndexConcurrently(
+            model_name="mtmessage",
+            name="mt_message_status_idx",
+        ),
+        migrations.AddField(
+            model_name="mtmessage",
+            name="attempt_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="attempt count"),
+        ),
+        migrations.AddField(
+            model_name="mtmessage",
+            name="next_attempt_time",
+            field=models.DateTimeField(null=True, verbose_name="next attempt time"),
+        ),
+        AddIndexConcurrently(
+            model_name="mtmessage",
+            index=models.Index(
+                models.F("status"),
+                models.OrderBy(
+                    models.F("priority_flag"), descending=True, nulls_last=True
+                ),
+                models.F("next_attempt_time"),
+                condition=models.Q(("status", "new")),
+                name="mt_message_status_idx",
+            ),
+        ),
+    ]
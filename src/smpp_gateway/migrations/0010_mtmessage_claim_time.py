@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:33
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking out writes to a large table
+    atomic = False
+
+    dependencies = [
+        ("smpp_gateway", "0009_mtmessage_retries"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mtmessage",
+            name="claim_time",
+            field=models.DateTimeField(null=True, verbose_name="claim time"),
+        ),
+        AddIndexConcurrently(
+            model_name="mtmessage",
+            index=models.Index(
+                condition=models.Q(("status", "sending")),
+                fields=["backend", "claim_time"],
+                name="mt_message_claim_idx",
+            ),
+        ),
+    ]
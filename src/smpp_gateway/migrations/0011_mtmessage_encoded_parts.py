@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:39
+
+import django.contrib.postgres.fields
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("smpp_gateway", "0010_mtmessage_claim_time"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mtmessage",
+            name="data_coding",
+            field=models.PositiveSmallIntegerField(
+                null=True, verbose_name="data coding"
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessage",
+            name="encoded_parts",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.BinaryField(),
+                editable=False,
+                null=True,
+                size=None,
+                verbose_name="encoded parts",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessage",
+            name="esm_class",
+            field=models.PositiveSmallIntegerField(null=True, verbose_name="ESM class"),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:50
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking out writes to a large table
+    atomic = False
+
+    dependencies = [
+        ("smpp_gateway", "0011_mtmessage_encoded_parts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="dlr_at",
+            field=models.DateTimeField(
+                help_text="When the delivery report was received from the MC.",
+                null=True,
+                verbose_name="delivery report at",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="resp_at",
+            field=models.DateTimeField(
+                help_text="When the submit_sm_resp was received from the MC.",
+                null=True,
+                verbose_name="response at",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="submitted_at",
+            field=models.DateTimeField(
+                help_text="When the submit_sm was sent to the MC.",
+                null=True,
+                verbose_name="submitted at",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="mtmessagestatus",
+            index=models.Index(
+                fields=["backend", "submitted_at"], name="mt_status_submitted_at_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:51
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking out writes to a large table
+    atomic = False
+
+    dependencies = [
+        ("smpp_gateway", "0012_mtmessagestatus_latency_timestamps"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="mtmessagestatus",
+            index=models.Index(
+                fields=["backend", "message_id"], name="mt_status_message_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("smpp_gateway", "0013_mtmessagestatus_message_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="dlr_done_date",
+            field=models.DateTimeField(
+                help_text="The done date of the delivery report, taken to be in UTC.",
+                null=True,
+                verbose_name="delivery report done date",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="dlr_error_code",
+            field=models.IntegerField(
+                help_text="The err of the delivery report.",
+                null=True,
+                verbose_name="delivery report error code",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mtmessagestatus",
+            name="dlr_state",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="The stat of the delivery report, e.g. DELIVRD or UNDELIV.",
+                max_length=7,
+                verbose_name="delivery report state",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="mtmessage",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("new", "New"),
+                    ("sending", "Sending"),
+                    ("sent", "Sent"),
+                    ("delivered", "Delivered"),
+                    ("undelivered", "Undelivered"),
+                    ("error", "Error"),
+                ],
+                max_length=32,
+                verbose_name="status",
+            ),
+        ),
+    ]
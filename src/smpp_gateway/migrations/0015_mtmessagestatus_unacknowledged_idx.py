@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:58
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking out writes to a large table
+    atomic = False
+
+    dependencies = [
+        ("smpp_gateway", "0014_mtmessagestatus_dlr_fields"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="mtmessagestatus",
+            index=models.Index(
+                condition=models.Q(("command_status__isnull", True)),
+                fields=["backend", "create_time"],
+                name="mt_status_unacknowledged_idx",
+            ),
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import connection, models
+from django.contrib.postgres.fields import ArrayField
+from django.db import models
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from rapidsms.models import Backend
@@ -82,6 +83,7 @@ class MTMessage(AbstractTimestampModel, models.Model):
         SENDING = "sending", _("Sending")
         SENT = "sent", _("Sent")
         DELIVERED = "delivered", _("Delivered")
+        UNDELIVERED = "undelivered", _("Undelivered")
         ERROR = "error", _("Error")
 
     class PriorityFlag(models.IntegerChoices):
@@ -95,19 +97,53 @@ class MTMessage(AbstractTimestampModel, models.Model):
     backend = models.ForeignKey(
         Backend, on_delete=models.PROTECT, verbose_name=_("backend")
     )
-    # SMPP client will decide how to encode it
+    # SMPP client will decide how to encode it, unless encoded_parts is set
     short_message = models.TextField(_("short message"))
+    # short_message already encoded and split into submit_sm PDUs, with the
+    # data_coding and esm_class to send them with (see encode())
+    encoded_parts = ArrayField(
+        models.BinaryField(),
+        verbose_name=_("encoded parts"),
+        null=True,
+        editable=False,
+    )
+    data_coding = models.PositiveSmallIntegerField(_("data coding"), null=True)
+    esm_class = models.PositiveSmallIntegerField(_("ESM class"), null=True)
     params = models.JSONField(_("params"))
     status = models.CharField(_("status"), max_length=32, choices=Status.choices)
     priority_flag = models.IntegerField(
         _("priority flag"), choices=PriorityFlag.choices, null=True
     )
+    # Number of times the message has been fetched to be sent
+    attempt_count = models.PositiveIntegerField(_("attempt count"), default=0)
+    # Set when a failed message is scheduled to be retried; NULL means now
+    next_attempt_time = models.DateTimeField(_("next attempt time"), null=True)
+    # When the message was last fetched to be sent (moved to SENDING)
+    claim_time = models.DateTimeField(_("claim time"), null=True)
+
+    def encode(self):
+        """Encode and split short_message now, so the SMPP client doesn't
+        have to when sending it.
+        """
+        from smpp_gateway.encoding import encode_message
+
+        for field, value in encode_message(self.short_message).items():
+            setattr(self, field, value)
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if self.status == MTMessage.Status.NEW:
-            with connection.cursor() as curs:
-                curs.execute(f"NOTIFY {self.backend.name}")
+            from smpp_gateway.queries import (
+                mt_notify_payload,
+                notify_payloads_enabled,
+                pg_notify,
+            )
+
+            if notify_payloads_enabled():
+                payload = mt_notify_payload([self.pk], [self.priority_flag])
+                pg_notify(self.backend.name, payload)
+            else:
+                pg_notify(self.backend.name)
 
     def __str__(self):
         return f"{self.short_message} ({self.id})"
@@ -119,9 +155,16 @@ class MTMessage(AbstractTimestampModel, models.Model):
                 # Allow for quick filtering of messages that need to be processed
                 "status",
                 models.F("priority_flag").desc(nulls_last=True),
+                "next_attempt_time",
                 name="mt_message_status_idx",
                 condition=models.Q(status="new"),  # No way to access Status.NEW here?
             ),
+            models.Index(
+                # Allow for quick filtering of claims that have expired
+                fields=["backend", "claim_time"],
+                name="mt_message_claim_idx",
+                condition=models.Q(status="sending"),
+            ),
         )
 
 
@@ -156,6 +199,38 @@ class MTMessageStatus(AbstractTimestampModel, models.Model):
         null=True,
         help_text=_("The delivery_report we receive from the MC (via its deliver_sm)."),
     )
+    submitted_at = models.DateTimeField(
+        _("submitted at"),
+        null=True,
+        help_text=_("When the submit_sm was sent to the MC."),
+    )
+    resp_at = models.DateTimeField(
+        _("response at"),
+        null=True,
+        help_text=_("When the submit_sm_resp was received from the MC."),
+    )
+    dlr_at = models.DateTimeField(
+        _("delivery report at"),
+        null=True,
+        help_text=_("When the delivery report was received from the MC."),
+    )
+    dlr_state = models.CharField(
+        _("delivery report state"),
+        max_length=7,
+        blank=True,
+        default="",
+        help_text=_("The stat of the delivery report, e.g. DELIVRD or UNDELIV."),
+    )
+    dlr_error_code = models.IntegerField(
+        _("delivery report error code"),
+        null=True,
+        help_text=_("The err of the delivery report."),
+    )
+    dlr_done_date = models.DateTimeField(
+        _("delivery report done date"),
+        null=True,
+        help_text=_("The done date of the delivery report, taken to be in UTC."),
+    )
 
     @cached_property
     def delivery_report_as_bytes(self) -> bytes:
@@ -172,3 +247,21 @@ class MTMessageStatus(AbstractTimestampModel, models.Model):
                 fields=["backend", "sequence_number"], name="unique_seq_num"
             )
         ]
+        indexes = [
+            models.Index(
+                # Allow for quick matching of delivery receipts
+                fields=["backend", "message_id"],
+                name="mt_status_message_id_idx",
+            ),
+            models.Index(
+                # Allow for quick filtering of PDUs awaiting a submit_sm_resp
+                fields=["backend", "create_time"],
+                name="mt_status_unacknowledged_idx",
+                condition=models.Q(command_status__isnull=True),
+            ),
+            models.Index(
+                # Allow for range scans when computing latencies
+                fields=["backend", "submitted_at"],
+                name="mt_status_submitted_at_idx",
+            ),
+        ]
@@ -1,10 +1,13 @@
 import logging
 
+import smpplib.consts
+
 from django.utils import timezone
 from rapidsms.backends.base import BackendBase
 
+from smpp_gateway.encoding import encode_message, new_reference
 from smpp_gateway.models import MTMessage
-from smpp_gateway.queries import pg_notify
+from smpp_gateway.queries import mt_notify_payload, notify_payloads_enabled, pg_notify
 from smpp_gateway.utils import grouper
 
 logger = logging.getLogger(__name__)
@@ -22,8 +25,12 @@ class SMPPGatewayBackend(BackendBase):
     def configure(self, **kwargs):
         self.send_group_size = kwargs.get("send_group_size", 100)
         self.socket_timeout = kwargs.get("socket_timeout", 5)
+        # Whether to encode messages here, rather than in the SMPP client
+        self.encode_messages = kwargs.get("encode_messages", True)
 
     def prepare_request(self, id_, text, identities, context):
+        # The text is the same for every identity, so only encode it once
+        encoded = encode_message(text) if self.encode_messages else {}
         for identity in identities:
             now = timezone.now()
             params = {
@@ -32,6 +39,13 @@ class SMPPGatewayBackend(BackendBase):
                 if param in context
             }
             params["destination_addr"] = identity
+            if encoded.get("esm_class", 0) & smpplib.consts.SMPP_GSMFEAT_UDHI:
+                # Each copy needs its own concatenation reference, or a
+                # handset receiving two of them can't tell their parts apart
+                encoded = {
+                    **encoded,
+                    "encoded_parts": new_reference(encoded["encoded_parts"]),
+                }
             yield {
                 "create_time": now,
                 "modify_time": now,
@@ -40,6 +54,7 @@ class SMPPGatewayBackend(BackendBase):
                 "params": params,
                 "status": MTMessage.Status.NEW,
                 "priority_flag": context.get("priority_flag"),
+                **encoded,
             }
 
     def send(self, id_, text, identities, context=None):
@@ -47,8 +62,15 @@ class SMPPGatewayBackend(BackendBase):
         context = context or {}
         kwargs_generator = self.prepare_request(id_, text, identities, context)
         for kwargs_group in grouper(kwargs_generator, self.send_group_size):
-            MTMessage.objects.bulk_create(
+            messages = MTMessage.objects.bulk_create(
                 [MTMessage(**kwargs) for kwargs in kwargs_group]
             )
             if context.get("priority_flag", 0) >= self.minimum_notify_priority_flag:
-                pg_notify(self.model.name)
+                if notify_payloads_enabled():
+                    payload = mt_notify_payload(
+                        [message.pk for message in messages],
+                        [message.priority_flag for message in messages],
+                    )
+                    pg_notify(self.model.name, payload)
+                else:
+                    pg_notify(self.model.name)
@@ -0,0 +1,88 @@
+import socket
+import struct
+
+from typing import Optional
+
+import smpplib.exceptions
+
+# command_length, command_id, command_status and sequence_number
+HEADER_LENGTH = 16
+# SMPP doesn't cap command_length, but the largest body a PDU needs is a
+# 64 KiB message_payload plus the other fields, so anything much longer is a
+# corrupt stream rather than a PDU worth growing the buffer for
+MAX_PDU_LENGTH = 128 * 1024
+
+
+class PduReader:
+    """
+    Reads from a socket into a reusable buffer and splits what was read into
+    raw PDUs. Each read takes as much as the kernel has buffered, up to the
+    free space in the buffer, so a burst of PDUs costs one recv() call rather
+    than two per PDU.
+    """
+
+    def __init__(self, buffer_size: int = 65536):
+        self.buffer = bytearray(buffer_size)
+        # Unparsed data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        """Discard buffered data, e.g. after reconnecting."""
+        self.start = self.end = 0
+
+    def read_from(self, sock: socket.socket) -> int:
+        """Read whatever is available from `sock` into the buffer, blocking
+        until something is. Returns the number of bytes read.
+        """
+        self.make_room()
+        try:
+            count = sock.recv_into(memoryview(self.buffer)[self.end :])
+        except socket.timeout:
+            raise
+        except OSError as err:
+            raise smpplib.exceptions.ConnectionError() from err
+        if not count:
+            raise smpplib.exceptions.ConnectionError()
+        self.end += count
+        return count
+
+    def make_room(self):
+        """Move unparsed data to the start of the buffer, and grow the buffer
+        if it can't hold the whole of the next PDU.
+        """
+        if self.start:
+            length = len(self)
+            self.buffer[:length] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, length
+        needed = max(self.next_pdu_length() or 0, self.end + 1)
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(needed - len(self.buffer)))
+
+    def next_pdu_length(self) -> Optional[int]:
+        if len(self) < 4:
+            return None
+        (length,) = struct.unpack_from(">L", self.buffer, self.start)
+        if length < HEADER_LENGTH or length > MAX_PDU_LENGTH:
+            raise smpplib.exceptions.PDUError("Broken PDU")
+        return length
+
+    def has_pdu(self) -> bool:
+        length = self.next_pdu_length()
+        return length is not None and len(self) >= length
+
+    def next_pdu(self) -> Optional[bytes]:
+        """Remove the next complete PDU from the buffer and return it, or
+        return None if there isn't one yet.
+        """
+        if not self.has_pdu():
+            return None
+        length = self.next_pdu_length()
+        raw_pdu = bytes(self.buffer[self.start : self.start + length])
+        self.start += length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return raw_pdu
@@ -0,0 +1,259 @@
+import collections
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, NamedTuple, Optional, Union
+
+from django.db import connections
+from django.db.models import Count
+
+from smpp_gateway import subscribers
+from smpp_gateway.metrics import BUCKET_BOUNDS, Histogram
+from smpp_gateway.models import MOMessage, MTMessage
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Sample(NamedTuple):
+    """One sample of a metric in the Prometheus text format."""
+
+    family: str
+    type: str
+    help: str
+    name: str
+    labels: dict[str, str]
+    value: Union[int, float]
+
+
+Collector = Callable[[], Iterable[Sample]]
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    pairs = ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped))
+    return "{" + pairs + "}"
+
+
+def format_value(value: Union[int, float]) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(samples: Iterable[Sample]) -> str:
+    """Render `samples` in the Prometheus text format, grouped by family."""
+    families: dict[str, list[Sample]] = collections.OrderedDict()
+    for sample in samples:
+        families.setdefault(sample.family, []).append(sample)
+    lines = []
+    for family, family_samples in families.items():
+        lines.append(f"# HELP {family} {family_samples[0].help}")
+        lines.append(f"# TYPE {family} {family_samples[0].type}")
+        for sample in family_samples:
+            lines.append(
+                f"{sample.name}{format_labels(sample.labels)} "
+                f"{format_value(sample.value)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def counter(name: str, help: str, labels: dict, value) -> Sample:
+    return Sample(name, "counter", help, name, labels, value)
+
+
+def gauge(name: str, help: str, labels: dict, value) -> Sample:
+    return Sample(name, "gauge", help, name, labels, value)
+
+
+def histogram_samples(
+    name: str, help: str, labels: dict, histogram: Histogram
+) -> list[Sample]:
+    samples = []
+    cumulative = 0
+    bounds = BUCKET_BOUNDS + (float("inf"),)
+    for bound, count in zip(bounds, histogram.buckets):
+        cumulative += count
+        bucket_labels = {**labels, "le": format_value(bound)}
+        samples.append(
+            Sample(name, "histogram", help, f"{name}_bucket", bucket_labels, cumulative)
+        )
+    samples.append(
+        Sample(name, "histogram", help, f"{name}_sum", labels, histogram.total)
+    )
+    samples.append(
+        Sample(name, "histogram", help, f"{name}_count", labels, histogram.count)
+    )
+    return samples
+
+
+def client_collector(client, session: str = "") -> Collector:
+    """Collect the counters, window and phase timings of an SMPP client."""
+
+    def collect():
+        labels = {"backend": client.backend.name}
+        if session:
+            labels["session"] = session
+        # Copied in one step, as the client's thread may be updating it
+        for event, value in sorted(dict(client.counters).items()):
+            yield counter(
+                "smpp_gateway_client_events_total",
+                "Events counted by the SMPP client, such as PDUs sent and "
+                "received, retries and reconnects.",
+                {**labels, "event": event},
+                value,
+            )
+        yield gauge(
+            "smpp_gateway_client_in_flight",
+            "submit_sm PDUs awaiting a submit_sm_resp.",
+            labels,
+            len(client.in_flight),
+        )
+        yield gauge(
+            "smpp_gateway_client_window_size",
+            "Maximum number of submit_sm PDUs awaiting a submit_sm_resp.",
+            labels,
+            client.window_size,
+        )
+        yield gauge(
+            "smpp_gateway_client_pending_receipts",
+            "Delivery receipts held until their submit_sm_resp is saved.",
+            labels,
+            len(client.pending_receipts),
+        )
+        yield gauge(
+            "smpp_gateway_client_mt_rate",
+            "Current rate limit for submit_sm PDUs, per second.",
+            labels,
+            client.rate_limiter.rate,
+        )
+        for phase, histogram in sorted(client.timings.snapshot().items()):
+            yield from histogram_samples(
+                "smpp_gateway_client_phase_seconds",
+                "Time taken by each phase of the SMPP client's work.",
+                {**labels, "phase": phase},
+                histogram,
+            )
+
+    return collect
+
+
+def queue_collector(model=MTMessage, statuses=None) -> Collector:
+    """Collect the number of messages of `model` waiting in each of
+    `statuses`, per backend.
+    """
+    if statuses is None:
+        statuses = [MTMessage.Status.NEW, MTMessage.Status.SENDING]
+    name = f"smpp_gateway_{model._meta.model_name}_queue"
+
+    def collect():
+        rows = (
+            model.objects.filter(status__in=statuses)
+            .values_list("backend__name", "status")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        for backend, status, count in rows:
+            yield gauge(
+                name,
+                f"{model._meta.verbose_name} objects waiting, by status.",
+                {"backend": backend, "status": status},
+                count,
+            )
+
+    return collect
+
+
+def mo_queue_collector() -> Collector:
+    return queue_collector(MOMessage, [MOMessage.Status.NEW])
+
+
+def mo_listener_collector() -> Collector:
+    """Collect the counters and timings of listen_mo_messages()."""
+
+    def collect():
+        for event, value in sorted(dict(subscribers.counters).items()):
+            yield counter(
+                "smpp_gateway_mo_listener_events_total",
+                "MO messages handled by the MO listener, by outcome.",
+                {"event": event},
+                value,
+            )
+        for phase, histogram in sorted(subscribers.timings.snapshot().items()):
+            yield from histogram_samples(
+                "smpp_gateway_mo_listener_phase_seconds",
+                "Time taken by each phase of the MO listener's work.",
+                {"phase": phase},
+                histogram,
+            )
+
+    return collect
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render(self.server.collect()).encode()
+        except Exception:
+            logger.exception("Failed to collect metrics")
+            self.send_error(500)
+            return
+        finally:
+            # Each request is handled in its own thread, with its own
+            # Django DB connection
+            connections.close_all()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Serves the samples from `collectors` at /metrics, in the Prometheus text
+    format, from a daemon thread. Collectors can be added after starting.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: str, port: int, collectors: list[Collector] = None):
+        super().__init__((address, port), MetricsHandler)
+        self.collectors = list(collectors or [])
+
+    def add_collector(self, collector: Collector):
+        self.collectors.append(collector)
+
+    def collect(self) -> list[Sample]:
+        return [sample for collector in self.collectors for sample in collector()]
+
+    def start(self):
+        host, port = self.server_address[:2]
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+        threading.Thread(target=self.serve_forever, name="metrics", daemon=True).start()
+
+
+def start_metrics_server(
+    address: str, port: int, collectors: list[Collector]
+) -> Optional[MetricsServer]:
+    """Start serving metrics on `port`, unless it is 0."""
+    if not port:
+        return None
+    server = MetricsServer(address, port, collectors)
+    server.start()
+    return server
@@ -1,17 +1,28 @@
+import json
 import logging
 
-from typing import Any
+from datetime import datetime, timedelta
+from typing import Any, Optional
 
 import psycopg2.extensions
 
+from django.conf import settings
 from django.db import connection, transaction
-from django.db.models import F, QuerySet
+from django.db.models import F, Q, QuerySet
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from rapidsms.models import Backend
 
-from smpp_gateway.models import MOMessage, MTMessage
+from smpp_gateway.models import MOMessage, MTMessage, MTMessageStatus
+from smpp_gateway.receipts import FINAL_STATES, DeliveryReceipt, parse_delivery_receipt
+from smpp_gateway.retries import RetryPolicy
 
 logger = logging.getLogger(__name__)
 
+# Notification payloads are limited to 8000 bytes, so only list the IDs of
+# this many MTMessages
+NOTIFY_PAYLOAD_MAX_IDS = 300
+
 
 def pg_listen(channel: str) -> psycopg2.extensions.connection:
     """Return a new connection listening for notifications on `channel`.
@@ -32,33 +43,484 @@ def pg_listen(channel: str) -> psycopg2.extensions.connection:
     return pg_conn
 
 
-def pg_notify(channel: str):
-    """Send a notification on `channel` with empty payload."""
+def pg_notify(channel: str, payload: str = ""):
+    """Send a notification on `channel`, with an empty payload by default."""
     with connection.cursor() as cursor:
-        cursor.execute(f"NOTIFY {channel};")
+        if payload:
+            cursor.execute(f"NOTIFY {channel}, %s;", [payload])
+        else:
+            cursor.execute(f"NOTIFY {channel};")
+
+
+def notify_payloads_enabled() -> bool:
+    return getattr(settings, "SMPP_GATEWAY_NOTIFY_PAYLOADS", False)
+
+
+def mt_notify_payload(ids: list[int], priority_flags: list[Optional[int]]) -> str:
+    """Payload for a notification of new MTMessages, giving their number and
+    highest priority_flag, and their IDs if there aren't too many to fit.
+    """
+    priorities = [flag for flag in priority_flags if flag is not None]
+    payload = {"count": len(ids), "priority": max(priorities, default=None)}
+    if len(ids) <= NOTIFY_PAYLOAD_MAX_IDS:
+        payload["ids"] = ids
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def parse_mt_notify_payload(payload: str) -> Optional[dict[str, Any]]:
+    """Parse a payload made by mt_notify_payload(), returning None if it is
+    empty, truncated or otherwise not one.
+    """
+    try:
+        parsed = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("count"), int):
+        return None
+    return parsed
 
 
 def get_mt_messages_to_send(limit: int, backend: Backend) -> list[dict[str, Any]]:
     """Fetches up to `limit` messages intended for `backend`, updates their
     status to SENDING, and returns select fields from the model. The messages
-    are sorted by descending `priority_flag`.
+    are sorted by descending `priority_flag`. Messages scheduled to be retried
+    later are skipped until their `next_attempt_time`.
     """
     with transaction.atomic():
         smses = list(
             MTMessage.objects.filter(status=MTMessage.Status.NEW, backend=backend)
+            .filter(
+                Q(next_attempt_time__isnull=True)
+                | Q(next_attempt_time__lte=timezone.now())
+            )
             .select_for_update(skip_locked=True)
             .order_by(F("priority_flag").desc(nulls_last=True))
-            .values("id", "short_message", "params", "priority_flag")[:limit]
+            .values(
+                "id",
+                "short_message",
+                "params",
+                "priority_flag",
+                "encoded_parts",
+                "data_coding",
+                "esm_class",
+            )[:limit]
         )
         if smses:
             pks = [sms["id"] for sms in smses]
             logger.debug(
                 f"get_mt_messages_to_send: Marking {pks} as {MTMessage.Status.SENDING.label}"
             )
-            MTMessage.objects.filter(pk__in=pks).update(status=MTMessage.Status.SENDING)
+            MTMessage.objects.filter(pk__in=pks).update(
+                status=MTMessage.Status.SENDING,
+                attempt_count=F("attempt_count") + 1,
+                claim_time=timezone.now(),
+            )
     return smses
 
 
+def save_submit_sm_resps(
+    backend: Backend,
+    resps: list[tuple],
+    now: Optional[datetime] = None,
+) -> int:
+    """Saves a batch of `(sequence_number, command_status, message_id)`
+    tuples from submit_sm_resps received from `backend` on the matching
+    MTMessageStatus objects, in a single statement. Each tuple may end with
+    the time the response was received, saved as `resp_at` (`now` if not
+    given), and then the time the submit_sm was sent, saved as
+    `submitted_at` if not None. Returns the number of MTMessageStatus objects
+    updated.
+    """
+    if not resps:
+        return 0
+    now = now or timezone.now()
+    values = ", ".join(
+        ["(%s::integer, %s::integer, %s, %s::timestamptz, %s::timestamptz)"]
+        * len(resps)
+    )
+    params = [now]
+    for sequence_number, command_status, message_id, *times in resps:
+        params.extend(
+            [
+                sequence_number,
+                command_status,
+                message_id,
+                times[0] if times else now,
+                times[1] if len(times) > 1 else None,
+            ]
+        )
+    params.append(backend.pk)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {MTMessageStatus._meta.db_table} AS status
+            SET
+                modify_time = %s,
+                command_status = resp.command_status,
+                message_id = resp.message_id,
+                resp_at = resp.resp_at,
+                submitted_at = COALESCE(resp.submitted_at, status.submitted_at)
+            FROM (VALUES {values})
+                AS resp (
+                    sequence_number, command_status, message_id, resp_at, submitted_at
+                )
+            WHERE
+                status.backend_id = %s
+                AND status.sequence_number = resp.sequence_number
+            """,
+            params,
+        )
+        return cursor.rowcount
+
+
+def write_mt_message_statuses(
+    backend: Backend,
+    sequence_numbers: list[tuple[int, int]],
+    now: Optional[datetime] = None,
+) -> int:
+    """Creates a placeholder MTMessageStatus for each `(mt_message_id,
+    sequence_number)` pair of PDUs about to be sent to `backend`, and marks
+    the MTMessages as SENT, in a single statement. The placeholders exist
+    before any submit_sm_resp can arrive. Their `submitted_at` is left for
+    the submit_sm_resp to fill in with the time each PDU was actually sent.
+    Returns the number of MTMessageStatus objects created.
+    """
+    if not sequence_numbers:
+        return 0
+    now = now or timezone.now()
+    mt_message_ids = [mt_message_id for mt_message_id, _ in sequence_numbers]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH inserted AS (
+                INSERT INTO {MTMessageStatus._meta.db_table} (
+                    create_time,
+                    modify_time,
+                    backend_id,
+                    mt_message_id,
+                    sequence_number,
+                    message_id,
+                    dlr_state
+                )
+                SELECT %s, %s, %s, pdu.mt_message_id, pdu.sequence_number, '', ''
+                FROM unnest(%s::bigint[], %s::integer[])
+                    AS pdu (mt_message_id, sequence_number)
+                RETURNING 1
+            ), sent AS (
+                UPDATE {MTMessage._meta.db_table}
+                SET modify_time = %s, status = %s
+                WHERE id = ANY(%s::bigint[]) AND status = %s
+            )
+            SELECT COUNT(*) FROM inserted
+            """,
+            [
+                now,
+                now,
+                backend.pk,
+                mt_message_ids,
+                [sequence_number for _, sequence_number in sequence_numbers],
+                now,
+                MTMessage.Status.SENT,
+                list(set(mt_message_ids)),
+                MTMessage.Status.SENDING,
+            ],
+        )
+        (count,) = cursor.fetchone()
+    return count
+
+
+def reclaim_expired_mt_messages(
+    backend: Backend, lease_seconds: float, now: Optional[datetime] = None
+) -> int:
+    """Returns MTMessages for `backend` that have been SENDING for longer than
+    `lease_seconds`, e.g. because the client sending them crashed, to NEW so
+    they will be sent again. So are SENT MTMessages with a PDU in their latest
+    attempt that was written out over `lease_seconds` ago and never got a
+    submit_sm_resp, since messages are marked as SENT just before their PDUs
+    are sent. The age of a PDU is taken from when its placeholder status was
+    created, since `submitted_at` is only known once the submit_sm_resp
+    arrives. Returns the number of MTMessages reclaimed.
+    """
+    now = now or timezone.now()
+    expired = now - timedelta(seconds=lease_seconds)
+    count = MTMessage.objects.filter(
+        status=MTMessage.Status.SENDING,
+        backend=backend,
+        claim_time__lt=expired,
+    ).update(status=MTMessage.Status.NEW, modify_time=now)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {MTMessage._meta.db_table} AS message
+            SET modify_time = %s, status = %s
+            FROM (
+                SELECT mt_message_id, MAX(create_time) AS create_time
+                FROM {MTMessageStatus._meta.db_table}
+                WHERE backend_id = %s
+                    AND command_status IS NULL
+                    AND create_time < %s
+                GROUP BY mt_message_id
+            ) AS unacknowledged
+            WHERE message.id = unacknowledged.mt_message_id
+                AND message.status = %s
+                AND unacknowledged.create_time >= message.claim_time
+            """,
+            [now, MTMessage.Status.NEW, backend.pk, expired, MTMessage.Status.SENT],
+        )
+        count += cursor.rowcount
+    return count
+
+
+def requeue_mt_messages(backend: Backend, sequence_numbers: list[int]) -> int:
+    """Returns the SENDING or SENT MTMessages that were sent to `backend` as
+    PDUs with the given `sequence_numbers` to NEW, so they will be sent
+    again straight away. The attempt doesn't count towards the retry policy's
+    `max_attempts`. Returns the number of MTMessages requeued.
+    """
+    return MTMessage.objects.filter(
+        status__in=[MTMessage.Status.SENDING, MTMessage.Status.SENT],
+        mtmessagestatus__backend=backend,
+        mtmessagestatus__sequence_number__in=sequence_numbers,
+    ).update(
+        status=MTMessage.Status.NEW,
+        attempt_count=Greatest(F("attempt_count") - 1, 0),
+        modify_time=timezone.now(),
+    )
+
+
+def schedule_mt_message_retries(
+    backend: Backend,
+    failures: list[tuple[int, int]],
+    policy: RetryPolicy,
+    now: Optional[datetime] = None,
+) -> tuple[int, int]:
+    """Applies `policy` to the SENDING or SENT MTMessages sent to `backend` as
+    PDUs whose `(sequence_number, command_status)` are given in `failures`.
+    Messages to be retried are returned to NEW with a `next_attempt_time`,
+    and the rest are marked as ERROR. Returns the number of messages retried
+    and failed.
+    """
+    if not failures:
+        return 0, 0
+    now = now or timezone.now()
+    command_statuses = dict(failures)
+    rows = (
+        MTMessageStatus.objects.filter(
+            backend=backend,
+            sequence_number__in=command_statuses,
+            mt_message__status__in=[MTMessage.Status.SENDING, MTMessage.Status.SENT],
+        )
+        .values_list("mt_message_id", "mt_message__attempt_count", "sequence_number")
+        .order_by()
+    )
+    updates = {}
+    for mt_message_id, attempt_count, sequence_number in rows:
+        delay = policy.retry_delay(command_statuses[sequence_number], attempt_count)
+        if delay is None:
+            updates[mt_message_id] = (MTMessage.Status.ERROR, None)
+        elif updates.get(mt_message_id, (None,))[0] != MTMessage.Status.ERROR:
+            # Retry a multipart message once all its failed parts allow it
+            updates[mt_message_id] = (
+                MTMessage.Status.NEW,
+                now + timedelta(seconds=delay),
+            )
+    if not updates:
+        return 0, 0
+    values = ", ".join(["(%s::bigint, %s, %s::timestamptz)"] * len(updates))
+    params = [now]
+    for mt_message_id, (status, next_attempt_time) in updates.items():
+        params.extend([mt_message_id, status, next_attempt_time])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {MTMessage._meta.db_table} AS message
+            SET
+                modify_time = %s,
+                status = retry.status,
+                next_attempt_time = retry.next_attempt_time
+            FROM (VALUES {values}) AS retry (id, status, next_attempt_time)
+            WHERE message.id = retry.id AND message.status IN (%s, %s)
+            """,
+            params + [MTMessage.Status.SENDING, MTMessage.Status.SENT],
+        )
+    retried = sum(1 for status, _ in updates.values() if status == MTMessage.Status.NEW)
+    return retried, len(updates) - retried
+
+
+def receipt_mt_status(receipt: Optional[DeliveryReceipt]) -> Optional[str]:
+    """The MTMessage status implied by a delivery receipt, or None if it
+    reports an intermediate state. Receipts with text that can't be parsed
+    are taken to mean the message was delivered.
+    """
+    if receipt is None or receipt.state == "DELIVRD":
+        return MTMessage.Status.DELIVERED
+    if receipt.state in FINAL_STATES:
+        return MTMessage.Status.UNDELIVERED
+    return None
+
+
+def save_delivery_receipts(
+    backend: Backend,
+    receipts: list[tuple],
+    now: Optional[datetime] = None,
+) -> int:
+    """Saves a batch of `(message_id, delivery_report)` pairs received from
+    `backend` on the matching MTMessageStatus objects, along with the state,
+    error code and done date parsed from each delivery_report. Each pair may
+    be followed by the time the receipt was received, saved as `dlr_at`
+    (`now` if not given). Both tables are updated in a single statement,
+    which finds each MTMessageStatus once via its (backend, message_id) index.
+    Returns the number of message_ids matched to an MTMessageStatus.
+
+    MTMessages are marked as DELIVERED or UNDELIVERED according to the
+    receipts for their segments. An UNDELIVERED message stays so, even if
+    receipts for its other segments report them delivered.
+
+    If the batch holds several receipts for the same message_id, only the
+    last one is saved, since Postgres would apply them in no particular order.
+    """
+    return len(match_delivery_receipts(backend, receipts, now))
+
+
+def match_delivery_receipts(
+    backend: Backend,
+    receipts: list[tuple],
+    now: Optional[datetime] = None,
+) -> set[str]:
+    """Like save_delivery_receipts(), but returns the message_ids that were
+    matched to an MTMessageStatus.
+    """
+    if not receipts:
+        return set()
+    now = now or timezone.now()
+    latest = {receipt[0]: receipt for receipt in receipts}
+    values = ", ".join(
+        ["(%s, %s::bytea, %s::timestamptz, %s, %s::integer, %s::timestamptz, %s)"]
+        * len(latest)
+    )
+    params = [now]
+    for message_id, delivery_report, *dlr_at in latest.values():
+        parsed = parse_delivery_receipt(delivery_report)
+        params.extend(
+            [
+                message_id,
+                delivery_report,
+                dlr_at[0] if dlr_at else now,
+                parsed.state if parsed else "",
+                parsed.error_code if parsed else None,
+                parsed.done_date if parsed else None,
+                receipt_mt_status(parsed),
+            ]
+        )
+    params.extend([backend.pk, now, MTMessage.Status.UNDELIVERED])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH matched AS (
+                UPDATE {MTMessageStatus._meta.db_table} AS status
+                SET
+                    modify_time = %s,
+                    delivery_report = receipt.delivery_report,
+                    dlr_at = receipt.dlr_at,
+                    dlr_state = receipt.dlr_state,
+                    dlr_error_code = receipt.dlr_error_code,
+                    dlr_done_date = receipt.dlr_done_date
+                FROM (VALUES {values}) AS receipt (
+                    message_id,
+                    delivery_report,
+                    dlr_at,
+                    dlr_state,
+                    dlr_error_code,
+                    dlr_done_date,
+                    mt_status
+                )
+                WHERE status.backend_id = %s AND status.message_id = receipt.message_id
+                RETURNING status.mt_message_id, status.message_id, receipt.mt_status
+            ), updated AS (
+                UPDATE {MTMessage._meta.db_table} AS message
+                SET modify_time = %s, status = segments.mt_status
+                FROM (
+                    -- 'undelivered' sorts after 'delivered', so any undelivered
+                    -- segment makes the whole message undelivered
+                    SELECT mt_message_id, MAX(mt_status) AS mt_status
+                    FROM matched
+                    WHERE mt_status IS NOT NULL
+                    GROUP BY mt_message_id
+                ) AS segments
+                WHERE message.id = segments.mt_message_id AND message.status <> %s
+            )
+            SELECT message_id FROM matched
+            """,
+            params,
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+# Latencies reported by get_mt_latency_percentiles(): the column they end
+# at, and the column they're measured from
+LATENCY_STAGES = {
+    "queue": ("status.submitted_at", "mt.create_time"),
+    "resp": ("status.resp_at", "status.submitted_at"),
+    "dlr": ("status.dlr_at", "status.submitted_at"),
+}
+LATENCY_PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def get_mt_latency_percentiles(
+    start: datetime,
+    end: datetime,
+    backend: Optional[Backend] = None,
+) -> dict[str, dict[str, dict[str, Any]]]:
+    """Computes percentiles of the latency of each stage of sending the MT
+    message segments submitted between `start` and `end`, per backend name:
+    from creating the MTMessage to sending its submit_sm ("queue"), and from
+    sending the submit_sm to receiving its submit_sm_resp ("resp") or
+    delivery report ("dlr").
+
+    Returns `{backend_name: {stage: {"count": n, "p50": s, "p95": s, "p99": s}}}`
+    with latencies in seconds, or None for stages with no timestamps yet.
+    """
+    columns = []
+    for end_column, start_column in LATENCY_STAGES.values():
+        latency = f"EXTRACT(EPOCH FROM {end_column} - {start_column})::float8"
+        columns.append(f"COUNT({end_column})")
+        columns.append(
+            "percentile_cont(%s::float8[]) " f"WITHIN GROUP (ORDER BY {latency})"
+        )
+    params = [list(LATENCY_PERCENTILES)] * len(LATENCY_STAGES)
+    params.extend([start, end])
+    backend_filter = ""
+    if backend is not None:
+        backend_filter = "AND status.backend_id = %s"
+        params.append(backend.pk)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT backend.name, {", ".join(columns)}
+            FROM {MTMessageStatus._meta.db_table} AS status
+            JOIN {MTMessage._meta.db_table} AS mt ON mt.id = status.mt_message_id
+            JOIN {Backend._meta.db_table} AS backend ON backend.id = status.backend_id
+            WHERE status.submitted_at >= %s AND status.submitted_at < %s
+                {backend_filter}
+            GROUP BY backend.name
+            ORDER BY backend.name
+            """,
+            params,
+        )
+        rows = cursor.fetchall()
+    results = {}
+    for backend_name, *values in rows:
+        results[backend_name] = stages = {}
+        for i, stage in enumerate(LATENCY_STAGES):
+            count, percentiles = values[2 * i], values[2 * i + 1]
+            stages[stage] = {"count": count}
+            for fraction, value in zip(
+                LATENCY_PERCENTILES, percentiles or [None] * len(LATENCY_PERCENTILES)
+            ):
+                stages[stage][f"p{round(fraction * 100)}"] = value
+    return results
+
+
 def get_mo_messages_to_process(limit: int = 1) -> QuerySet[MOMessage]:
     """Fetches up to `limit` incoming messages while updating their
     status to PROCESSING.
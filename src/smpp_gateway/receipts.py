@@ -0,0 +1,67 @@
+import re
+
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+# The message_state values of delivery receipts, as abbreviated in their
+# text (SMPP 3.4, Appendix B)
+FINAL_STATES = {"DELIVRD", "EXPIRED", "DELETED", "UNDELIV", "REJECTD"}
+INTERMEDIATE_STATES = {"ENROUTE", "ACCEPTD", "UNKNOWN"}
+
+# Fields of the receipt text, which MCs don't always give in the same order
+# or case, or at all. Searching for each with a precompiled pattern is
+# quicker than splitting the text into key:value pairs, and isn't confused
+# by the free-form "text" field, which may hold colons and spaces itself.
+STAT_RE = re.compile(rb"\bstat:([A-Za-z]+)", re.IGNORECASE)
+ERR_RE = re.compile(rb"\berr:(\d+)", re.IGNORECASE)
+DONE_DATE_RE = re.compile(rb"\bdone date:(\d{10}(?:\d\d)?)", re.IGNORECASE)
+
+
+class DeliveryReceipt(NamedTuple):
+    """The parts of a delivery receipt's text that are saved in their own
+    MTMessageStatus columns.
+    """
+
+    state: str
+    error_code: Optional[int]
+    done_date: Optional[datetime]
+
+
+def parse_done_date(value: bytes) -> Optional[datetime]:
+    """Parse a YYMMDDhhmm or YYMMDDhhmmss date. MCs don't say which time zone
+    they use, so it's taken to be UTC.
+    """
+    # Slicing is several times quicker than datetime.strptime()
+    try:
+        return datetime(
+            2000 + int(value[0:2]),
+            int(value[2:4]),
+            int(value[4:6]),
+            int(value[6:8]),
+            int(value[8:10]),
+            int(value[10:12] or 0),
+            tzinfo=timezone.utc,
+        )
+    except ValueError:
+        return None
+
+
+def parse_delivery_receipt(text: Optional[bytes]) -> Optional[DeliveryReceipt]:
+    """Parse the state, error code and done date out of the short_message of
+    a delivery receipt, such as
+    `id:123 sub:001 dlvrd:001 submit date:2101011200 done date:2101011201
+    stat:DELIVRD err:000 text:Hello`. Returns None if there is no known state.
+    """
+    if not text:
+        return None
+    match = STAT_RE.search(text)
+    if match is None:
+        return None
+    state = match.group(1).decode().upper()
+    if state not in FINAL_STATES and state not in INTERMEDIATE_STATES:
+        return None
+    match = ERR_RE.search(text)
+    error_code = int(match.group(1)) if match else None
+    match = DONE_DATE_RE.search(text)
+    done_date = parse_done_date(match.group(1)) if match else None
+    return DeliveryReceipt(state, error_code, done_date)
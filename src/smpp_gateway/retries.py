@@ -0,0 +1,75 @@
+import json
+
+from typing import Optional
+
+import smpplib.consts
+
+# Transient submit_sm_resp errors that are worth retrying by default
+DEFAULT_RETRY_STATUSES = (
+    smpplib.consts.SMPP_ESME_RSYSERR,
+    smpplib.consts.SMPP_ESME_RSUBMITFAIL,
+    smpplib.consts.SMPP_ESME_RX_T_APPN,
+    smpplib.consts.SMPP_ESME_RDELIVERYFAILURE,
+)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff policy for MT messages whose submit_sm_resp reported
+    an error. Messages that failed with one of `statuses` are retried after
+    `base_delay * multiplier ** (attempt_count - 1)` seconds, capped at
+    `max_delay`, until `max_attempts` attempts have been made. Each entry in
+    `statuses` maps a command_status to overrides for any of these settings
+    for that status.
+    """
+
+    SETTINGS = ("max_attempts", "base_delay", "multiplier", "max_delay")
+
+    def __init__(
+        self,
+        statuses: Optional[dict[int, dict]] = None,
+        max_attempts: int = 5,
+        base_delay: float = 30,
+        multiplier: float = 2,
+        max_delay: float = 3600,
+    ):
+        self.defaults = {
+            "max_attempts": max_attempts,
+            "base_delay": base_delay,
+            "multiplier": multiplier,
+            "max_delay": max_delay,
+        }
+        if statuses is None:
+            statuses = {status: {} for status in DEFAULT_RETRY_STATUSES}
+        self.statuses = {}
+        for status, overrides in statuses.items():
+            unknown = set(overrides) - set(self.SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown retry policy settings: {sorted(unknown)}")
+            self.statuses[status] = {**self.defaults, **overrides}
+
+    @classmethod
+    def from_json(cls, value: str) -> "RetryPolicy":
+        """Create a policy from a JSON object such as:
+
+        {"max_attempts": 3, "statuses": {"0x08": {}, "0x45": {"base_delay": 60}}}
+
+        Status codes may be given in decimal or hex. If "statuses" is left out,
+        the DEFAULT_RETRY_STATUSES are retried.
+        """
+        config = json.loads(value or "{}")
+        statuses = config.pop("statuses", None)
+        if statuses is not None:
+            statuses = {int(status, 0): rule for status, rule in statuses.items()}
+        return cls(statuses, **config)
+
+    def retry_delay(self, command_status: int, attempt_count: int) -> Optional[float]:
+        """Seconds to wait before retrying a message that failed with
+        `command_status` after `attempt_count` attempts, or None if it should
+        not be retried.
+        """
+        rule = self.statuses.get(command_status)
+        if rule is None or attempt_count >= rule["max_attempts"]:
+            return None
+        delay = rule["base_delay"] * rule["multiplier"] ** max(attempt_count - 1, 0)
+        return min(delay, rule["max_delay"])
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+
+from typing import Callable, Optional
+
+from django.db import connections
+
+from smpp_gateway.monitoring import HealthchecksIoWorker
+
+logger = logging.getLogger(__name__)
+
+
+class SessionHealth:
+    """
+    Stands in for a HealthchecksIoWorker in one session of a SessionPool,
+    recording when the session was last healthy. The pool's worker is only
+    pinged while every session is healthy, so a failed bind is reported even
+    if the others keep working.
+    """
+
+    def __init__(self, pool: "SessionPool"):
+        self.pool = pool
+        self.last_success_time: Optional[float] = None
+
+    def success_ping(self):
+        self.last_success_time = time.monotonic()
+        self.pool.success_ping()
+
+    def fail_ping(self):
+        self.pool.fail_ping()
+
+
+class SmppSession(threading.Thread):
+    """
+    Thread running one SMPP session. `run_session` is called with the
+    session's SessionHealth, and should connect, bind and listen until the
+    exit signal is received.
+    """
+
+    def __init__(self, name: str, run_session: Callable, health: SessionHealth):
+        super().__init__(name=name, daemon=True)
+        self.run_session = run_session
+        self.health = health
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        logger.info(f"Starting SMPP session {self.name}")
+        try:
+            self.run_session(self.health)
+        except Exception as err:
+            logger.exception(f"SMPP session {self.name} failed")
+            self.error = err
+        finally:
+            # Each session thread has its own Django DB connection
+            connections.close_all()
+
+
+class SessionPool:
+    """
+    Runs several SMPP sessions for the same backend, each in its own thread
+    with its own socket, Postgres connection and health state.
+    Sessions share the MT message queue through get_mt_messages_to_send(),
+    which skips rows another session has locked.
+
+    `sessions` maps the name of each session to the callable that runs it.
+    """
+
+    def __init__(
+        self,
+        sessions: dict[str, Callable],
+        exit_signal_received: Callable[[], bool],
+        hc_worker: Optional[HealthchecksIoWorker] = None,
+        stale_after: float = 60,
+    ):
+        self.exit_signal_received = exit_signal_received
+        self.hc_worker = hc_worker
+        # Seconds after its last success ping that a session is unhealthy
+        self.stale_after = stale_after
+        self.sessions = [
+            SmppSession(name, run_session, SessionHealth(self))
+            for name, run_session in sessions.items()
+        ]
+
+    def is_healthy(self) -> bool:
+        now = time.monotonic()
+        return all(
+            session.is_alive()
+            and session.health.last_success_time is not None
+            and now - session.health.last_success_time < self.stale_after
+            for session in self.sessions
+        )
+
+    def success_ping(self):
+        if self.hc_worker and self.is_healthy():
+            self.hc_worker.success_ping()
+
+    def fail_ping(self):
+        if self.hc_worker:
+            self.hc_worker.fail_ping()
+
+    def run(self):
+        """Start all sessions and wait for them to finish. Returns the
+        sessions that failed.
+        """
+        for session in self.sessions:
+            session.start()
+        running = list(self.sessions)
+        while running:
+            # Join with a timeout so the main thread can handle signals
+            running[0].join(timeout=1)
+            for session in [s for s in running if not s.is_alive()]:
+                running.remove(session)
+                if session.error is not None:
+                    self.fail_ping()
+                elif not self.exit_signal_received():
+                    logger.warning(f"SMPP session {session.name} ended unexpectedly")
+        return [session for session in self.sessions if session.error is not None]
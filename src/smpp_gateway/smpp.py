@@ -1,13 +1,24 @@
 import json
 import logging
 
-from typing import Optional
+from typing import Callable, Optional
 
 from django.db import connection as db_conn
 from rapidsms.models import Backend
 
+from smpp_gateway.async_client import AsyncPgSmppClient
 from smpp_gateway.client import PgSmppClient, PgSmppSequenceGenerator
 from smpp_gateway.monitoring import HealthchecksIoWorker
+from smpp_gateway.prometheus import (
+    MetricsServer,
+    client_collector,
+    queue_collector,
+    start_metrics_server,
+)
+from smpp_gateway.retries import RetryPolicy
+from smpp_gateway.sessions import SessionHealth, SessionPool
+from smpp_gateway.supervisor import Backoff, run_supervised
+from smpp_gateway.utils import set_exit_signals
 
 logger = logging.getLogger(__name__)
 
@@ -25,15 +36,33 @@ def get_smpplib_client(
     hc_check_uuid: str,
     hc_ping_key: str,
     hc_check_slug: str,
+    window_size: int = 10,
+    mt_burst_size: int = 1,
+    dlr_batch_size: int = 100,
+    dlr_batch_delay_ms: int = 100,
+    pending_receipt_max: int = 10000,
+    pending_receipt_ttl: float = 60,
+    resp_batch_size: int = 100,
+    resp_batch_delay_ms: int = 100,
+    sequence_block_size: int = 100,
+    engine: str = "select",
+    exit_signal_received: Optional[Callable[[], bool]] = None,
+    logger_name: Optional[str] = None,
+    send_mt: bool = True,
+    adaptive_rate: bool = True,
+    retry_policy: Optional[RetryPolicy] = None,
+    lease_seconds: float = 300,
+    segment_cache_size: int = 1000,
+    enquire_link_interval: Optional[float] = None,
+    queue_poll_interval: Optional[float] = None,
+    stats_interval: float = 60,
 ) -> PgSmppClient:
-    sequence_generator = PgSmppSequenceGenerator(db_conn, backend.name)
-    if hc_check_uuid:
-        hc_worker = HealthchecksIoWorker(uuid=hc_check_uuid)
-    elif hc_ping_key and hc_check_slug:
-        hc_worker = HealthchecksIoWorker(ping_key=hc_ping_key, slug=hc_check_slug)
-    else:
-        hc_worker = None
-    client = PgSmppClient(
+    sequence_generator = PgSmppSequenceGenerator(
+        db_conn, backend.name, block_size=sequence_block_size
+    )
+    hc_worker = get_hc_worker(hc_check_uuid, hc_ping_key, hc_check_slug)
+    client_class = AsyncPgSmppClient if engine == "asyncio" else PgSmppClient
+    client = client_class(
         notify_mo_channel,
         backend,
         hc_worker,
@@ -47,30 +76,67 @@ def get_smpplib_client(
         allow_unknown_opt_params=True,
         sequence_generator=sequence_generator,
         timeout=socket_timeout,
+        logger_name=logger_name,
+        # Keyword-only arguments to PgSmppClient:
+        window_size=window_size,
+        mt_burst_size=mt_burst_size,
+        dlr_batch_size=dlr_batch_size,
+        dlr_batch_delay=dlr_batch_delay_ms / 1000,
+        pending_receipt_max=pending_receipt_max,
+        pending_receipt_ttl=pending_receipt_ttl,
+        resp_batch_size=resp_batch_size,
+        resp_batch_delay=resp_batch_delay_ms / 1000,
+        exit_signal_received=exit_signal_received,
+        send_mt=send_mt,
+        adaptive_rate=adaptive_rate,
+        retry_policy=retry_policy,
+        lease_seconds=lease_seconds,
+        segment_cache_size=segment_cache_size,
+        enquire_link_interval=enquire_link_interval,
+        queue_poll_interval=queue_poll_interval,
+        stats_interval=stats_interval,
     )
     return client
 
 
+def get_hc_worker(
+    hc_check_uuid: str, hc_ping_key: str, hc_check_slug: str
+) -> Optional[HealthchecksIoWorker]:
+    if hc_check_uuid:
+        return HealthchecksIoWorker(uuid=hc_check_uuid)
+    elif hc_ping_key and hc_check_slug:
+        return HealthchecksIoWorker(ping_key=hc_ping_key, slug=hc_check_slug)
+    return None
+
+
 def smpplib_main_loop(
     client: PgSmppClient,
     system_id: str,
     password: str,
     interface_version: Optional[str],
     system_type: Optional[str],
+    bind_command: str = "bind_transceiver",
+    reconnect: bool = False,
 ):
+    def bind():
+        getattr(client, bind_command)(
+            system_id=system_id,
+            password=password,
+            interface_version=interface_version,
+            system_type=system_type,
+        )
+
+    if reconnect:
+        return run_supervised(client, bind, Backoff())
     client.connect()
-    client.bind_transceiver(
-        system_id=system_id,
-        password=password,
-        interface_version=interface_version,
-        system_type=system_type,
-    )
+    bind()
     client.listen()
 
 
-def start_smpp_client(options):
-    backend, _ = Backend.objects.get_or_create(name=options["backend_name"])
-    client = get_smpplib_client(
+def get_client_from_options(
+    options, backend: Backend, hc_enabled: bool = True, **kwargs
+) -> PgSmppClient:
+    return get_smpplib_client(
         options["host"],
         options["port"],
         options["notify_mo_channel"],
@@ -80,14 +146,111 @@ def start_smpp_client(options):
         options["mt_messages_per_second"],
         options["socket_timeout"],
         options["event_loop_timeout"],
-        options["hc_check_uuid"],
-        options["hc_ping_key"],
-        options["hc_check_slug"],
+        options["hc_check_uuid"] if hc_enabled else "",
+        options["hc_ping_key"] if hc_enabled else "",
+        options["hc_check_slug"] if hc_enabled else "",
+        window_size=options["window_size"],
+        mt_burst_size=options["mt_burst_size"],
+        dlr_batch_size=options["dlr_batch_size"],
+        dlr_batch_delay_ms=options["dlr_batch_delay_ms"],
+        pending_receipt_max=options["pending_receipt_max"],
+        pending_receipt_ttl=options["pending_receipt_ttl"],
+        resp_batch_size=options["resp_batch_size"],
+        resp_batch_delay_ms=options["resp_batch_delay_ms"],
+        sequence_block_size=options["sequence_block_size"],
+        engine=options["engine"],
+        adaptive_rate=options["adaptive_rate"],
+        retry_policy=RetryPolicy.from_json(options["retry_policy"]),
+        lease_seconds=options["lease_seconds"],
+        segment_cache_size=options["segment_cache_size"],
+        enquire_link_interval=options["enquire_link_interval"],
+        queue_poll_interval=options["queue_poll_interval"],
+        stats_interval=options["stats_interval"],
+        **kwargs,
     )
+
+
+def start_smpp_client(options):
+    backend, _ = Backend.objects.get_or_create(name=options["backend_name"])
+    metrics_server = start_metrics_server(
+        options["metrics_address"], options["metrics_port"], [queue_collector()]
+    )
+    if options["binds"] > 1 or options["bind_mode"] == "split":
+        return start_smpp_sessions(options, backend, metrics_server)
+    client = get_client_from_options(options, backend)
+    if metrics_server:
+        metrics_server.add_collector(client_collector(client))
     smpplib_main_loop(
         client,
         options["system_id"],
         options["password"],
         options["interface_version"],
         options["system_type"],
+        reconnect=options["reconnect"],
+    )
+
+
+def start_smpp_sessions(
+    options, backend: Backend, metrics_server: Optional[MetricsServer] = None
+):
+    """Run `options["binds"]` SMPP sessions for `backend`, each in its own
+    thread. With the "split" bind mode, each session is a transmitter that
+    only sends MT messages, paired with a receiver that only receives MO
+    messages and delivery receipts.
+    """
+    exit_signal_received = set_exit_signals()
+
+    def session_runner(name: str, bind_command: str, send_mt: bool = True):
+        def run_session(health: SessionHealth):
+            client = get_client_from_options(
+                options,
+                backend,
+                hc_enabled=False,
+                exit_signal_received=exit_signal_received,
+                logger_name=f"smpp.Client.{backend.name}.{name}",
+                send_mt=send_mt,
+            )
+            client.hc_worker = health
+            if metrics_server:
+                metrics_server.add_collector(client_collector(client, name))
+            smpplib_main_loop(
+                client,
+                options["system_id"],
+                options["password"],
+                options["interface_version"],
+                options["system_type"],
+                bind_command=bind_command,
+                reconnect=options["reconnect"],
+            )
+
+        return run_session
+
+    sessions = {}
+    for i in range(options["binds"]):
+        if options["bind_mode"] == "split":
+            sessions[f"tx{i}"] = session_runner(f"tx{i}", "bind_transmitter")
+            sessions[f"rx{i}"] = session_runner(
+                f"rx{i}", "bind_receiver", send_mt=False
+            )
+        else:
+            sessions[f"bind{i}"] = session_runner(f"bind{i}", "bind_transceiver")
+    # A healthy session pings at least once per keepalive or queue poll, both
+    # of which default to the event loop timeout
+    ping_interval = max(
+        options["enquire_link_interval"] or options["event_loop_timeout"],
+        options["queue_poll_interval"] or options["event_loop_timeout"],
+    )
+    pool = SessionPool(
+        sessions,
+        exit_signal_received,
+        hc_worker=get_hc_worker(
+            options["hc_check_uuid"], options["hc_ping_key"], options["hc_check_slug"]
+        ),
+        stale_after=3 * ping_interval,
     )
+    failed = pool.run()
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(sessions)} SMPP sessions failed: "
+            + ", ".join(session.name for session in failed)
+        )
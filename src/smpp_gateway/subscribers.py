@@ -1,3 +1,4 @@
+import collections
 import logging
 import select
 
@@ -5,12 +6,17 @@ from django.db.models import QuerySet
 from psycopg2.extensions import Notify  # noqa F401
 from rapidsms.router import lookup_connections, receive
 
+from smpp_gateway.metrics import PhaseTimers
 from smpp_gateway.models import MOMessage
 from smpp_gateway.queries import get_mo_messages_to_process, pg_listen
 from smpp_gateway.utils import set_exit_signals
 
 logger = logging.getLogger(__name__)
 
+# Running totals and timings of MO messages handled by this process
+counters = collections.Counter()
+timings = PhaseTimers()
+
 
 def handle_mo_messages(smses: QuerySet[MOMessage]):
     for sms in smses:
@@ -29,9 +35,12 @@ def handle_mo_messages(smses: QuerySet[MOMessage]):
                 status=MOMessage.Status.ERROR,
                 error=str(err),
             )
+            counters["mo_message_error"] += 1
         else:
-            receive(decoded_short_message, connection, fields=fields)
+            with timings.time("receive"):
+                receive(decoded_short_message, connection, fields=fields)
             MOMessage.objects.filter(pk=sms.pk).update(status=MOMessage.Status.DONE)
+            counters["mo_message_done"] += 1
 
 
 def listen_mo_messages(channel: str):
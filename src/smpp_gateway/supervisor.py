@@ -0,0 +1,81 @@
+import logging
+import random
+import time
+
+from typing import Callable
+
+import smpplib.exceptions
+
+from smpp_gateway.client import PgSmppClient
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the client reconnects, rather than exiting
+RECONNECT_ERRORS = (
+    smpplib.exceptions.ConnectionError,
+    smpplib.exceptions.PDUError,
+    OSError,
+)
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: each delay is a random time up to
+    `base * factor ** failures`, capped at `maximum` seconds.
+    """
+
+    def __init__(
+        self,
+        base: float = 1,
+        maximum: float = 60,
+        factor: float = 2,
+        random=random.random,
+    ):
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.random = random
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.base * self.factor**self.failures, self.maximum)
+        self.failures += 1
+        return delay * self.random()
+
+    def reset(self):
+        self.failures = 0
+
+
+def run_supervised(
+    client: PgSmppClient,
+    bind: Callable[[], None],
+    backoff: Backoff,
+    sleep=time.sleep,
+):
+    """
+    Connect, bind by calling `bind`, and listen until the exit signal is
+    received. If the connection drops or can't be made, reconcile the
+    messages that were in flight and try again after a backoff. The client,
+    and so its Postgres LISTEN connection, is kept throughout.
+    """
+    while not client.exit_signal_received():
+        try:
+            client.connect()
+            bind()
+            backoff.reset()
+            client.listen()
+            return
+        except RECONNECT_ERRORS:
+            logger.exception(f"SMPP session for backend={client.backend} failed")
+        client.counters["reconnects"] += 1
+        client.close_connection()
+        client.reconcile_in_flight()
+        delay = backoff.next_delay()
+        logger.info(f"Reconnecting in {delay:.1f} seconds")
+        # Wake up regularly to check for the exit signal
+        deadline = time.monotonic() + delay
+        while not client.exit_signal_received():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sleep(min(remaining, 0.5))
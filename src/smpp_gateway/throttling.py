@@ -0,0 +1,111 @@
+import time
+
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are added continuously at `rate` per
+    second, up to a maximum of `burst` tokens, and each PDU sent consumes one.
+    A `burst` of 1 spreads PDUs evenly at exactly `rate` per second.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last_refill = clock()
+
+    def refill(self):
+        now = self.clock()
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def consume(self, tokens: int = 1) -> bool:
+        """Take `tokens` from the bucket if available, returning whether it
+        was possible.
+        """
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def time_until_available(self, tokens: int = 1) -> float:
+        """Seconds until `tokens` will be available in the bucket."""
+        self.refill()
+        return max(tokens - self.tokens, 0) / self.rate
+
+
+class AimdRateController:
+    """
+    Additive-increase/multiplicative-decrease controller for the rate of a
+    TokenBucket. Each throttling error multiplies the rate by
+    `decrease_factor`, at most once per `decrease_interval` seconds so that a
+    window full of throttled PDUs only counts once. The rate then recovers by
+    `increase_step` per `increase_interval` seconds without throttling, up to
+    `max_rate`.
+    """
+
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        max_rate: float,
+        min_rate: float = 1,
+        decrease_factor: float = 0.5,
+        decrease_interval: float = 1,
+        increase_step: Optional[float] = None,
+        increase_interval: float = 1,
+        clock=time.monotonic,
+    ):
+        self.bucket = bucket
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        # By default, recover from a single decrease in about 10 intervals
+        self.increase_step = increase_step or max(max_rate / 20, 1)
+        self.increase_interval = increase_interval
+        self.clock = clock
+        self.last_decrease_time = None
+        self.last_change_time = clock()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def set_rate(self, rate: float):
+        # Tokens added so far are counted at the old rate
+        self.bucket.refill()
+        self.bucket.rate = rate
+        self.last_change_time = self.clock()
+
+    def throttled(self) -> bool:
+        """Reduce the rate after a throttling error, returning whether it
+        changed.
+        """
+        now = self.clock()
+        if (
+            self.last_decrease_time is not None
+            and now - self.last_decrease_time < self.decrease_interval
+        ):
+            return False
+        self.last_decrease_time = now
+        rate = max(self.rate * self.decrease_factor, self.min_rate)
+        if rate == self.rate:
+            return False
+        self.set_rate(rate)
+        return True
+
+    def succeeded(self) -> bool:
+        """Increase the rate after a successful submission if it has not
+        changed for `increase_interval` seconds, returning whether it changed.
+        """
+        if self.rate >= self.max_rate:
+            return False
+        if self.clock() - self.last_change_time < self.increase_interval:
+            return False
+        self.set_rate(min(self.rate + self.increase_step, self.max_rate))
+        return True
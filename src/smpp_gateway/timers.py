@@ -0,0 +1,46 @@
+import heapq
+import itertools
+import time
+
+from typing import Callable, Optional
+
+
+class Timers:
+    """
+    Repeating timers for a select() loop, kept in a heap ordered by when
+    each is next due. The loop waits at most time_until_next() seconds, then
+    calls run_due(). Each timer is rescheduled `interval` seconds after its
+    callback returns, so a slow callback doesn't make it fire repeatedly to
+    catch up.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap: list[tuple[float, int, float, Callable[[], None]]] = []
+        # Breaks ties between timers due at the same time
+        self.counter = itertools.count()
+
+    def add(self, interval: float, callback: Callable[[], None]):
+        """Call `callback` every `interval` seconds, starting `interval`
+        seconds from now.
+        """
+        self.schedule(self.clock() + interval, interval, callback)
+
+    def schedule(self, due: float, interval: float, callback: Callable[[], None]):
+        heapq.heappush(self.heap, (due, next(self.counter), interval, callback))
+
+    def time_until_next(self) -> Optional[float]:
+        """Seconds until the next timer is due, or None if there are none."""
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - self.clock(), 0)
+
+    def run_due(self):
+        """Call the callback of every timer that is due."""
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, interval, callback = heapq.heappop(self.heap)
+            try:
+                callback()
+            finally:
+                self.schedule(self.clock() + interval, interval, callback)
@@ -0,0 +1,376 @@
+import socket
+import struct
+import threading
+
+from unittest import mock
+
+import pytest
+import smpplib.client
+import smpplib.consts
+import smpplib.smpp
+
+from smpp_gateway.async_client import AsyncPgSmppClient
+from smpp_gateway.models import MOMessage, MTMessage, MTMessageStatus
+from smpp_gateway.smpp import get_smpplib_client
+from tests.factories import BackendFactory, MTMessageFactory
+
+
+class FakeSMSC:
+    """The SMSC end of a socketpair, which makes and parses PDUs with its own
+    smpplib client (and sequence numbers).
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        # Fail rather than hang if the client under test stops responding
+        self.sock.settimeout(10)
+        self.client = smpplib.client.Client(
+            "127.0.0.1", 0, allow_unknown_opt_params=True
+        )
+        self.client._socket.close()
+
+    def make_pdu(self, command: str, **kwargs):
+        return smpplib.smpp.make_pdu(command, client=self.client, **kwargs)
+
+    def send_pdu(self, pdu):
+        self.sock.sendall(pdu.generate())
+
+    def read_pdu(self):
+        raw_pdu = self.sock.recv(4)
+        length = struct.unpack(">L", raw_pdu)[0]
+        while len(raw_pdu) < length:
+            raw_pdu += self.sock.recv(length - len(raw_pdu))
+        return smpplib.smpp.parse_pdu(
+            raw_pdu, client=self.client, allow_unknown_opt_params=True
+        )
+
+    def read_until(self, command: str):
+        while True:
+            pdu = self.read_pdu()
+            if pdu.command == command:
+                return pdu
+
+
+@pytest.mark.django_db(transaction=True)
+def test_asyncio_engine():
+    """The asyncio engine sends queued messages, saves their responses and
+    delivery receipts, saves MO messages, and acknowledges the receipts and
+    MO messages once saved.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        resp_batch_size=1,
+        dlr_batch_size=1,
+        engine="asyncio",
+    )
+    assert isinstance(client, AsyncPgSmppClient)
+    message = MTMessageFactory(backend=backend, params={"destination_addr": "123"})
+    client._socket.close()
+    client._socket, smsc_socket = socket.socketpair()
+    client.state = smpplib.consts.SMPP_CLIENT_STATE_BOUND_TRX
+    smsc = FakeSMSC(smsc_socket)
+    exit_signal = threading.Event()
+    client.exit_signal_received = exit_signal.is_set
+    acks = []
+
+    def smsc_session():
+        try:
+            submit_sm = smsc.read_until("submit_sm")
+            resp = smsc.make_pdu("submit_sm_resp", message_id="abc")
+            resp.sequence = submit_sm.sequence
+            smsc.send_pdu(resp)
+            for sequence, extra_params in [
+                (7, {"receipted_message_id": "abc"}),
+                (8, {"source_addr": "456"}),
+            ]:
+                deliver_sm = smsc.make_pdu(
+                    "deliver_sm", short_message=b"hi", **extra_params
+                )
+                deliver_sm.sequence = sequence
+                smsc.send_pdu(deliver_sm)
+                acks.append(smsc.read_until("deliver_sm_resp").sequence)
+        finally:
+            # Let the client exit even if the session failed
+            exit_signal.set()
+        unbind = smsc.read_until("unbind")
+        unbind_resp = smsc.make_pdu("unbind_resp")
+        unbind_resp.sequence = unbind.sequence
+        smsc.send_pdu(unbind_resp)
+
+    smsc_thread = threading.Thread(target=smsc_session, daemon=True)
+    smsc_thread.start()
+    with mock.patch.object(client, "timeout", 2):
+        client.listen()
+    smsc_thread.join(timeout=10)
+    smsc_socket.close()
+
+    assert not smsc_thread.is_alive()
+    assert acks == [7, 8]
+    message.refresh_from_db()
+    assert message.status == MTMessage.Status.DELIVERED
+    status = MTMessageStatus.objects.get(mt_message=message)
+    assert status.message_id == "abc"
+    assert status.delivery_report.tobytes() == b"hi"
+    assert MOMessage.objects.get().short_message.tobytes() == b"hi"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_asyncio_engine_finishes_batch_on_exit():
+    """A batch being sent when the exit signal arrives is sent in full, so no
+    messages are left SENDING.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        2,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        engine="asyncio",
+    )
+    messages = MTMessageFactory.create_batch(
+        3, backend=backend, params={"destination_addr": "123"}
+    )
+    client._socket.close()
+    client._socket, smsc_socket = socket.socketpair()
+    client.state = smpplib.consts.SMPP_CLIENT_STATE_BOUND_TRX
+    smsc = FakeSMSC(smsc_socket)
+    exit_signal = threading.Event()
+    client.exit_signal_received = exit_signal.is_set
+    submitted = []
+
+    def smsc_session():
+        while True:
+            try:
+                pdu = smsc.read_pdu()
+            finally:
+                # Exit as soon as the first submit_sm has been read
+                exit_signal.set()
+            if pdu.command == "submit_sm":
+                submitted.append(pdu.sequence)
+                resp = smsc.make_pdu("submit_sm_resp", message_id=f"id{len(submitted)}")
+            elif pdu.command == "unbind":
+                resp = smsc.make_pdu("unbind_resp")
+            else:
+                continue
+            resp.sequence = pdu.sequence
+            smsc.send_pdu(resp)
+            if pdu.command == "unbind":
+                return
+
+    smsc_thread = threading.Thread(target=smsc_session, daemon=True)
+    smsc_thread.start()
+    with mock.patch.object(client, "timeout", 2):
+        client.listen()
+    smsc_thread.join(timeout=10)
+    smsc_socket.close()
+
+    assert not smsc_thread.is_alive()
+    assert len(submitted) == 3
+    for message in messages:
+        message.refresh_from_db()
+        assert message.status == MTMessage.Status.SENT
+
+
+@pytest.mark.django_db(transaction=True)
+def test_asyncio_engine_without_mt_messages():
+    """On an idle link, the asyncio engine sends enquire_links and unbinds on
+    exit without querying the DB from the event loop.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        enquire_link_interval=0.1,
+        engine="asyncio",
+    )
+    client._socket.close()
+    client._socket, smsc_socket = socket.socketpair()
+    client.state = smpplib.consts.SMPP_CLIENT_STATE_BOUND_TRX
+    smsc = FakeSMSC(smsc_socket)
+    exit_signal = threading.Event()
+    client.exit_signal_received = exit_signal.is_set
+    commands = []
+
+    def smsc_session():
+        try:
+            enquire_link = smsc.read_until("enquire_link")
+            commands.append(enquire_link.command)
+            resp = smsc.make_pdu("enquire_link_resp")
+            resp.sequence = enquire_link.sequence
+            smsc.send_pdu(resp)
+        finally:
+            exit_signal.set()
+        unbind = smsc.read_until("unbind")
+        commands.append(unbind.command)
+        unbind_resp = smsc.make_pdu("unbind_resp")
+        unbind_resp.sequence = unbind.sequence
+        smsc.send_pdu(unbind_resp)
+
+    smsc_thread = threading.Thread(target=smsc_session, daemon=True)
+    smsc_thread.start()
+    with mock.patch.object(client, "timeout", 2):
+        client.listen()
+    smsc_thread.join(timeout=10)
+    smsc_socket.close()
+
+    assert not smsc_thread.is_alive()
+    assert commands == ["enquire_link", "unbind"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_asyncio_engine_default_batch_settings():
+    """With the default batch sizes, a lone submit_sm_resp and delivery
+    receipt are saved, and the receipt acknowledged, after the batch delay
+    rather than waiting for more PDUs.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        engine="asyncio",
+    )
+    message = MTMessageFactory(backend=backend, params={"destination_addr": "123"})
+    client._socket.close()
+    client._socket, smsc_socket = socket.socketpair()
+    client.state = smpplib.consts.SMPP_CLIENT_STATE_BOUND_TRX
+    smsc = FakeSMSC(smsc_socket)
+    smsc.sock.settimeout(3)
+    exit_signal = threading.Event()
+    client.exit_signal_received = exit_signal.is_set
+    acks = []
+
+    def smsc_session():
+        try:
+            submit_sm = smsc.read_until("submit_sm")
+            resp = smsc.make_pdu("submit_sm_resp", message_id="abc")
+            resp.sequence = submit_sm.sequence
+            smsc.send_pdu(resp)
+            deliver_sm = smsc.make_pdu(
+                "deliver_sm", short_message=b"hi", receipted_message_id="abc"
+            )
+            deliver_sm.sequence = 7
+            smsc.send_pdu(deliver_sm)
+            acks.append(smsc.read_until("deliver_sm_resp").sequence)
+        finally:
+            exit_signal.set()
+        unbind = smsc.read_until("unbind")
+        unbind_resp = smsc.make_pdu("unbind_resp")
+        unbind_resp.sequence = unbind.sequence
+        smsc.send_pdu(unbind_resp)
+
+    smsc_thread = threading.Thread(target=smsc_session, daemon=True)
+    smsc_thread.start()
+    with mock.patch.object(client, "timeout", 2):
+        client.listen()
+    smsc_thread.join(timeout=10)
+    smsc_socket.close()
+
+    assert acks == [7]
+    status = MTMessageStatus.objects.get(mt_message=message)
+    assert status.message_id == "abc"
+    assert status.delivery_report.tobytes() == b"hi"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_asyncio_engine_handles_pdus_read_with_bind_resp():
+    """PDUs read into the buffer while binding are handled before the
+    asyncio tasks start, including one read only in part.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        engine="asyncio",
+    )
+    client._socket.close()
+    client._socket, smsc_socket = socket.socketpair()
+    client.state = smpplib.consts.SMPP_CLIENT_STATE_BOUND_TRX
+    smsc = FakeSMSC(smsc_socket)
+    exit_signal = threading.Event()
+    client.exit_signal_received = exit_signal.is_set
+    raw_pdus = b""
+    for sequence in (7, 8):
+        deliver_sm = smsc.make_pdu("deliver_sm", short_message=b"hi", source_addr="1")
+        deliver_sm.sequence = sequence
+        raw_pdus += deliver_sm.generate()
+    # As if read along with the bind_resp, with the rest still to come
+    smsc.sock.sendall(raw_pdus[:-5])
+    client.pdu_reader.read_from(client._socket)
+    smsc.sock.sendall(raw_pdus[-5:])
+    acks = []
+
+    def smsc_session():
+        # Give up on the acks, rather than hang, if the PDUs aren't handled
+        smsc.sock.settimeout(3)
+        try:
+            for _ in range(2):
+                acks.append(smsc.read_until("deliver_sm_resp").sequence)
+        except socket.timeout:
+            pass
+        finally:
+            exit_signal.set()
+        smsc.sock.settimeout(10)
+        unbind = smsc.read_until("unbind")
+        unbind_resp = smsc.make_pdu("unbind_resp")
+        unbind_resp.sequence = unbind.sequence
+        smsc.send_pdu(unbind_resp)
+
+    smsc_thread = threading.Thread(target=smsc_session, daemon=True)
+    smsc_thread.start()
+    with mock.patch.object(client, "timeout", 2):
+        client.listen()
+    smsc_thread.join(timeout=10)
+    smsc_socket.close()
+
+    assert acks == [7, 8]
+    assert MOMessage.objects.count() == 2
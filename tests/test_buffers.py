@@ -0,0 +1,82 @@
+from smpp_gateway.buffers import BatchBuffer, PendingReceiptBuffer
+from tests.test_throttling import FakeClock
+
+
+class TestBatchBuffer:
+    def test_due_when_full(self):
+        """The buffer is due as soon as it holds `max_size` items."""
+        buffer = BatchBuffer(max_size=2, max_delay=1, clock=FakeClock())
+        assert buffer.time_until_due() is None
+
+        buffer.append("a")
+        assert not buffer.is_due()
+        buffer.append("b")
+        assert buffer.is_due()
+
+    def test_due_after_delay(self):
+        """The buffer is due once its oldest item has waited `max_delay`."""
+        clock = FakeClock()
+        buffer = BatchBuffer(max_size=10, max_delay=1, clock=clock)
+        buffer.append("a")
+        clock.now += 0.5
+        buffer.append("b")
+
+        assert buffer.time_until_due() == 0.5
+        clock.now += 0.5
+        assert buffer.is_due()
+        assert buffer.drain() == ["a", "b"]
+        assert buffer.time_until_due() is None
+
+
+class TestPendingReceiptBuffer:
+    def test_expire(self):
+        """Receipts are removed and counted once they've been held for `ttl`."""
+        clock = FakeClock()
+        buffer = PendingReceiptBuffer(max_size=10, ttl=1, clock=clock)
+        buffer.add(["a"])
+        clock.now += 0.5
+        buffer.add(["b"])
+
+        assert buffer.expire() == []
+        clock.now += 0.5
+        assert buffer.expire() == ["a"]
+        assert (len(buffer), buffer.expired) == (1, 1)
+
+    def test_drop_oldest(self):
+        """The oldest receipts are dropped to keep at most `max_size`."""
+        buffer = PendingReceiptBuffer(max_size=2, ttl=1, clock=FakeClock())
+        buffer.add(["a", "b", "c"])
+
+        assert buffer.dropped == 1
+        assert buffer.drain()[0] == ["b", "c"]
+
+    def test_add_keeps_expiry_times(self):
+        """Drained receipts added back expire when they would have."""
+        clock = FakeClock()
+        buffer = PendingReceiptBuffer(max_size=10, ttl=1, clock=clock)
+        buffer.add(["a"])
+        clock.now += 0.5
+        buffer.add(*buffer.drain())
+
+        clock.now += 0.5
+        assert buffer.expire() == ["a"]
+
+    def test_due_after_retry_interval(self):
+        """Held receipts are due to be matched again `retry_interval` after
+        they were first held, and again after being added back.
+        """
+        clock = FakeClock()
+        buffer = PendingReceiptBuffer(
+            max_size=10, ttl=10, retry_interval=1, clock=clock
+        )
+        assert buffer.time_until_due() is None
+
+        buffer.add(["a"])
+        clock.now += 0.5
+        buffer.add(["b"])
+        assert buffer.time_until_due() == 0.5
+        clock.now += 0.5
+        assert buffer.is_due()
+
+        buffer.add(*buffer.drain())
+        assert buffer.time_until_due() == 1
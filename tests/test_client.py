@@ -1,16 +1,100 @@
+import collections
+import logging
+import select
+import socket
+import time
+
 from unittest import mock
 
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from smpplib import consts as smpplib_consts
+from smpplib import smpp
 from smpplib.command import DeliverSM, SubmitSMResp
 
-from smpp_gateway.models import MOMessage, MTMessage
-from smpp_gateway.queries import pg_listen
+from smpp_gateway.client import PgSmppSequenceGenerator
+from smpp_gateway.encoding import SegmentCache, new_reference
+from smpp_gateway.models import MOMessage, MTMessage, MTMessageStatus
+from smpp_gateway.queries import mt_notify_payload, pg_listen, pg_notify
 from smpp_gateway.smpp import PgSmppClient, get_smpplib_client
+from smpp_gateway.throttling import TokenBucket
+from smpp_gateway.utils import decoded_params
 from tests.factories import BackendFactory, MTMessageFactory, MTMessageStatusFactory
 
 
+@pytest.mark.django_db(transaction=True)
+class TestPgSmppSequenceGenerator:
+    def test_block_served_from_memory(self):
+        """Only one query is needed per block of sequence numbers."""
+        generator = PgSmppSequenceGenerator(connection, "seq_test_1", block_size=10)
+
+        with CaptureQueriesContext(connection) as ctx:
+            sequences = [generator.next_sequence() for _ in range(11)]
+
+        assert len(ctx.captured_queries) == 2
+        assert sequences == list(range(sequences[0], sequences[0] + 11))
+        assert generator.sequence == sequences[-1]
+
+    def test_unique_across_clients_and_restarts(self):
+        """Concurrent and restarted generators never hand out the same number."""
+        generator_1 = PgSmppSequenceGenerator(connection, "seq_test_2", block_size=5)
+        generator_2 = PgSmppSequenceGenerator(connection, "seq_test_2", block_size=5)
+        sequences = []
+        for _ in range(7):
+            sequences.append(generator_1.next_sequence())
+            sequences.append(generator_2.next_sequence())
+        restarted = PgSmppSequenceGenerator(connection, "seq_test_2", block_size=5)
+        sequences.append(restarted.next_sequence())
+
+        assert len(set(sequences)) == len(sequences)
+
+    def test_unique_across_block_sizes(self):
+        """A generator restarted with a smaller block size never hands out
+        numbers from a block still being used by another generator.
+        """
+        generator_1 = PgSmppSequenceGenerator(connection, "seq_test_4", block_size=100)
+        sequences = [generator_1.next_sequence() for _ in range(50)]
+        generator_2 = PgSmppSequenceGenerator(connection, "seq_test_4", block_size=10)
+        sequences.extend(generator_2.next_sequence() for _ in range(20))
+        sequences.extend(generator_1.next_sequence() for _ in range(50))
+
+        assert len(set(sequences)) == len(sequences)
+
+    def test_reserve_block(self):
+        """Blocks can be reserved ahead of time."""
+        generator = PgSmppSequenceGenerator(connection, "seq_test_5", block_size=3)
+        assert generator.available == 0
+
+        generator.reserve_block()
+        generator.next_sequence()
+        generator.reserve_block()
+
+        assert generator.available == 5
+
+    def test_cycle(self):
+        """The sequence never exceeds MAX_SEQUENCE, and cycles back to the start."""
+        generator = PgSmppSequenceGenerator(connection, "seq_test_3", block_size=10)
+        max_sequence = generator.MAX_SEQUENCE
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval('smpp_gateway_sequence_seq_test_3', %s)",
+                [max_sequence - 4],
+            )
+
+        sequences = [generator.next_sequence() for _ in range(5)]
+
+        assert sequences == [
+            max_sequence - 3,
+            max_sequence - 2,
+            max_sequence - 1,
+            max_sequence,
+            1,
+        ]
+
+
 @pytest.mark.django_db(transaction=True)
 class TestMessageReceivedHandler:
     def test_received_mo_message(self):
@@ -166,6 +250,7 @@ def test_message_sent_handler():
     pdu.message_id = "qwerty"
 
     client.message_sent_handler(pdu)
+    client.flush_submit_sm_resps()
 
     outbound_msg_status.refresh_from_db()
 
@@ -173,6 +258,48 @@ def test_message_sent_handler():
     assert outbound_msg_status.message_id == "qwerty"
 
 
+@pytest.mark.django_db(transaction=True)
+def test_message_sent_handler_batches_responses():
+    """Responses are saved in batches, and responses without an
+    MTMessageStatus are counted.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        resp_batch_size=3,
+    )
+    statuses = MTMessageStatusFactory.create_batch(
+        2, mt_message__backend=backend, command_status=None
+    )
+    sequence_numbers = [status.sequence_number for status in statuses] + [999999]
+
+    for i, sequence_number in enumerate(sequence_numbers):
+        pdu = SubmitSMResp("submit_sm_resp")
+        pdu.sequence = sequence_number
+        pdu.message_id = f"id{i}"
+        client.message_sent_handler(pdu)
+        if i == 0:
+            statuses[0].refresh_from_db()
+            assert statuses[0].command_status is None
+
+    for i, status in enumerate(statuses):
+        status.refresh_from_db()
+        assert status.command_status == smpplib_consts.SMPP_ESME_ROK
+        assert status.message_id == f"id{i}"
+    assert client.counters["submit_sm_resp_unmatched"] == 1
+
+
 @pytest.mark.django_db(transaction=True)
 @mock.patch.object(PgSmppClient, "send_message", return_value=mock.Mock(sequence=1))
 class TestSetPriorityFlag:
@@ -268,3 +395,1034 @@ class TestSetPriorityFlag:
 
         mock_send_message.assert_called_once()
         assert mock_send_message.call_args.kwargs["priority_flag"] == priority
+
+
+@pytest.mark.django_db(transaction=True)
+class TestWindow:
+    def get_client(self, window_size):
+        return get_smpplib_client(
+            "127.0.0.1",
+            8000,
+            "notify_mo_channel",
+            BackendFactory(),
+            {},  # submit_sm_params
+            False,  # set_priority_flag
+            20,  # mt_messages_per_second
+            30,  # socket_timeout
+            5,  # event_loop_timeout
+            "",  # hc_check_uuid
+            "",  # hc_ping_key
+            "",  # hc_check_slug
+            window_size=window_size,
+        )
+
+    @mock.patch("smpplib.client.Client.send_message")
+    def test_sent_pdus_are_tracked_until_response(self, mock_send_message):
+        """Each submit_sm is tracked as in flight until its submit_sm_resp arrives."""
+        client = self.get_client(window_size=10)
+        mock_send_message.return_value = mock.Mock(sequence=1)
+        client.send_message(short_message=b"hi")
+        assert list(client.in_flight) == [1]
+
+        pdu = SubmitSMResp("submit_sm_resp")
+        pdu.sequence = 1
+        pdu.message_id = "qwerty"
+        client.message_sent_handler(pdu)
+
+        assert client.in_flight == {}
+
+    def test_full_window_reads_responses(self):
+        """When the window is full, incoming PDUs are read until there is room."""
+        client = self.get_client(window_size=2)
+        client.in_flight = {1: time.monotonic(), 2: time.monotonic()}
+
+        with mock.patch("select.select", return_value=([client._socket], [], [])):
+            with mock.patch.object(
+                client, "read_once", side_effect=lambda *args: client.in_flight.pop(1)
+            ) as mock_read_once:
+                client.wait_for_window()
+
+        mock_read_once.assert_called_once()
+        assert list(client.in_flight) == [2]
+
+    def test_full_window_expires_stale_pdus(self):
+        """PDUs that never got a response stop occupying the window."""
+        client = self.get_client(window_size=2)
+        client.in_flight = {1: time.monotonic() - client.timeout, 2: time.monotonic()}
+
+        with mock.patch.object(client, "read_once") as mock_read_once:
+            client.wait_for_window()
+
+        mock_read_once.assert_not_called()
+        assert list(client.in_flight) == [2]
+
+
+@pytest.mark.django_db(transaction=True)
+@mock.patch("smpplib.client.Client.send_message", return_value=mock.Mock(sequence=1))
+def test_send_message_waits_for_rate_limit(mock_send_message):
+    """While waiting for the rate limiter, incoming PDUs are still handled."""
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        BackendFactory(),
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client.rate_limiter.tokens = 0
+
+    with mock.patch.object(client, "service_io") as mock_service_io:
+        mock_service_io.side_effect = lambda timeout: setattr(
+            client.rate_limiter, "tokens", 1
+        )
+        client.send_message(short_message=b"hi")
+
+    mock_service_io.assert_called_once()
+    assert 0 < mock_service_io.call_args.args[0] <= 1 / 20
+    mock_send_message.assert_called_once()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_delivery_receipts_acknowledged_after_flush():
+    """Delivery receipts are buffered, and only acknowledged with a
+    deliver_sm_resp once the batch containing them has been saved.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        dlr_batch_size=2,
+    )
+    statuses = [
+        MTMessageStatusFactory(
+            mt_message__backend=backend,
+            mt_message__status=MTMessage.Status.SENT,
+            message_id=message_id,
+        )
+        for message_id in ["abc", "def"]
+    ]
+
+    with mock.patch.object(client, "send_pdu") as mock_send_pdu:
+        for sequence, status in enumerate(statuses, start=100):
+            pdu = DeliverSM("deliver_sm")
+            pdu.sequence = sequence
+            pdu.short_message = b"this is a delivery receipt"
+            pdu.receipted_message_id = status.message_id
+            client._message_received(pdu)
+            if sequence == 100:
+                # Not saved or acknowledged until the batch is full
+                mock_send_pdu.assert_not_called()
+                status.refresh_from_db()
+                assert status.delivery_report.tobytes() == b""
+
+    assert [call.args[0].command for call in mock_send_pdu.call_args_list] == [
+        "deliver_sm_resp",
+        "deliver_sm_resp",
+    ]
+    assert [call.args[0].sequence for call in mock_send_pdu.call_args_list] == [
+        100,
+        101,
+    ]
+    for status in statuses:
+        status.refresh_from_db()
+        assert status.delivery_report.tobytes() == b"this is a delivery receipt"
+        assert status.mt_message.status == MTMessage.Status.DELIVERED
+
+
+@pytest.mark.django_db(transaction=True)
+def test_duplicate_delivery_receipts_all_acknowledged():
+    """Every deliver_sm is acknowledged even when a batch holds several
+    receipts for the same message_id, of which only the last is saved.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        dlr_batch_size=2,
+    )
+    status = MTMessageStatusFactory(
+        mt_message__backend=backend,
+        mt_message__status=MTMessage.Status.SENT,
+        message_id="abc",
+    )
+
+    with mock.patch.object(client, "send_pdu") as mock_send_pdu:
+        for sequence, short_message in [(100, b"enroute"), (101, b"delivered")]:
+            pdu = DeliverSM("deliver_sm")
+            pdu.sequence = sequence
+            pdu.short_message = short_message
+            pdu.receipted_message_id = "abc"
+            client._message_received(pdu)
+
+    assert [call.args[0].sequence for call in mock_send_pdu.call_args_list] == [
+        100,
+        101,
+    ]
+    status.refresh_from_db()
+    assert status.delivery_report.tobytes() == b"delivered"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_receipt_before_submit_sm_resp_matched_late():
+    """A delivery receipt that arrives before its submit_sm_resp is saved is
+    held, and saved once the submit_sm_resp is.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    status = MTMessageStatusFactory(
+        mt_message__backend=backend,
+        mt_message__status=MTMessage.Status.SENT,
+        command_status=None,
+        sequence_number=1,
+    )
+    pdu = DeliverSM("deliver_sm")
+    pdu.short_message = b"stat:DELIVRD"
+    pdu.receipted_message_id = "abc"
+
+    client._save_delivery_receipts([(pdu, decoded_params(pdu), timezone.now())])
+    assert len(client.pending_receipts) == 1
+    resp = SubmitSMResp("submit_sm_resp", message_id="abc")
+    resp.sequence = 1
+    client.message_sent_handler(resp)
+    client.flush_submit_sm_resps()
+
+    status.refresh_from_db()
+    assert status.dlr_state == "DELIVRD"
+    assert status.mt_message.status == MTMessage.Status.DELIVERED
+    assert len(client.pending_receipts) == 0
+    assert client.counters["receipt_matched_late"] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pending_receipts_retried_on_timer():
+    """Held receipts are matched again once due, even if this session saves no
+    submit_sm_resps, e.g. because another session is bound as transmitter.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    status = MTMessageStatusFactory(
+        mt_message__backend=backend,
+        mt_message__status=MTMessage.Status.SENT,
+        command_status=None,
+        sequence_number=1,
+    )
+    pdu = DeliverSM("deliver_sm")
+    pdu.short_message = b"stat:DELIVRD"
+    pdu.receipted_message_id = "abc"
+
+    client._save_delivery_receipts([(pdu, decoded_params(pdu), timezone.now())])
+    assert 0 < client.time_until_flush() <= client.pending_receipts.retry_interval
+    # Saved by the transmitter's session
+    MTMessageStatus.objects.filter(pk=status.pk).update(
+        command_status=smpplib_consts.SMPP_ESME_ROK, message_id="abc"
+    )
+    client.pending_receipts.retry_time = time.monotonic()
+    client.flush_due_buffers()
+
+    status.refresh_from_db()
+    assert status.dlr_state == "DELIVRD"
+    assert len(client.pending_receipts) == 0
+    assert client.time_until_flush() is None
+    assert client.counters["receipt_matched_late"] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pending_receipts_expire():
+    """Receipts that are never matched are counted once they expire."""
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        pending_receipt_ttl=0,
+    )
+    pdu = DeliverSM("deliver_sm")
+    pdu.short_message = b"stat:DELIVRD"
+    pdu.receipted_message_id = "missing"
+
+    client._save_delivery_receipts([(pdu, decoded_params(pdu), timezone.now())])
+
+    assert len(client.pending_receipts) == 0
+    assert client.counters["receipt_expired"] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_receipt_during_batch_not_overwritten():
+    """A delivery receipt read while the batch is still being sent is not
+    overwritten when the batch is marked as sent.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    delivered, sent = MTMessageFactory.create_batch(2, backend=backend)
+
+    def send_message(**kwargs):
+        # The receipt for the first message arrives before the batch ends
+        MTMessage.objects.filter(pk=delivered.pk).update(
+            status=MTMessage.Status.DELIVERED
+        )
+        return mock.Mock(sequence=send_message.sequence.pop())
+
+    send_message.sequence = [2, 1]
+    client.rate_limiter.burst = client.rate_limiter.tokens = 2
+    with mock.patch("smpplib.client.Client.send_message", side_effect=send_message):
+        client.send_mt_messages()
+
+    delivered.refresh_from_db()
+    sent.refresh_from_db()
+    assert delivered.status == MTMessage.Status.DELIVERED
+    assert sent.status == MTMessage.Status.SENT
+
+
+@pytest.mark.django_db(transaction=True)
+def test_send_mt_messages_fetches_again_after_full_batch():
+    """When a batch comes back full, the main loop fetches the next one right
+    away rather than after the queue poll interval, handling incoming PDUs,
+    timers and logging between batches.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        1,  # mt_messages_per_second
+        30,  # socket_timeout
+        2,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    messages = MTMessageFactory.create_batch(5, backend=backend)
+    sequences = iter(range(1, 6))
+
+    client._socket, smsc_socket = socket.socketpair()
+    client.queue_poll_interval = 60
+    # Ignore the notifications about the new messages
+    client._pg_conn.poll()
+    client._pg_conn.notifies.clear()
+    # Leave the loop once the backlog has been sent
+    client.exit_signal_received = lambda: not client.mt_backlog
+
+    with mock.patch.object(client, "wait_for_token"), mock.patch(
+        "smpplib.client.Client.send_message",
+        side_effect=lambda **kwargs: mock.Mock(sequence=next(sequences)),
+    ) as mock_send_message, mock.patch.object(
+        client, "send_mt_batch", wraps=client.send_mt_batch
+    ) as mock_send_mt_batch, mock.patch.object(
+        client, "log_counters"
+    ) as mock_log_counters, mock.patch(
+        "select.select", wraps=select.select
+    ) as mock_select:
+        try:
+            client._listen(None, True)
+        finally:
+            client._socket.close()
+            smsc_socket.close()
+
+    assert mock_send_message.call_count == 5
+    # Two full batches of 2, then a final batch of 1
+    assert [call.args for call in mock_send_mt_batch.call_args_list] == [(2,)] * 3
+    # The main loop had a turn after each of the first two batches, without
+    # waiting for the queue poll interval
+    assert mock_log_counters.call_count == 2
+    assert [call.args[3] for call in mock_select.call_args_list] == [0, 0]
+    for message in messages:
+        message.refresh_from_db()
+        assert message.status == MTMessage.Status.SENT
+
+
+@pytest.mark.django_db(transaction=True)
+def test_listen_flushes_buffers_on_error():
+    """Buffered submit_sm_resps are saved even if the listen loop fails."""
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    status = MTMessageStatusFactory(mt_message__backend=backend, backend=backend)
+    pdu = SubmitSMResp("submit_sm_resp")
+    pdu.sequence = status.sequence_number
+    pdu.message_id = "qwerty"
+    client.message_sent_handler(pdu)
+
+    with mock.patch.object(
+        client, "send_mt_messages", side_effect=RuntimeError
+    ), mock.patch.object(client, "safe_disconnect") as mock_safe_disconnect:
+        with pytest.raises(RuntimeError):
+            client.listen()
+
+    status.refresh_from_db()
+    assert status.message_id == "qwerty"
+    mock_safe_disconnect.assert_not_called()
+
+
+def test_log_counters(caplog):
+    """Running totals are logged at most once per interval."""
+    client = PgSmppClient.__new__(PgSmppClient)
+    client.logger = logging.getLogger(__name__)
+    client.backend = "backend"
+    client.counters = collections.Counter(submit_sm_resp_unmatched=3)
+    client.counters_logged_time = time.monotonic()
+    client.rate_limiter = TokenBucket(2.5)
+    client.segment_cache = SegmentCache()
+    client.segment_cache.hits, client.segment_cache.misses = 4, 1
+
+    with caplog.at_level(logging.INFO):
+        client.log_counters()
+        assert caplog.messages == []
+        client.counters_logged_time -= PgSmppClient.COUNTERS_LOG_INTERVAL
+        client.log_counters()
+        client.log_counters()
+
+    assert caplog.messages == [
+        "Counters for backend=backend: segment_cache_hits=4, "
+        "segment_cache_misses=1, submit_sm_resp_unmatched=3, mt_rate=2.5"
+    ]
+
+
+@pytest.mark.django_db
+def test_exit_signal_received_passed_in():
+    """Clients running outside the main thread use the exit signal check they
+    are given, rather than setting signal handlers.
+    """
+    exit_signal_received = mock.Mock(return_value=False)
+
+    with mock.patch("smpp_gateway.client.set_exit_signals") as mock_set_exit_signals:
+        client = get_smpplib_client(
+            "127.0.0.1",
+            8000,
+            "notify_mo_channel",
+            BackendFactory(),
+            {},  # submit_sm_params
+            False,  # set_priority_flag
+            20,  # mt_messages_per_second
+            30,  # socket_timeout
+            5,  # event_loop_timeout
+            "",  # hc_check_uuid
+            "",  # hc_ping_key
+            "",  # hc_check_slug
+            exit_signal_received=exit_signal_received,
+        )
+
+    mock_set_exit_signals.assert_not_called()
+    assert client.exit_signal_received is exit_signal_received
+
+
+@pytest.mark.django_db(transaction=True)
+def test_receiver_does_not_send_mt_messages():
+    """Clients bound as receivers leave MT messages for transmitters."""
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        send_mt=False,
+    )
+    message = MTMessageFactory(backend=backend)
+
+    with mock.patch("smpplib.client.Client.send_message") as mock_send_message:
+        client.send_mt_messages()
+
+    mock_send_message.assert_not_called()
+    message.refresh_from_db()
+    assert message.status == MTMessage.Status.NEW
+
+
+@pytest.mark.django_db(transaction=True)
+def test_throttled_messages_slow_down_and_requeue():
+    """A throttling error halves the rate, and the throttled message is
+    requeued to be sent again.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    throttled, sent = [
+        MTMessageStatusFactory(
+            mt_message__backend=backend,
+            mt_message__status=MTMessage.Status.SENT,
+            backend=backend,
+        )
+        for _ in range(2)
+    ]
+    for status in [throttled, sent]:
+        client.in_flight[status.sequence_number] = time.monotonic()
+
+    for status, command_status in [
+        (throttled, smpplib_consts.SMPP_ESME_RTHROTTLED),
+        (sent, smpplib_consts.SMPP_ESME_ROK),
+    ]:
+        pdu = SubmitSMResp("submit_sm_resp")
+        pdu.sequence = status.sequence_number
+        pdu.status = command_status
+        pdu.message_id = ""
+        # Error responses are handled twice by smpplib
+        if command_status != smpplib_consts.SMPP_ESME_ROK:
+            client.error_pdu_handler(pdu)
+        client.message_sent_handler(pdu)
+    client.flush_submit_sm_resps()
+
+    assert client.rate_limiter.rate == 10
+    assert client.counters["submit_sm_throttled"] == 1
+    throttled.mt_message.refresh_from_db()
+    sent.mt_message.refresh_from_db()
+    assert throttled.mt_message.status == MTMessage.Status.NEW
+    assert sent.mt_message.status == MTMessage.Status.SENT
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submit_sm_resp_saves_send_time():
+    """submitted_at is saved with the response as the time the PDU was sent,
+    including for error responses, which smpplib handles twice.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    sent, failed = MTMessageStatusFactory.create_batch(
+        2,
+        mt_message__backend=backend,
+        mt_message__status=MTMessage.Status.SENT,
+        command_status=None,
+    )
+    for status in [sent, failed]:
+        client.in_flight[status.sequence_number] = time.monotonic() - 10
+
+    for status, command_status in [
+        (sent, smpplib_consts.SMPP_ESME_ROK),
+        (failed, smpplib_consts.SMPP_ESME_RSUBMITFAIL),
+    ]:
+        pdu = SubmitSMResp("submit_sm_resp")
+        pdu.sequence = status.sequence_number
+        pdu.status = command_status
+        pdu.message_id = ""
+        if command_status != smpplib_consts.SMPP_ESME_ROK:
+            client.error_pdu_handler(pdu)
+        client.message_sent_handler(pdu)
+    client.flush_submit_sm_resps()
+
+    for status in [sent, failed]:
+        status.refresh_from_db()
+        assert 9 < (status.resp_at - status.submitted_at).total_seconds() < 11
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generic_nack_saved_as_failure():
+    """A generic_nack is saved as a failed response, so its message is
+    retried or failed rather than left SENT awaiting a response.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    status = MTMessageStatusFactory(
+        mt_message__backend=backend,
+        mt_message__status=MTMessage.Status.SENT,
+        command_status=None,
+    )
+    client.in_flight[status.sequence_number] = time.monotonic()
+    pdu = smpp.make_pdu("generic_nack", client=client)
+    pdu.sequence = status.sequence_number
+    pdu.status = smpplib_consts.SMPP_ESME_RINVCMDLEN
+
+    client.handle_pdu(pdu)
+    client.flush_submit_sm_resps()
+
+    assert client.in_flight == {}
+    status.refresh_from_db()
+    assert status.command_status == smpplib_consts.SMPP_ESME_RINVCMDLEN
+    assert status.submitted_at is not None
+    assert status.mt_message.status != MTMessage.Status.SENT
+    assert (
+        client.counters["mt_message_retried"] + client.counters["mt_message_failed"]
+        == 1
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reclaim_expired_claims():
+    """Expired claims are reclaimed on the first fetch, then at most once per
+    interval.
+    """
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        BackendFactory(),
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        lease_seconds=60,
+    )
+
+    with mock.patch(
+        "smpp_gateway.client.reclaim_expired_mt_messages", return_value=2
+    ) as mock_reclaim:
+        client.send_mt_messages()
+        client.send_mt_messages()
+        client.reclaimed_time -= 30
+        client.send_mt_messages()
+
+    assert mock_reclaim.call_args_list == [mock.call(client.backend, 60)] * 2
+    assert client.counters["mt_message_reclaimed"] == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reconcile_in_flight():
+    """After the connection drops, messages without a submit_sm_resp and
+    unsent messages of the batch are requeued, and the placeholder statuses
+    of unsent PDUs are deleted. The rest of the batch stays sent.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    in_flight, acknowledged, unsent = [
+        MTMessageStatusFactory(
+            mt_message__backend=backend,
+            mt_message__status=MTMessage.Status.SENT,
+            backend=backend,
+        )
+        for _ in range(3)
+    ]
+    client.start_batch(
+        [
+            (status.mt_message_id, [{"sequence": status.sequence_number}])
+            for status in (in_flight, acknowledged, unsent)
+        ]
+    )
+    client.batch_unsent = {unsent.mt_message_id}
+    client.batch_unsent_sequences = {unsent.sequence_number}
+    client.in_flight[in_flight.sequence_number] = time.monotonic()
+
+    client.reconcile_in_flight()
+
+    assert client.in_flight == {}
+    assert client.batch_ids == []
+    assert client.counters["mt_message_requeued"] == 1
+    for message, status in [
+        (in_flight.mt_message, MTMessage.Status.NEW),
+        (acknowledged.mt_message, MTMessage.Status.SENT),
+        (unsent.mt_message, MTMessage.Status.NEW),
+    ]:
+        message.refresh_from_db()
+        assert message.status == status
+    assert not MTMessageStatus.objects.filter(pk=unsent.pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_statuses_written_before_sending():
+    """Placeholder statuses for the whole batch exist, and the batch is marked
+    as sent, before its first PDU is sent.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client.rate_limiter.burst = client.rate_limiter.tokens = 10
+    messages = MTMessageFactory.create_batch(2, backend=backend)
+    sent = []
+
+    def send_message(**kwargs):
+        statuses = MTMessageStatus.objects.filter(backend=backend)
+        assert statuses.count() == 2
+        assert statuses.filter(sequence_number=kwargs["sequence"]).exists()
+        assert not MTMessage.objects.exclude(status=MTMessage.Status.SENT).exists()
+        sent.append(kwargs["sequence"])
+        return mock.Mock(sequence=kwargs["sequence"])
+
+    with mock.patch("smpplib.client.Client.send_message", side_effect=send_message):
+        assert client.send_mt_batch(10) == 2
+
+    assert sorted(
+        MTMessageStatus.objects.filter(backend=backend).values_list(
+            "sequence_number", flat=True
+        )
+    ) == sorted(sent)
+    assert {status.mt_message for status in MTMessageStatus.objects.all()} == set(
+        messages
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+@mock.patch("smpplib.client.Client.send_message")
+def test_send_pre_encoded_parts(mock_send_message):
+    """Messages encoded when they were queued are sent without encoding."""
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client.rate_limiter.burst = client.rate_limiter.tokens = 10
+    mock_send_message.side_effect = [mock.Mock(sequence=n) for n in (1, 2)]
+    message = MTMessageFactory(
+        backend=backend, status=MTMessage.Status.NEW, short_message="a" * 200
+    )
+    message.encode()
+    message.save()
+    client.segment_cache.random = mock.Mock(return_value=7)
+
+    with mock.patch.object(client, "make_parts") as mock_make_parts:
+        assert client.send_mt_batch(10) == 1
+
+    mock_make_parts.assert_not_called()
+    # With a new concatenation reference for this attempt
+    assert [
+        call.kwargs["short_message"] for call in mock_send_message.call_args_list
+    ] == new_reference(message.encoded_parts, lambda a, b: 7)
+    assert mock_send_message.call_args.kwargs["esm_class"] == 64
+    # Each phase of sending the batch was timed
+    assert {"fetch", "submit_sm", "save_statuses"} <= set(client.timings.snapshot())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_read_available_handles_every_pdu_read():
+    """All PDUs received together are handled before returning to select()."""
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        BackendFactory(),
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client._socket, smsc_socket = socket.socketpair()
+    raw_pdus = []
+    for sequence in range(1, 4):
+        pdu = SubmitSMResp("submit_sm_resp", client=client, message_id="abc")
+        pdu.sequence = sequence
+        raw_pdus.append(pdu.generate())
+    smsc_socket.sendall(b"".join(raw_pdus))
+
+    try:
+        with mock.patch.object(client, "message_sent_handler") as mock_handler:
+            client.read_available()
+    finally:
+        client._socket.close()
+        smsc_socket.close()
+
+    assert [call.kwargs["pdu"].sequence for call in mock_handler.call_args_list] == [
+        1,
+        2,
+        3,
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_read_buffered_handles_pdus_read_while_binding():
+    """PDUs read along with the bind_resp are handled without waiting for more
+    data on the socket, including one that was read only in part.
+    """
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        BackendFactory(),
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client._socket, smsc_socket = socket.socketpair()
+    raw_pdus = []
+    for sequence in range(1, 4):
+        pdu = SubmitSMResp("submit_sm_resp", client=client, message_id="abc")
+        pdu.sequence = sequence
+        raw_pdus.append(pdu.generate())
+    raw_pdus = b"".join(raw_pdus)
+    smsc_socket.sendall(raw_pdus[:-5])
+    client.pdu_reader.read_from(client._socket)
+    smsc_socket.sendall(raw_pdus[-5:])
+
+    try:
+        with mock.patch.object(client, "message_sent_handler") as mock_handler:
+            client.read_buffered()
+    finally:
+        client._socket.close()
+        smsc_socket.close()
+
+    assert [call.kwargs["pdu"].sequence for call in mock_handler.call_args_list] == [
+        1,
+        2,
+        3,
+    ]
+    assert len(client.pdu_reader) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pg_notifies_coalesced():
+    """Every pending notification is drained and answered by one fetch cycle."""
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    for _ in range(3):
+        pg_notify(backend.name)
+
+    with mock.patch.object(client, "send_mt_messages") as mock_send_mt_messages:
+        client.receive_pg_notify()
+        client.receive_pg_notify()
+
+    mock_send_mt_messages.assert_called_once()
+    assert client._pg_conn.notifies == []
+    assert client.counters["pg_notify_coalesced"] == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pg_notify_payload_skips_fetch():
+    """Notifications listing only messages already fetched don't start
+    another fetch cycle, unlike notifications without a usable payload.
+    """
+    backend = BackendFactory()
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        backend,
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+    )
+    client.fetched_ids = {1, 2, 3}
+
+    with mock.patch.object(client, "send_mt_messages") as mock_send_mt_messages:
+        pg_notify(backend.name, mt_notify_payload([1, 2], [None, None]))
+        pg_notify(backend.name, mt_notify_payload([3], [None]))
+        client.receive_pg_notify()
+        mock_send_mt_messages.assert_not_called()
+        assert client.counters["pg_notify_skipped"] == 2
+
+        pg_notify(backend.name, mt_notify_payload([3, 4], [None, None]))
+        client.receive_pg_notify()
+        assert mock_send_mt_messages.call_count == 1
+
+        pg_notify(backend.name, mt_notify_payload([1], [None])[:-3])
+        client.receive_pg_notify()
+        assert mock_send_mt_messages.call_count == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_keep_alive_only_when_idle():
+    """An enquire_link is only sent once no PDU has been read for
+    `enquire_link_interval` seconds.
+    """
+    client = get_smpplib_client(
+        "127.0.0.1",
+        8000,
+        "notify_mo_channel",
+        BackendFactory(),
+        {},  # submit_sm_params
+        False,  # set_priority_flag
+        20,  # mt_messages_per_second
+        30,  # socket_timeout
+        5,  # event_loop_timeout
+        "",  # hc_check_uuid
+        "",  # hc_ping_key
+        "",  # hc_check_slug
+        enquire_link_interval=30,
+        queue_poll_interval=2,
+    )
+    assert client.queue_poll_interval == 2
+
+    with mock.patch.object(client, "send_pdu") as mock_send_pdu:
+        client.keep_alive()
+        mock_send_pdu.assert_not_called()
+
+        client.last_read_time -= 30
+        client.keep_alive()
+        client.keep_alive()
+
+    assert [call.args[0].command for call in mock_send_pdu.call_args_list] == [
+        "enquire_link"
+    ]
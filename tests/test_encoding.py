@@ -0,0 +1,61 @@
+from unittest import mock
+
+import smpplib.consts
+import smpplib.gsm
+
+from smpp_gateway.encoding import SegmentCache
+
+LONG_TEXT = "a" * 200
+
+
+def test_cached_parts_match_smpplib():
+    cache = SegmentCache(random=lambda a, b: 42)
+
+    with mock.patch("random.randint", return_value=42):
+        expected = smpplib.gsm.make_parts(LONG_TEXT)
+        assert cache.make_parts(LONG_TEXT) == expected
+        assert cache.make_parts(LONG_TEXT) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_new_reference_for_each_message():
+    """Parts returned from the cache get a fresh concatenation reference."""
+    references = iter([7, 8])
+    cache = SegmentCache(random=lambda a, b: next(references))
+
+    first, _, esm_class = cache.make_parts(LONG_TEXT)
+    second, _, _ = cache.make_parts(LONG_TEXT)
+    third, _, _ = cache.make_parts(LONG_TEXT)
+
+    assert esm_class == smpplib.consts.SMPP_GSMFEAT_UDHI
+    assert len(first) == 2
+    assert {part[3] for part in second} == {7}
+    assert {part[3] for part in third} == {8}
+    assert [part[4:] for part in second] == [part[4:] for part in first]
+
+
+def test_single_part_unchanged():
+    cache = SegmentCache()
+
+    cache.make_parts("hi")
+
+    assert cache.make_parts("hi") == ([b"hi"], 0, 0)
+
+
+def test_least_recently_used_evicted():
+    cache = SegmentCache(max_size=2)
+    cache.make_parts("a")
+    cache.make_parts("b")
+    cache.make_parts("a")
+    cache.make_parts("c")
+
+    assert [key[0] for key in cache.entries] == ["a", "c"]
+
+
+def test_disabled():
+    cache = SegmentCache(max_size=0)
+    cache.make_parts("hi")
+    cache.make_parts("hi")
+
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
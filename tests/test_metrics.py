@@ -0,0 +1,57 @@
+import pytest
+
+from smpp_gateway.metrics import Histogram, PhaseTimers, format_histograms
+
+
+class TestHistogram:
+    def test_percentiles(self):
+        histogram = Histogram()
+        for seconds in [0.000005] * 90 + [0.001] * 9 + [100]:
+            histogram.record(seconds)
+
+        assert histogram.count == 100
+        assert histogram.total == pytest.approx(100.009 + 0.00045)
+        assert histogram.percentile(0.5) == 0.00001
+        assert 0.001 <= histogram.percentile(0.99) < 0.002
+        assert histogram.percentile(1) == float("inf")
+
+    def test_empty(self):
+        assert Histogram().percentile(0.5) is None
+
+    def test_difference(self):
+        histogram = Histogram()
+        histogram.record(1)
+        previous = histogram.copy()
+        histogram.record(2)
+
+        difference = histogram - previous
+
+        assert (difference.count, difference.total) == (1, 2)
+        assert histogram.count == 2
+
+
+class TestPhaseTimers:
+    def test_time_phase(self):
+        timers = PhaseTimers()
+
+        with timers.time("fetch"):
+            pass
+        with pytest.raises(ValueError):
+            with timers.time("fetch"):
+                raise ValueError
+
+        assert timers.snapshot()["fetch"].count == 2
+
+    def test_since_last(self):
+        timers = PhaseTimers()
+        timers.record("fetch", 0.002)
+        timers.record("select", 1)
+
+        assert set(timers.since_last()) == {"fetch", "select"}
+        timers.record("fetch", 0.003)
+        histograms = timers.since_last()
+
+        assert list(histograms) == ["fetch"]
+        assert format_histograms(histograms) == (
+            "fetch count=1 total=3ms p50<=5.12ms p99<=5.12ms"
+        )
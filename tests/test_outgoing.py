@@ -0,0 +1,68 @@
+from unittest import mock
+
+import pytest
+
+from django.test import override_settings
+
+from smpp_gateway.encoding import CONCAT_UDH_REFERENCE_INDEX, new_reference
+from smpp_gateway.models import MTMessage
+from smpp_gateway.outgoing import SMPPGatewayBackend
+from smpp_gateway.queries import parse_mt_notify_payload, pg_listen
+
+LONG_TEXT = "a" * 200
+
+
+@pytest.mark.django_db(transaction=True)
+def test_send_stores_encoded_parts():
+    """Messages are encoded once when queued, with the parts stored on each
+    under their own concatenation reference.
+    """
+    backend = SMPPGatewayBackend(None, "smppsim")
+    references = iter([1, 2])
+
+    with mock.patch(
+        "smpp_gateway.outgoing.new_reference",
+        side_effect=lambda parts: new_reference(parts, lambda a, b: next(references)),
+    ):
+        backend.send(1, LONG_TEXT, ["+15550001", "+15550002"])
+
+    messages = MTMessage.objects.all()
+    assert len(messages) == 2
+    for message in messages:
+        assert len(message.encoded_parts) == 2
+        assert message.data_coding == 0
+        assert message.esm_class == 64
+    parts = [
+        [bytes(part) for part in message.encoded_parts]
+        for message in messages.order_by("pk")
+    ]
+    assert parts[1] == new_reference(parts[0], lambda a, b: 2)
+    assert {part[CONCAT_UDH_REFERENCE_INDEX] for part in parts[0]} == {1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_send_without_encoding():
+    backend = SMPPGatewayBackend(None, "smppsim", encode_messages=False)
+
+    backend.send(1, LONG_TEXT, ["+15550001"])
+
+    message = MTMessage.objects.get()
+    assert message.encoded_parts is None
+    assert message.data_coding is None
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(SMPP_GATEWAY_NOTIFY_PAYLOADS=True)
+def test_send_notify_payload():
+    backend = SMPPGatewayBackend(None, "smppsim")
+    listen_conn = pg_listen("smppsim")
+
+    backend.send(1, "hi", ["+15550001", "+15550002"], {"priority_flag": 2})
+
+    listen_conn.poll()
+    payload = parse_mt_notify_payload(listen_conn.notifies.pop().payload)
+    assert payload == {
+        "count": 2,
+        "priority": 2,
+        "ids": list(MTMessage.objects.order_by("pk").values_list("pk", flat=True)),
+    }
@@ -0,0 +1,94 @@
+import socket
+import struct
+
+from unittest import mock
+
+import pytest
+
+from smpplib import smpp
+from smpplib.exceptions import ConnectionError, PDUError
+
+from smpp_gateway.pdu_reader import MAX_PDU_LENGTH, PduReader
+
+
+def make_raw_pdu(sequence: int, message_id: str = "abc") -> bytes:
+    client = mock.Mock(sequence=sequence)
+    pdu = smpp.make_pdu("submit_sm_resp", client=client, message_id=message_id)
+    pdu.sequence = sequence
+    return pdu.generate()
+
+
+@pytest.fixture
+def sockets():
+    reader, writer = socket.socketpair()
+    reader.settimeout(1)
+    yield reader, writer
+    reader.close()
+    writer.close()
+
+
+def test_reads_several_pdus_at_once(sockets):
+    reader_socket, writer_socket = sockets
+    raw_pdus = [make_raw_pdu(n) for n in range(1, 4)]
+    writer_socket.sendall(b"".join(raw_pdus))
+    reader = PduReader()
+
+    reader.read_from(reader_socket)
+
+    assert [reader.next_pdu() for _ in range(4)] == raw_pdus + [None]
+    assert len(reader) == 0
+
+
+def test_partial_pdu_kept_until_complete(sockets):
+    reader_socket, writer_socket = sockets
+    raw_pdu = make_raw_pdu(1)
+    reader = PduReader()
+
+    for chunk in [raw_pdu[:2], raw_pdu[2:10], raw_pdu[10:]]:
+        assert reader.next_pdu() is None
+        writer_socket.sendall(chunk)
+        reader.read_from(reader_socket)
+
+    assert reader.next_pdu() == raw_pdu
+
+
+def test_buffer_grows_for_large_pdu(sockets):
+    reader_socket, writer_socket = sockets
+    raw_pdu = make_raw_pdu(1, message_id="x" * 60)
+    writer_socket.sendall(raw_pdu + make_raw_pdu(2))
+    reader = PduReader(buffer_size=20)
+
+    while not reader.has_pdu():
+        reader.read_from(reader_socket)
+
+    assert reader.next_pdu() == raw_pdu
+    assert len(reader.buffer) >= len(raw_pdu)
+
+
+def test_closed_connection(sockets):
+    reader_socket, writer_socket = sockets
+    writer_socket.close()
+
+    with pytest.raises(ConnectionError):
+        PduReader().read_from(reader_socket)
+
+
+def test_broken_pdu():
+    reader = PduReader()
+    reader.buffer[:4] = b"\x00\x00\x00\x02"
+    reader.end = 4
+
+    with pytest.raises(PDUError):
+        reader.next_pdu()
+
+
+def test_pdu_too_long(sockets):
+    reader_socket, writer_socket = sockets
+    reader = PduReader()
+    reader.buffer[:4] = struct.pack(">L", MAX_PDU_LENGTH + 1)
+    reader.end = 4
+
+    with pytest.raises(PDUError):
+        reader.read_from(reader_socket)
+    # The buffer wasn't grown to fit it
+    assert len(reader.buffer) == 65536
@@ -0,0 +1,92 @@
+import collections
+import urllib.error
+import urllib.request
+
+from unittest import mock
+
+import pytest
+
+from smpp_gateway.metrics import PhaseTimers
+from smpp_gateway.models import MTMessage
+from smpp_gateway.prometheus import (
+    MetricsServer,
+    client_collector,
+    gauge,
+    queue_collector,
+    render,
+)
+from smpp_gateway.throttling import TokenBucket
+from tests.factories import BackendFactory, MTMessageFactory
+
+
+def test_render():
+    samples = [
+        gauge("queue", "Messages waiting.", {"backend": 'a"b'}, 2),
+        gauge("queue", "Messages waiting.", {"backend": "c"}, 0.5),
+    ]
+
+    assert render(samples) == (
+        "# HELP queue Messages waiting.\n"
+        "# TYPE queue gauge\n"
+        'queue{backend="a\\"b"} 2\n'
+        'queue{backend="c"} 0.5\n'
+    )
+
+
+def test_client_collector():
+    client = mock.Mock(
+        counters=collections.Counter(reconnects=2),
+        in_flight={1: 0.0},
+        pending_receipts=[],
+        window_size=10,
+        rate_limiter=TokenBucket(20),
+        timings=PhaseTimers(),
+    )
+    client.backend.name = "smppsim"
+    client.timings.record("fetch", 0.003)
+
+    text = render(client_collector(client, "tx0")())
+
+    labels = 'backend="smppsim",session="tx0"'
+    assert f'smpp_gateway_client_events_total{{{labels},event="reconnects"}} 2' in text
+    assert f"smpp_gateway_client_in_flight{{{labels}}} 1" in text
+    assert f"smpp_gateway_client_window_size{{{labels}}} 10" in text
+    assert (
+        f'smpp_gateway_client_phase_seconds_bucket{{{labels},phase="fetch",le="0.00256"}} 0'
+        in text
+    )
+    assert (
+        f'smpp_gateway_client_phase_seconds_bucket{{{labels},phase="fetch",le="+Inf"}} 1'
+        in text
+    )
+    assert (
+        f'smpp_gateway_client_phase_seconds_count{{{labels},phase="fetch"}} 1' in text
+    )
+
+
+@pytest.mark.django_db
+def test_queue_collector():
+    backend = BackendFactory(name="smppsim")
+    for status in ["new", "new", "sending", "sent"]:
+        MTMessageFactory(backend=backend, status=status)
+
+    samples = {sample.labels["status"]: sample.value for sample in queue_collector()()}
+
+    assert samples == {MTMessage.Status.NEW: 2, MTMessage.Status.SENDING: 1}
+
+
+def test_metrics_server():
+    server = MetricsServer(
+        "127.0.0.1", 0, [lambda: [gauge("up", "Whether it is up.", {}, 1)]]
+    )
+    server.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert response.read().decode().endswith("up 1\n")
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
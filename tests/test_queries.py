@@ -1,15 +1,36 @@
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
 from multiprocessing.pool import ThreadPool
+from unittest import mock
 
 import pytest
 
-from smpp_gateway.models import MOMessage, MTMessage
+from django.utils import timezone
+
+from smpp_gateway.models import MOMessage, MTMessage, MTMessageStatus
 from smpp_gateway.queries import (
+    NOTIFY_PAYLOAD_MAX_IDS,
     get_mo_messages_to_process,
+    get_mt_latency_percentiles,
     get_mt_messages_to_send,
+    mt_notify_payload,
+    parse_mt_notify_payload,
     pg_listen,
     pg_notify,
+    reclaim_expired_mt_messages,
+    requeue_mt_messages,
+    save_delivery_receipts,
+    save_submit_sm_resps,
+    schedule_mt_message_retries,
+    write_mt_message_statuses,
+)
+from smpp_gateway.retries import RetryPolicy
+from tests.factories import (
+    BackendFactory,
+    MOMessageFactory,
+    MTMessageFactory,
+    MTMessageStatusFactory,
 )
-from tests.factories import BackendFactory, MOMessageFactory, MTMessageFactory
 
 
 @pytest.mark.django_db
@@ -28,6 +49,32 @@ class TestGetMessagesToSend:
 
         assert len(messages) == 5
 
+    def test_skip_messages_not_due(self):
+        """Messages scheduled to be retried later are skipped until due."""
+        backend = BackendFactory()
+        due, _ = [
+            MTMessageFactory(backend=backend, next_attempt_time=next_attempt_time)
+            for next_attempt_time in [
+                timezone.now() - timedelta(seconds=1),
+                timezone.now() + timedelta(minutes=1),
+            ]
+        ]
+
+        messages = get_mt_messages_to_send(100, backend)
+
+        assert [message["id"] for message in messages] == [due.pk]
+
+    def test_attempt_count_and_claim_time(self):
+        """Each fetch counts as an attempt, and records when it was made."""
+        message = MTMessageFactory(attempt_count=2)
+        before = timezone.now()
+
+        get_mt_messages_to_send(100, message.backend)
+
+        message.refresh_from_db()
+        assert message.attempt_count == 3
+        assert message.claim_time >= before
+
     def test_full_page(self):
         """Return only `limit` messages if more are present."""
         backend = BackendFactory()
@@ -100,6 +147,237 @@ class TestGetMessagesToSend:
         assert [3, 2, 1, 0, None] == [i["priority_flag"] for i in messages]
 
 
+@pytest.mark.django_db
+def test_save_submit_sm_resps():
+    """Responses are saved on the MTMessageStatus with the same backend and
+    sequence_number.
+    """
+    backend = BackendFactory()
+    status_1, status_2 = MTMessageStatusFactory.create_batch(
+        2, mt_message__backend=backend, command_status=None
+    )
+    other_backend_status = MTMessageStatusFactory(command_status=None)
+
+    count = save_submit_sm_resps(
+        backend,
+        [
+            (status_1.sequence_number, 0, "abc"),
+            (other_backend_status.sequence_number, 0, "def"),
+        ],
+    )
+
+    assert count == 1
+    for status in (status_1, status_2, other_backend_status):
+        status.refresh_from_db()
+    assert (status_1.command_status, status_1.message_id) == (0, "abc")
+    assert (status_2.command_status, status_2.message_id) == (None, "")
+    assert other_backend_status.command_status is None
+
+
+@pytest.mark.django_db
+def test_save_submit_sm_resps_resp_at():
+    """resp_at is set to the time each response was received, if given, or
+    else to now, and submitted_at to the time each PDU was sent, if known.
+    """
+    backend = BackendFactory()
+    status_1, status_2, status_3 = MTMessageStatusFactory.create_batch(
+        3, mt_message__backend=backend, submitted_at=None
+    )
+    now = timezone.now()
+    received_at = now - timedelta(seconds=5)
+    sent_at = now - timedelta(seconds=6)
+
+    save_submit_sm_resps(
+        backend,
+        [
+            (status_1.sequence_number, 0, "abc", received_at, sent_at),
+            (status_2.sequence_number, 0, "def"),
+            (status_3.sequence_number, 0, "ghi", received_at, None),
+        ],
+        now=now,
+    )
+
+    for status in (status_1, status_2, status_3):
+        status.refresh_from_db()
+    assert (status_1.resp_at, status_1.submitted_at) == (received_at, sent_at)
+    assert (status_2.resp_at, status_2.submitted_at) == (now, None)
+    assert (status_3.resp_at, status_3.submitted_at) == (received_at, None)
+
+
+@pytest.mark.django_db
+class TestSaveDeliveryReceipts:
+    def test_saves_matching_receipts(self):
+        """Receipts are saved on the MTMessageStatus with the same backend and
+        message_id, and the MTMessage is marked as delivered.
+        """
+        backend = BackendFactory()
+        statuses = [
+            MTMessageStatusFactory(
+                mt_message__backend=backend,
+                mt_message__status=MTMessage.Status.SENT,
+                message_id=message_id,
+            )
+            for message_id in ["a", "b", "c"]
+        ]
+        MTMessageStatusFactory(message_id="a")  # another backend
+
+        count = save_delivery_receipts(
+            backend, [("a", b"receipt a"), ("c", b"receipt c"), ("z", b"receipt z")]
+        )
+
+        assert count == 2
+        for status in statuses:
+            status.refresh_from_db()
+            status.mt_message.refresh_from_db()
+        assert [s.delivery_report.tobytes() for s in statuses] == [
+            b"receipt a",
+            b"",
+            b"receipt c",
+        ]
+        assert [s.mt_message.status for s in statuses] == [
+            MTMessage.Status.DELIVERED,
+            MTMessage.Status.SENT,
+            MTMessage.Status.DELIVERED,
+        ]
+
+    def test_duplicate_message_id(self):
+        """The last of several receipts for the same message_id is saved."""
+        backend = BackendFactory()
+        status = MTMessageStatusFactory(backend=backend, message_id="a")
+
+        count = save_delivery_receipts(
+            backend, [("a", b"enroute"), ("a", b"delivered"), ("a", b"final")]
+        )
+
+        assert count == 1
+        status.refresh_from_db()
+        assert status.delivery_report.tobytes() == b"final"
+
+    def test_receipt_states(self):
+        """The parsed receipt is saved, and the MTMessage status follows its
+        state. Intermediate states leave the MTMessage as it was.
+        """
+        backend = BackendFactory()
+        statuses = [
+            MTMessageStatusFactory(
+                mt_message__backend=backend,
+                mt_message__status=MTMessage.Status.SENT,
+                message_id=message_id,
+            )
+            for message_id in ["a", "b", "c"]
+        ]
+
+        save_delivery_receipts(
+            backend,
+            [
+                ("a", b"id:a done date:2101011201 stat:DELIVRD err:000"),
+                ("b", b"id:b done date:2101011201 stat:UNDELIV err:034"),
+                ("c", b"id:c stat:ENROUTE"),
+            ],
+        )
+
+        for status in statuses:
+            status.refresh_from_db()
+            status.mt_message.refresh_from_db()
+        assert [(s.dlr_state, s.dlr_error_code) for s in statuses] == [
+            ("DELIVRD", 0),
+            ("UNDELIV", 34),
+            ("ENROUTE", None),
+        ]
+        assert statuses[0].dlr_done_date == datetime(
+            2021, 1, 1, 12, 1, tzinfo=dt_timezone.utc
+        )
+        assert [s.mt_message.status for s in statuses] == [
+            MTMessage.Status.DELIVERED,
+            MTMessage.Status.UNDELIVERED,
+            MTMessage.Status.SENT,
+        ]
+
+    def test_undelivered_segment(self):
+        """A multipart message is undelivered if any of its segments is."""
+        backend = BackendFactory()
+        mt_message = MTMessageFactory(backend=backend)
+        for message_id in ["a", "b", "c"]:
+            MTMessageStatusFactory(mt_message=mt_message, message_id=message_id)
+
+        save_delivery_receipts(
+            backend, [("a", b"stat:DELIVRD"), ("b", b"stat:EXPIRED")]
+        )
+        save_delivery_receipts(backend, [("c", b"stat:DELIVRD")])
+
+        mt_message.refresh_from_db()
+        assert mt_message.status == MTMessage.Status.UNDELIVERED
+
+    def test_dlr_at(self):
+        """dlr_at is set to the time the receipt was received, if given."""
+        backend = BackendFactory()
+        status = MTMessageStatusFactory(backend=backend, message_id="a")
+        received_at = timezone.now() - timedelta(seconds=5)
+
+        save_delivery_receipts(backend, [("a", b"receipt a", received_at)])
+
+        status.refresh_from_db()
+        assert status.dlr_at == received_at
+
+    def test_empty(self):
+        assert save_delivery_receipts(BackendFactory(), []) == 0
+
+
+@pytest.mark.django_db
+class TestGetMTLatencyPercentiles:
+    def test_percentiles(self):
+        """Latencies of each stage are summarized per backend, ignoring
+        segments submitted outside of the time range.
+        """
+        backend = BackendFactory(name="a")
+        now = timezone.now()
+        for seconds in range(1, 11):
+            status = MTMessageStatusFactory(
+                backend=backend,
+                mt_message__backend=backend,
+                submitted_at=now,
+                resp_at=now + timedelta(seconds=seconds),
+                dlr_at=now + timedelta(seconds=10 * seconds) if seconds <= 5 else None,
+            )
+            status.mt_message.create_time = now - timedelta(seconds=1)
+            status.mt_message.save()
+        MTMessageStatusFactory(
+            backend=backend,
+            submitted_at=now - timedelta(hours=2),
+            resp_at=now,
+        )
+
+        results = get_mt_latency_percentiles(
+            now - timedelta(hours=1), now + timedelta(hours=1)
+        )
+
+        assert list(results) == ["a"]
+        stages = results["a"]
+        assert stages["queue"] == {"count": 10, "p50": 1.0, "p95": 1.0, "p99": 1.0}
+        assert stages["resp"]["count"] == 10
+        assert stages["resp"]["p50"] == pytest.approx(5.5)
+        assert stages["resp"]["p99"] == pytest.approx(9.91)
+        assert stages["dlr"]["count"] == 5
+        assert stages["dlr"]["p50"] == pytest.approx(30)
+
+    def test_backend_filter(self):
+        now = timezone.now()
+        status = MTMessageStatusFactory(submitted_at=now)
+        MTMessageStatusFactory(submitted_at=now)
+
+        results = get_mt_latency_percentiles(
+            now - timedelta(hours=1), now + timedelta(hours=1), status.backend
+        )
+
+        assert list(results) == [status.backend.name]
+        assert results[status.backend.name]["resp"] == {
+            "count": 0,
+            "p50": None,
+            "p95": None,
+            "p99": None,
+        }
+
+
 @pytest.mark.django_db
 class TestGetMessagesToProcess:
     def test_empty(self):
@@ -115,6 +393,32 @@ class TestGetMessagesToProcess:
 
         assert messages.count() == 5
 
+    def test_skip_messages_not_due(self):
+        """Messages scheduled to be retried later are skipped until due."""
+        backend = BackendFactory()
+        due, _ = [
+            MTMessageFactory(backend=backend, next_attempt_time=next_attempt_time)
+            for next_attempt_time in [
+                timezone.now() - timedelta(seconds=1),
+                timezone.now() + timedelta(minutes=1),
+            ]
+        ]
+
+        messages = get_mt_messages_to_send(100, backend)
+
+        assert [message["id"] for message in messages] == [due.pk]
+
+    def test_attempt_count_and_claim_time(self):
+        """Each fetch counts as an attempt, and records when it was made."""
+        message = MTMessageFactory(attempt_count=2)
+        before = timezone.now()
+
+        get_mt_messages_to_send(100, message.backend)
+
+        message.refresh_from_db()
+        assert message.attempt_count == 3
+        assert message.claim_time >= before
+
     def test_full_page(self):
         """Return only `limit` messages if more are present."""
         MOMessageFactory.create_batch(5)
@@ -235,3 +539,219 @@ class TestNotifications:
         listen_conn = pg_listen("test_channel")
         listen_conn.poll()
         assert len(listen_conn.notifies) == 0
+
+    def test_notify_payload(self):
+        listen_conn = pg_listen("test_channel")
+        payload = mt_notify_payload([1, 2], [None, 2])
+
+        pg_notify("test_channel", payload)
+
+        listen_conn.poll()
+        assert listen_conn.notifies.pop().payload == payload
+        assert parse_mt_notify_payload(payload) == {
+            "count": 2,
+            "priority": 2,
+            "ids": [1, 2],
+        }
+
+
+def test_mt_notify_payload_leaves_out_too_many_ids():
+    ids = list(range(NOTIFY_PAYLOAD_MAX_IDS + 1))
+
+    payload = parse_mt_notify_payload(mt_notify_payload(ids, [None] * len(ids)))
+
+    assert payload == {"count": len(ids), "priority": None}
+
+
+@pytest.mark.parametrize("payload", ["", '{"count": 2, "ids": [1', "[]", '{"a": 1}'])
+def test_parse_mt_notify_payload_invalid(payload):
+    assert parse_mt_notify_payload(payload) is None
+
+
+@pytest.mark.django_db
+def test_requeue_mt_messages():
+    """Only SENDING or SENT messages with the given sequence numbers on the
+    given backend are requeued.
+    """
+    backend = BackendFactory()
+    statuses = [
+        MTMessageStatusFactory(
+            backend=backend,
+            mt_message__backend=backend,
+            mt_message__status=status,
+            sequence_number=sequence_number,
+        )
+        for sequence_number, status in [
+            (1, MTMessage.Status.SENT),
+            (2, MTMessage.Status.SENDING),
+            (3, MTMessage.Status.DELIVERED),
+            (4, MTMessage.Status.SENT),
+        ]
+    ]
+    MTMessageStatusFactory(sequence_number=1, mt_message__status=MTMessage.Status.SENT)
+
+    assert requeue_mt_messages(backend, [1, 2, 3]) == 2
+
+    for status in statuses:
+        status.mt_message.refresh_from_db()
+    assert [s.mt_message.status for s in statuses] == [
+        MTMessage.Status.NEW,
+        MTMessage.Status.NEW,
+        MTMessage.Status.DELIVERED,
+        MTMessage.Status.SENT,
+    ]
+
+
+@pytest.mark.django_db
+class TestScheduleMTMessageRetries:
+    def test_retry_or_fail(self):
+        """Retryable failures are requeued with a backoff, and others are
+        marked as errors.
+        """
+        backend = BackendFactory()
+        now = timezone.now()
+        retryable, permanent, exhausted = [
+            MTMessageStatusFactory(
+                backend=backend,
+                mt_message__backend=backend,
+                mt_message__status=MTMessage.Status.SENT,
+                mt_message__attempt_count=attempt_count,
+            )
+            for attempt_count in [2, 1, 3]
+        ]
+        policy = RetryPolicy({8: {"max_attempts": 3}}, base_delay=10)
+
+        result = schedule_mt_message_retries(
+            backend,
+            [
+                (retryable.sequence_number, 8),
+                (permanent.sequence_number, 11),
+                (exhausted.sequence_number, 8),
+            ],
+            policy,
+            now=now,
+        )
+
+        assert result == (1, 2)
+        for status in [retryable, permanent, exhausted]:
+            status.mt_message.refresh_from_db()
+        assert retryable.mt_message.status == MTMessage.Status.NEW
+        assert retryable.mt_message.next_attempt_time == now + timedelta(seconds=20)
+        assert permanent.mt_message.status == MTMessage.Status.ERROR
+        assert exhausted.mt_message.status == MTMessage.Status.ERROR
+
+    def test_delivered_untouched(self):
+        status = MTMessageStatusFactory(mt_message__status=MTMessage.Status.DELIVERED)
+
+        assert schedule_mt_message_retries(
+            status.backend, [(status.sequence_number, 8)], RetryPolicy()
+        ) == (0, 0)
+
+    def test_empty(self):
+        assert schedule_mt_message_retries(BackendFactory(), [], RetryPolicy()) == (
+            0,
+            0,
+        )
+
+
+@pytest.mark.django_db
+def test_reclaim_expired_mt_messages():
+    """Only messages for the backend that have been SENDING for longer than
+    the lease are returned to NEW.
+    """
+    backend = BackendFactory()
+    now = timezone.now()
+    expired, current, sent = [
+        MTMessageFactory(
+            backend=backend, status=status, claim_time=now - timedelta(seconds=age)
+        )
+        for status, age in [
+            (MTMessage.Status.SENDING, 301),
+            (MTMessage.Status.SENDING, 299),
+            (MTMessage.Status.SENT, 301),
+        ]
+    ]
+    MTMessageFactory(
+        status=MTMessage.Status.SENDING, claim_time=now - timedelta(seconds=301)
+    )
+
+    assert reclaim_expired_mt_messages(backend, 300, now=now) == 1
+
+    for message in [expired, current, sent]:
+        message.refresh_from_db()
+    assert expired.status == MTMessage.Status.NEW
+    assert current.status == MTMessage.Status.SENDING
+    assert sent.status == MTMessage.Status.SENT
+
+
+@pytest.mark.django_db
+def test_reclaim_unacknowledged_sent_mt_messages():
+    """SENT messages are returned to NEW if a PDU of their latest attempt has
+    been awaiting a submit_sm_resp for longer than the lease.
+    """
+    backend = BackendFactory()
+    now = timezone.now()
+    messages = []
+    for written_age, claim_age, command_status in [
+        (301, 302, None),  # never acknowledged
+        (301, 302, 0),  # acknowledged
+        (299, 300, None),  # still within the lease
+        (301, 200, None),  # from an earlier attempt
+    ]:
+        status = MTMessageStatusFactory(
+            mt_message__backend=backend,
+            mt_message__status=MTMessage.Status.SENT,
+            mt_message__claim_time=now - timedelta(seconds=claim_age),
+            create_time=now - timedelta(seconds=written_age),
+            command_status=command_status,
+        )
+        messages.append(status.mt_message)
+
+    assert reclaim_expired_mt_messages(backend, 300, now=now) == 1
+
+    for message in messages:
+        message.refresh_from_db()
+    assert [message.status for message in messages] == [
+        MTMessage.Status.NEW,
+        MTMessage.Status.SENT,
+        MTMessage.Status.SENT,
+        MTMessage.Status.SENT,
+    ]
+
+
+@pytest.mark.django_db
+def test_write_mt_message_statuses():
+    """A placeholder status is created for each PDU, and SENDING messages are
+    marked as SENT.
+    """
+    backend = BackendFactory()
+    multipart, single = MTMessageFactory.create_batch(
+        2, backend=backend, status=MTMessage.Status.SENDING
+    )
+    delivered = MTMessageFactory(backend=backend, status=MTMessage.Status.DELIVERED)
+
+    count = write_mt_message_statuses(
+        backend,
+        [(multipart.pk, 1), (multipart.pk, 2), (single.pk, 3), (delivered.pk, 4)],
+    )
+
+    assert count == 4
+    statuses = MTMessageStatus.objects.filter(backend=backend).order_by(
+        "sequence_number"
+    )
+    assert [(s.mt_message_id, s.sequence_number) for s in statuses] == [
+        (multipart.pk, 1),
+        (multipart.pk, 2),
+        (single.pk, 3),
+        (delivered.pk, 4),
+    ]
+    # Not known until the submit_sm_resp arrives
+    assert all(s.submitted_at is None and s.command_status is None for s in statuses)
+    for message in [multipart, single, delivered]:
+        message.refresh_from_db()
+    assert multipart.status == single.status == MTMessage.Status.SENT
+    assert delivered.status == MTMessage.Status.DELIVERED
+
+
+def test_write_mt_message_statuses_empty():
+    assert write_mt_message_statuses(mock.Mock(), []) == 0
@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from smpp_gateway.receipts import DeliveryReceipt, parse_delivery_receipt
+
+
+def test_parse_delivery_receipt():
+    receipt = parse_delivery_receipt(
+        b"id:0123456789 sub:001 dlvrd:001 submit date:2101011200 "
+        b"done date:2101011201 stat:DELIVRD err:000 text:Hello stat:UNDELIV"
+    )
+
+    assert receipt == DeliveryReceipt(
+        "DELIVRD", 0, datetime(2021, 1, 1, 12, 1, tzinfo=timezone.utc)
+    )
+
+
+def test_parse_fields_in_any_order_and_case():
+    receipt = parse_delivery_receipt(
+        b"Stat:undeliv Err:34 Done Date:210101120159 id:abc"
+    )
+
+    assert receipt == DeliveryReceipt(
+        "UNDELIV", 34, datetime(2021, 1, 1, 12, 1, 59, tzinfo=timezone.utc)
+    )
+
+
+def test_parse_missing_fields():
+    assert parse_delivery_receipt(b"id:abc stat:EXPIRED") == DeliveryReceipt(
+        "EXPIRED", None, None
+    )
+
+
+def test_parse_invalid_done_date():
+    receipt = parse_delivery_receipt(b"stat:REJECTD done date:2113991200")
+
+    assert receipt.done_date is None
+
+
+@pytest.mark.parametrize("text", [None, b"", b"receipt", b"stat:NOPE err:000"])
+def test_parse_unknown_state(text):
+    assert parse_delivery_receipt(text) is None
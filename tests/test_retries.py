@@ -0,0 +1,44 @@
+import pytest
+import smpplib.consts
+
+from smpp_gateway.retries import RetryPolicy
+
+
+class TestRetryPolicy:
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(base_delay=10, multiplier=3, max_delay=100)
+        status = smpplib.consts.SMPP_ESME_RSYSERR
+
+        assert [policy.retry_delay(status, attempt) for attempt in range(1, 6)] == [
+            10,
+            30,
+            90,
+            100,
+            None,
+        ]
+
+    def test_not_retried(self):
+        """Statuses not in the policy are never retried."""
+        policy = RetryPolicy()
+
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RINVDSTADR, 1) is None
+
+    def test_from_json(self):
+        policy = RetryPolicy.from_json(
+            '{"max_attempts": 2, "statuses": {"0x45": {"base_delay": 60}, "8": {}}}'
+        )
+
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RSUBMITFAIL, 1) == 60
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RSYSERR, 1) == 30
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RSYSERR, 2) is None
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RX_T_APPN, 1) is None
+
+    def test_from_empty_json(self):
+        """The default statuses are retried if none are given."""
+        policy = RetryPolicy.from_json("")
+
+        assert policy.retry_delay(smpplib.consts.SMPP_ESME_RSYSERR, 1) == 30
+
+    def test_unknown_setting(self):
+        with pytest.raises(ValueError):
+            RetryPolicy({8: {"base_dleay": 1}})
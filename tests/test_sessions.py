@@ -0,0 +1,135 @@
+import threading
+
+from unittest import mock
+
+from smpp_gateway.sessions import SessionPool
+from smpp_gateway.smpp import start_smpp_sessions
+
+
+def test_sessions_run_concurrently():
+    """Every session runs in its own thread, at the same time."""
+    barrier = threading.Barrier(3, timeout=5)
+    names = []
+
+    def run_session(health):
+        names.append(threading.current_thread().name)
+        barrier.wait()
+
+    pool = SessionPool(
+        {name: run_session for name in ["bind0", "bind1", "bind2"]}, lambda: False
+    )
+
+    assert pool.run() == []
+    assert sorted(names) == ["bind0", "bind1", "bind2"]
+
+
+def test_failed_session_does_not_stop_others():
+    """A session that fails is reported, while the others keep running but
+    no longer count as healthy.
+    """
+    exit_signal = threading.Event()
+    pinged = threading.Event()
+    hc_worker = mock.Mock()
+
+    def run_session(health):
+        if threading.current_thread().name == "bind0":
+            raise ConnectionError
+        pool.sessions[0].join(timeout=5)
+        health.success_ping()
+        pinged.set()
+        exit_signal.wait(timeout=5)
+
+    pool = SessionPool(
+        {"bind0": run_session, "bind1": run_session},
+        exit_signal.is_set,
+        hc_worker=hc_worker,
+    )
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(pool.run()))
+    thread.start()
+    assert pinged.wait(timeout=5)
+    exit_signal.set()
+    thread.join(timeout=5)
+
+    assert [session.name for session in result] == ["bind0"]
+    assert isinstance(pool.sessions[0].error, ConnectionError)
+    hc_worker.fail_ping.assert_called_once()
+    hc_worker.success_ping.assert_not_called()
+
+
+def test_healthy_only_when_all_sessions_are():
+    hc_worker = mock.Mock()
+    pool = SessionPool(
+        {"bind0": mock.Mock(), "bind1": mock.Mock()},
+        lambda: False,
+        hc_worker=hc_worker,
+    )
+    for session in pool.sessions:
+        session.is_alive = mock.Mock(return_value=True)
+
+    pool.sessions[0].health.success_ping()
+    hc_worker.success_ping.assert_not_called()
+
+    pool.sessions[1].health.success_ping()
+    hc_worker.success_ping.assert_called_once()
+
+    pool.sessions[0].health.last_success_time -= pool.stale_after
+    assert not pool.is_healthy()
+
+
+@mock.patch("smpp_gateway.smpp.set_exit_signals", return_value=lambda: False)
+@mock.patch("smpp_gateway.smpp.smpplib_main_loop")
+@mock.patch("smpp_gateway.smpp.get_client_from_options")
+def test_split_bind_mode(mock_get_client, mock_main_loop, mock_set_exit_signals):
+    """In split mode, each bind is a transmitter that sends MT messages and a
+    receiver that doesn't.
+    """
+    options = {
+        "binds": 2,
+        "bind_mode": "split",
+        "system_id": "id",
+        "password": "pw",
+        "interface_version": None,
+        "system_type": None,
+        "hc_check_uuid": "",
+        "hc_ping_key": "",
+        "hc_check_slug": "",
+        "event_loop_timeout": 5,
+        "enquire_link_interval": None,
+        "queue_poll_interval": None,
+        "reconnect": True,
+    }
+
+    start_smpp_sessions(options, mock.Mock())
+
+    sessions = {
+        call.kwargs["logger_name"].rsplit(".", 1)[1]: call.kwargs["send_mt"]
+        for call in mock_get_client.call_args_list
+    }
+    assert sessions == {"tx0": True, "rx0": False, "tx1": True, "rx1": False}
+    assert sorted(
+        call.kwargs["bind_command"] for call in mock_main_loop.call_args_list
+    ) == ["bind_receiver", "bind_receiver", "bind_transmitter", "bind_transmitter"]
+
+
+@mock.patch("smpp_gateway.smpp.set_exit_signals", return_value=lambda: False)
+@mock.patch("smpp_gateway.smpp.SessionPool")
+def test_stale_after_follows_longest_interval(mock_pool, mock_set_exit_signals):
+    """Sessions are only stale once they've missed several keepalives or
+    queue polls, whichever is less frequent.
+    """
+    mock_pool.return_value.run.return_value = []
+    options = {
+        "binds": 2,
+        "bind_mode": "transceiver",
+        "hc_check_uuid": "",
+        "hc_ping_key": "",
+        "hc_check_slug": "",
+        "event_loop_timeout": 5,
+        "enquire_link_interval": 30,
+        "queue_poll_interval": None,
+    }
+
+    start_smpp_sessions(options, mock.Mock())
+
+    assert mock_pool.call_args.kwargs["stale_after"] == 90
@@ -0,0 +1,68 @@
+import time
+
+from unittest import mock
+
+import pytest
+
+from smpplib.exceptions import ConnectionError
+
+from smpp_gateway.supervisor import Backoff, run_supervised
+
+
+def test_backoff_grows_until_reset():
+    backoff = Backoff(base=1, maximum=10, random=lambda: 1)
+
+    assert [backoff.next_delay() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+    backoff.reset()
+    assert backoff.next_delay() == 1
+
+
+def test_backoff_jitter():
+    backoff = Backoff(base=4, random=lambda: 0.25)
+
+    assert backoff.next_delay() == 1
+
+
+def get_client(connect_errors: int):
+    client = mock.Mock()
+    client.exit_signal_received.return_value = False
+    client.connect.side_effect = [ConnectionError] * connect_errors + [None]
+    client.counters = {"reconnects": 0}
+    return client
+
+
+def test_reconnects_after_connection_error():
+    """A failed connection is closed and reconciled before reconnecting."""
+    client = get_client(connect_errors=2)
+    bind = mock.Mock()
+    sleep = mock.Mock(side_effect=time.sleep)
+
+    run_supervised(client, bind, Backoff(base=0.01, random=lambda: 1), sleep=sleep)
+
+    assert client.connect.call_count == 3
+    assert client.close_connection.call_count == 2
+    assert client.reconcile_in_flight.call_count == 2
+    assert client.counters["reconnects"] == 2
+    bind.assert_called_once()
+    client.listen.assert_called_once()
+    total = sum(call.args[0] for call in sleep.call_args_list)
+    assert total == pytest.approx(0.03, abs=0.01)
+
+
+def test_stops_on_exit_signal():
+    """No reconnection is attempted once the exit signal is received."""
+    client = get_client(connect_errors=1)
+    client.exit_signal_received.side_effect = [False, True, True]
+
+    run_supervised(client, mock.Mock(), Backoff(), sleep=mock.Mock())
+
+    client.connect.assert_called_once()
+    client.reconcile_in_flight.assert_called_once()
+
+
+def test_other_errors_not_caught():
+    client = get_client(connect_errors=0)
+    client.listen.side_effect = ValueError
+
+    with pytest.raises(ValueError):
+        run_supervised(client, mock.Mock(), Backoff(), sleep=mock.Mock())
@@ -0,0 +1,89 @@
+from smpp_gateway.throttling import AimdRateController, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket:
+    def test_starts_full(self):
+        """A new bucket allows `burst` PDUs straight away."""
+        bucket = TokenBucket(rate=10, burst=3, clock=FakeClock())
+
+        assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+    def test_refills_at_rate(self):
+        """Tokens are added at `rate` per second."""
+        clock = FakeClock()
+        bucket = TokenBucket(rate=4, burst=1, clock=clock)
+        assert bucket.consume()
+
+        assert bucket.time_until_available() == 0.25
+        clock.now += 0.125
+        assert not bucket.consume()
+        clock.now += 0.125
+        assert bucket.consume()
+
+    def test_refill_capped_at_burst(self):
+        """An idle bucket never holds more than `burst` tokens."""
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, burst=2, clock=clock)
+        clock.now += 60
+
+        assert [bucket.consume() for _ in range(3)] == [True, True, False]
+
+
+class TestAimdRateController:
+    def test_throttled_halves_rate_once_per_interval(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=20, clock=clock)
+        controller = AimdRateController(bucket, max_rate=20, clock=clock)
+
+        assert controller.throttled()
+        # A window full of throttled responses only counts once
+        assert not controller.throttled()
+        assert bucket.rate == 10
+        clock.now += 1
+        assert controller.throttled()
+        assert bucket.rate == 5
+
+    def test_min_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=3, clock=clock)
+        controller = AimdRateController(bucket, max_rate=3, min_rate=2, clock=clock)
+
+        assert controller.throttled()
+        clock.now += 1
+        assert not controller.throttled()
+        assert bucket.rate == 2
+
+    def test_recovers_gradually(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=20, clock=clock)
+        controller = AimdRateController(bucket, max_rate=20, clock=clock)
+        controller.throttled()
+
+        assert not controller.succeeded()
+        rates = []
+        for _ in range(12):
+            clock.now += 1
+            controller.succeeded()
+            rates.append(bucket.rate)
+
+        assert rates == [11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 20, 20]
+
+    def test_tokens_counted_at_old_rate(self):
+        """Tokens accumulated before a rate change are kept."""
+        clock = FakeClock()
+        bucket = TokenBucket(rate=4, burst=10, clock=clock)
+        bucket.tokens = 0
+        controller = AimdRateController(bucket, max_rate=4, clock=clock)
+        clock.now += 1
+
+        controller.throttled()
+
+        assert bucket.tokens == 4
@@ -0,0 +1,60 @@
+import pytest
+
+from smpp_gateway.timers import Timers
+from tests.test_throttling import FakeClock
+
+
+class TestTimers:
+    def test_timers_run_independently(self):
+        clock = FakeClock()
+        timers = Timers(clock=clock)
+        calls = []
+        timers.add(5, lambda: calls.append("keepalive"))
+        timers.add(2, lambda: calls.append("poll"))
+        assert timers.time_until_next() is not None
+
+        for _ in range(10):
+            clock.now += 1
+            timers.run_due()
+
+        assert calls == [
+            "poll",
+            "poll",
+            "keepalive",
+            "poll",
+            "poll",
+            "keepalive",
+            "poll",
+        ]
+
+    def test_time_until_next(self):
+        clock = FakeClock()
+        timers = Timers(clock=clock)
+        assert timers.time_until_next() is None
+
+        timers.add(5, lambda: None)
+        timers.add(2, lambda: None)
+        clock.now += 1.5
+
+        assert timers.time_until_next() == 0.5
+        clock.now += 1
+        assert timers.time_until_next() == 0
+
+    def test_rescheduled_after_callback(self):
+        """A timer is next due `interval` seconds after its callback returns,
+        even if it raised.
+        """
+        clock = FakeClock()
+        timers = Timers(clock=clock)
+
+        def slow_callback():
+            clock.now += 3
+            raise ValueError
+
+        timers.add(1, slow_callback)
+        clock.now += 1
+
+        with pytest.raises(ValueError):
+            timers.run_due()
+
+        assert timers.time_until_next() == 1